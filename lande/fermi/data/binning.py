@@ -1,21 +1,26 @@
 import re
+from os.path import expandvars
 from tempfile import NamedTemporaryFile
 
 import numpy as np
 import pyfits
+import pywcs
 
 from GtApp import GtApp
 
 
-def gtbin_from_binfile(evfile, outfile, scfile, binfile):
-    """ Run gtbin on ft1 file evfile to create outfile outfile.
-        but make the outfile have a binning consistent with the reference
-        binfile. """
-
-    global b
+def gtbin_kwargs_from_binfile(binfile):
+    """ The gtbin parameters which would create
+        a counts map/cube with the same binning as binfile. """
     b = pyfits.open(binfile)
-
     h = b['primary'].header
+    ebins = b['ENERGIES'].data.field('ENERGY') if 'ENERGIES' in [i.name for i in b] else None
+    return gtbin_kwargs_from_header(h, ebins)
+
+
+def gtbin_kwargs_from_header(h, ebins=None):
+    """ Same as gtbin_kwargs_from_binfile, but from the primary
+        header and energies (from the ENERGIES extension) of a binfile. """
 
     naxis = h['naxis']
 
@@ -57,8 +62,6 @@ def gtbin_from_binfile(evfile, outfile, scfile, binfile):
 
     elif naxis == 3:
 
-        ebins = b['ENERGIES'].data.field('ENERGY')
-
         emin = ebins[0]
         emax = ebins[-1]
         enumbins = len(ebins)
@@ -74,8 +77,258 @@ def gtbin_from_binfile(evfile, outfile, scfile, binfile):
             enumbins = enumbins,
         )
 
+    return kwargs
+
+
+def gtbin_from_binfile(evfile, outfile, scfile, binfile):
+    """ Run gtbin on ft1 file evfile to create outfile outfile.
+        but make the outfile have a binning consistent with the reference
+        binfile. """
+
+    kwargs = gtbin_kwargs_from_binfile(binfile)
+
     GtApp('gtbin').run(
         evfile=evfile, 
         outfile=outfile, 
         scfile=scfile, 
         **kwargs)
+
+
+class EventBinner(object):
+    """ Bin events into a counts map (CMAP) or counts cube (CCUBE)
+        with the same binning as the reference binfile. This creates
+        the same counts as gtbin_from_binfile, but without running gtbin.
+
+        Events are added in chunks (see bin_from_binfiles) so that an event
+        file never has to be read into memory all at once.
+
+        Example, binning a few synthetic events:
+
+            >>> header = pyfits.Header()
+            >>> for k,v in [('NAXIS',3), ('NAXIS1',4), ('NAXIS2',4), ('NAXIS3',3),
+            ...             ('CTYPE1','RA---CAR'), ('CTYPE2','DEC--CAR'), 
+            ...             ('CRPIX1',2.5), ('CRPIX2',2.5), ('CRVAL1',0.), ('CRVAL2',0.), 
+            ...             ('CDELT1',-1.), ('CDELT2',1.), ('CROTA2',0.)]:
+            ...     header.update(k,v)
+            >>> energies = [100., 1000., 10000.]
+            >>> binner = EventBinner(header, energies)
+            >>> binner.kwargs['algorithm'], binner.kwargs['enumbins']
+            ('CCUBE', 3)
+            >>> binner.add(ra=[0.5, 359.5, 0.5, 50.], dec=[0.5, -0.5, 0.5, 0.], 
+            ...            energy=[150., 5000., 9000., 150.], time=[0., 1., 2., 3.])
+            >>> binner.counts.shape
+            (3, 4, 4)
+            >>> int(binner.counts.sum()) # the last event is outside the map
+            3
+            >>> print binner.counts[0,2,1], binner.counts[2,1,2], binner.counts[2,2,1]
+            1 1 1
+    """
+    def __init__(self, binfile, energies=None, tmin=None, tmax=None):
+        """ binfile is either a reference counts map/cube (or a header
+            of one, in which case energies are the energies from
+            its ENERGIES extension). Only events between tmin and tmax
+            are binned. """
+        if isinstance(binfile, pyfits.Header):
+            header = binfile
+            self.kwargs = gtbin_kwargs_from_header(header, energies)
+        else:
+            binfile = expandvars(binfile)
+            header = pyfits.open(binfile)['primary'].header
+            self.kwargs = gtbin_kwargs_from_binfile(binfile)
+
+        self.tmin, self.tmax = tmin, tmax
+
+        self.wcs = pywcs.WCS(header, naxis=2)
+        self.header = self.wcs.to_header()
+        self.nx, self.ny = self.kwargs['nxpix'], self.kwargs['nypix']
+        self.galactic = self.kwargs['coordsys'] == 'GAL'
+
+        if self.kwargs['algorithm'] == 'CCUBE':
+            k = self.kwargs
+            self.energy_edges = np.logspace(np.log10(k['emin']), np.log10(k['emax']), k['enumbins']+1)
+            self.counts = np.zeros((k['enumbins'], self.ny, self.nx), dtype=int)
+        else:
+            self.energy_edges = None
+            self.counts = np.zeros((self.ny, self.nx), dtype=int)
+
+    def add(self, ra, dec, energy, time, l=None, b=None):
+        """ Bin a chunk of events. """
+        energy, time = np.asarray(energy, dtype=float), np.asarray(time, dtype=float)
+
+        lon, lat = (l, b) if self.galactic else (ra, dec)
+        if lon is None:
+            raise Exception("Galactic coordinates must be given to bin into a galactic map")
+        lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+
+        cut = np.ones(len(energy), dtype=bool)
+        if self.tmin is not None: cut &= time >= self.tmin
+        if self.tmax is not None: cut &= time < self.tmax
+        lon, lat, energy = lon[cut], lat[cut], energy[cut]
+
+        x, y = self.wcs.wcs_sky2pix(lon, lat, 0)
+
+        # Pixel i covers [i-0.5,i+0.5] and events which
+        # can not be projected are nan
+        good = np.isfinite(x) & np.isfinite(y)
+        x_edges = np.arange(self.nx+1) - 0.5
+        y_edges = np.arange(self.ny+1) - 0.5
+
+        if self.energy_edges is not None:
+            counts, edges = np.histogramdd(np.transpose([energy[good], y[good], x[good]]),
+                                           bins=[self.energy_edges, y_edges, x_edges])
+        else:
+            counts, edges = np.histogramdd(np.transpose([y[good], x[good]]),
+                                           bins=[y_edges, x_edges])
+        self.counts += counts.astype(int)
+
+    def write(self, outfile, gti_start, gti_stop, events_header=None):
+        """ Save the counts in the same format as gtbin. 
+        
+            Keywords describing the data selection (DSTYP, DSVAL, ...)
+            are copied from events_header, the header of the EVENTS extension. """
+        primary = pyfits.PrimaryHDU(data=self.counts.astype(np.int32))
+        for key in self.header.keys():
+            primary.header.update(key, self.header[key])
+
+        if events_header is not None:
+            for key in events_header.keys():
+                if key.startswith('DS') or key in ['NDSKEYS','TELESCOP','INSTRUME','EQUINOX','RADECSYS']:
+                    primary.header.update(key, events_header[key])
+
+        gti_start, gti_stop = np.asarray(gti_start, dtype=float), np.asarray(gti_stop, dtype=float)
+        if self.tmin is not None: gti_start = np.maximum(gti_start, self.tmin)
+        if self.tmax is not None: gti_stop = np.minimum(gti_stop, self.tmax)
+        keep = gti_start < gti_stop
+        gti_start, gti_stop = gti_start[keep], gti_stop[keep]
+
+        for h in [primary.header]:
+            h.update('TSTART', float(gti_start[0]) if len(gti_start) > 0 else 0.)
+            h.update('TSTOP', float(gti_stop[-1]) if len(gti_stop) > 0 else 0.)
+
+        if self.energy_edges is not None:
+            # N.B. The energy bins are logarithmic, so a linear WCS 
+            # axis only approximately describes them. The exact 
+            # bins are in the EBOUNDS extension.
+            primary.header.update('CTYPE3', 'Energy')
+            primary.header.update('CUNIT3', 'MeV')
+            primary.header.update('CRPIX3', 1.)
+            primary.header.update('CRVAL3', float(self.energy_edges[0]))
+            primary.header.update('CDELT3', float(self.energy_edges[-1]-self.energy_edges[0])/(len(self.energy_edges)-1))
+
+        hdulist = [primary]
+
+        if self.energy_edges is not None:
+            # N.B. EBOUNDS are in keV
+            ebounds = pyfits.new_table([
+                pyfits.Column(name='CHANNEL', format='I', array=np.arange(1, len(self.energy_edges))),
+                pyfits.Column(name='E_MIN', format='1E', unit='keV', array=self.energy_edges[:-1]*1e3),
+                pyfits.Column(name='E_MAX', format='1E', unit='keV', array=self.energy_edges[1:]*1e3)])
+            ebounds.name = 'EBOUNDS'
+            hdulist.append(ebounds)
+
+        gti = pyfits.new_table([
+            pyfits.Column(name='START', format='D', unit='s', array=gti_start),
+            pyfits.Column(name='STOP', format='D', unit='s', array=gti_stop)])
+        gti.name = 'GTI'
+        hdulist.append(gti)
+
+        pyfits.HDUList(hdulist).writeto(expandvars(outfile), clobber=True)
+
+
+def bin_from_binfiles(evfile, outfiles, binfiles, tmins=None, tmaxs=None, chunksize=1000000):
+    """ Bin the events in the ft1 file evfile into each of outfiles, with
+        the binning of the corresponding binfile (and optionally only
+        the events between the corresponding tmin and tmax).
+
+        This creates the same counts as running gtbin_from_binfile for each
+        output file, but reads evfile only once, chunksize rows at a time.
+
+        Example, binning a tiny ft1 file into a counts cube:
+
+            >>> import os, shutil
+            >>> from tempfile import mkdtemp
+            >>> tempdir = mkdtemp()
+            >>> binfile, evfile, outfile = [os.path.join(tempdir,i) for i in ['binfile.fits','ft1.fits','ccube.fits']]
+
+        The reference counts cube:
+
+            >>> reference = pyfits.PrimaryHDU(data=np.zeros((3,4,4), dtype=np.int32))
+            >>> for k,v in [('CTYPE1','RA---CAR'), ('CTYPE2','DEC--CAR'), 
+            ...             ('CRPIX1',2.5), ('CRPIX2',2.5), ('CRVAL1',0.), ('CRVAL2',0.), 
+            ...             ('CDELT1',-1.), ('CDELT2',1.), ('CROTA2',0.)]:
+            ...     reference.header.update(k,v)
+            >>> energies = pyfits.new_table([pyfits.Column(name='ENERGY', format='D', array=[100., 1000., 10000.])])
+            >>> energies.name = 'ENERGIES'
+            >>> pyfits.HDUList([reference, energies]).writeto(binfile)
+
+        The ft1 file (the last event is outside the map):
+
+            >>> events = pyfits.new_table([
+            ...     pyfits.Column(name='RA', format='E', array=[0.5, 359.5, 50.]),
+            ...     pyfits.Column(name='DEC', format='E', array=[0.5, -0.5, 0.]),
+            ...     pyfits.Column(name='ENERGY', format='E', array=[150., 5000., 150.]),
+            ...     pyfits.Column(name='TIME', format='D', array=[1., 2., 3.])])
+            >>> events.name = 'EVENTS'
+            >>> events.header.update('NDSKEYS', 0)
+            >>> gti = pyfits.new_table([
+            ...     pyfits.Column(name='START', format='D', array=[0.]),
+            ...     pyfits.Column(name='STOP', format='D', array=[10.])])
+            >>> gti.name = 'GTI'
+            >>> pyfits.HDUList([pyfits.PrimaryHDU(), events, gti]).writeto(evfile)
+
+            >>> bin_from_binfile(evfile, outfile, binfile)
+            >>> f = pyfits.open(outfile)
+            >>> [hdu.name for hdu in f]
+            ['PRIMARY', 'EBOUNDS', 'GTI']
+            >>> counts = f['PRIMARY'].data
+            >>> counts.shape, int(counts.sum()), int(counts[0,2,1]), int(counts[2,1,2])
+            ((3, 4, 4), 2, 1, 1)
+            >>> h = f['PRIMARY'].header
+            >>> print h['CTYPE1'], h['CTYPE2'], float(h['CRPIX1']), float(h['CRVAL1']), float(h['CDELT1'])
+            RA---CAR DEC--CAR 2.5 0.0 -1.0
+            >>> print h['CTYPE3'], h['CUNIT3'], h['CRPIX3'], h['CRVAL3'], h['CDELT3']
+            Energy MeV 1.0 100.0 3300.0
+            >>> print h['TSTART'], h['TSTOP'], h['NDSKEYS']
+            0.0 10.0 0
+            >>> ebounds = f['EBOUNDS'].data
+            >>> ebounds.field('CHANNEL').tolist()
+            [1, 2, 3]
+            >>> print ebounds.field('E_MIN')[0], ebounds.field('E_MAX')[-1] # keV
+            100000.0 10000000.0
+            >>> f['GTI'].data.field('START').tolist(), f['GTI'].data.field('STOP').tolist()
+            ([0.0], [10.0])
+            >>> f.close()
+            >>> shutil.rmtree(tempdir)
+    """
+    if tmins is None: tmins = [None]*len(binfiles)
+    if tmaxs is None: tmaxs = [None]*len(binfiles)
+
+    binners = [EventBinner(binfile, tmin=tmin, tmax=tmax) for binfile,tmin,tmax in zip(binfiles, tmins, tmaxs)]
+    galactic = any(binner.galactic for binner in binners)
+
+    f = pyfits.open(expandvars(evfile), memmap=True)
+    events = f['EVENTS']
+    nrows = events.header['NAXIS2']
+
+    for start in range(0, nrows, chunksize):
+        chunk = events.data[start:start+chunksize]
+        columns = dict(ra=chunk.field('RA'), dec=chunk.field('DEC'),
+                       energy=chunk.field('ENERGY'), time=chunk.field('TIME'))
+        if galactic:
+            columns.update(l=chunk.field('L'), b=chunk.field('B'))
+        for binner in binners:
+            binner.add(**columns)
+
+    gti = f['GTI'].data
+    for binner,outfile in zip(binners, outfiles):
+        binner.write(outfile, gti.field('START'), gti.field('STOP'), events_header=events.header)
+
+
+def bin_from_binfile(evfile, outfile, binfile, **kwargs):
+    """ In-process replacement for gtbin_from_binfile. """
+    bin_from_binfiles(evfile, [outfile], [binfile], **kwargs)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,7 +1,179 @@
-""" Store paths to important catalog data. 
+""" Store paths to important catalog data.
+
+    The data is expected to be in catalog_dir, which defaults
+    to the catalog directory on AFS but can be changed with the
+    $CATALOG_DIR environment variable (or with set_catalog_dir)
+    so that it works on machines without AFS.
+
+    This file also contains CatalogStore, which provides quick access
+    to the sources of a catalog (like 2FGL). Usage:
+
+        store = get_catalog_store('$FERMI/catalogs/gll_psc_v05.fit')
+
+        # all sources within 10 degrees of the crab
+        names = store.cone_search(83.63, 22.01, 10)
+
+        source = store['2FGL J0534.5+2201']
+        print source['Flux_Density']
+
+    For building pointlike ROIs, lande.fermi.likelihood.catalogs.StoreCatalog2FGL
+    is a Catalog2FGL which does its cone searches with a CatalogStore.
 """
+import os
+from os.path import exists, expandvars, getmtime, getsize
 from glob import glob
-dict2fgl = dict(ft2="/afs/slac/g/glast/groups/catalog/P7_V4_SOURCE/ft2_2years.fits",
-                ltcube="/afs/slac/g/glast/groups/catalog/P7_V4_SOURCE/ltcube_24m_pass7.4_source_z100_t90_cl0.fits",
-                ft1=glob("/afs/slac/g/glast/groups/catalog/P7_V4_SOURCE/pass7.3_pre_source_merit_*_pass7.4_source_z100_t90_cl0.fits"),
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+import pyfits
+from scipy.spatial import cKDTree
+
+catalog_dir = os.environ.get('CATALOG_DIR', '/afs/slac/g/glast/groups/catalog/P7_V4_SOURCE')
+
+def get_dict2fgl(catalog_dir):
+    return dict(ft2="%s/ft2_2years.fits" % catalog_dir,
+                ltcube="%s/ltcube_24m_pass7.4_source_z100_t90_cl0.fits" % catalog_dir,
+                ft1=glob("%s/pass7.3_pre_source_merit_*_pass7.4_source_z100_t90_cl0.fits" % catalog_dir),
                )
+
+dict2fgl = get_dict2fgl(expandvars(catalog_dir))
+
+def set_catalog_dir(dir):
+    """ Point dict2fgl at a different copy of the catalog data. """
+    global catalog_dir
+    catalog_dir = dir
+    dict2fgl.clear()
+    dict2fgl.update(get_dict2fgl(expandvars(dir)))
+
+
+def normalize_name(name):
+    """ Names are matched ignoring case and spaces:
+
+            >>> normalize_name(' 2FGL J0534.5+2201 ')
+            '2FGLJ0534.5+2201'
+            >>> normalize_name('Crab pulsar')
+            'CRABPULSAR'
+    """
+    return name.replace(' ','').upper()
+
+def unit_vectors(ra, dec):
+    """ Cartesian unit vectors for the sky positions (in degrees):
+
+            >>> (np.round(unit_vectors([0, 90, 0], [0, 0, 90]), 10) + 0).tolist()
+            [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.vstack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)]).T
+
+
+class CatalogStore(object):
+    """ A catalog loaded once into memory as a table of columns,
+        indexed by position (a KD-tree of unit vectors) for cone
+        searches and by name (including the associations) for lookups.
+
+        The columns are saved to indexfile (by default next to the
+        catalog file) so that later loads do not have to read
+        the FITS file. The index is rebuilt whenever the catalog
+        file changes. """
+
+    name_columns = ['Source_Name', 'ASSOC1', 'ASSOC2']
+
+    def __init__(self, filename, indexfile=None, hdu=1):
+        self.filename = expandvars(filename)
+        if indexfile is None: indexfile = self.filename + '.index.npz'
+        self.indexfile = expandvars(indexfile)
+        self.hdu = hdu
+
+        self.columns = self._load_index()
+        if self.columns is None:
+            self.columns = self._read_catalog()
+            self._save_index()
+
+        self.names = np.asarray([i.strip() for i in self.columns['Source_Name']])
+        self.name_index = dict()
+        for column in self.name_columns:
+            if column not in self.columns: continue
+            for i,name in enumerate(self.columns[column]):
+                name = normalize_name(name)
+                if name != '': self.name_index.setdefault(name, i)
+
+        self.tree = cKDTree(unit_vectors(self.columns['RAJ2000'], self.columns['DEJ2000']))
+
+    def _file_id(self):
+        return np.asarray([getsize(self.filename), getmtime(self.filename)])
+
+    def _read_catalog(self):
+        data = pyfits.open(self.filename)[self.hdu].data
+        return dict((name, np.asarray(data.field(name))) for name in data.names)
+
+    def _load_index(self):
+        if not exists(self.indexfile): return None
+        try:
+            index = np.load(self.indexfile)
+            if not np.all(index['__file_id__'] == self._file_id()): return None
+            return dict((k,index[k]) for k in index.files if k != '__file_id__')
+        except Exception, ex:
+            print 'Unable to load catalog index %s: %s' % (self.indexfile, ex)
+            return None
+
+    def _save_index(self):
+        """ Save the index atomically, and don't fail if
+            the catalog directory is not writable. """
+        try:
+            temp = NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(self.indexfile)), suffix='.npz', delete=False)
+            np.savez(temp, __file_id__=self._file_id(), **self.columns)
+            temp.close()
+            os.rename(temp.name, self.indexfile)
+        except Exception, ex:
+            print 'Unable to save catalog index %s: %s' % (self.indexfile, ex)
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, name):
+        """ Row of the source with the given name (or association). """
+        return self.name_index[normalize_name(name)]
+
+    def __contains__(self, name):
+        return normalize_name(name) in self.name_index
+
+    def __getitem__(self, name):
+        """ A dictionary of all the catalog values for a source. """
+        i = self.index(name)
+        return dict((k,v[i]) for k,v in self.columns.items())
+
+    def column(self, column, names=None):
+        """ Values of a column for the given names (or for all sources). """
+        if names is None: return self.columns[column]
+        return self.columns[column][[self.index(name) for name in names]]
+
+    def cone_indices(self, ra, dec, radius):
+        """ Rows of all sources within radius (in degrees) of (ra,dec),
+            sorted by distance. """
+        v = unit_vectors(ra, dec)[0]
+        # convert the angular radius into a chord length
+        chord = 2*np.sin(np.radians(min(radius, 180.))/2)
+        indices = np.asarray(self.tree.query_ball_point(v, chord*(1+1e-12)), dtype=int)
+        distances = np.sum((self.tree.data[indices] - v)**2, axis=1)
+        return indices[np.argsort(distances)]
+
+    def cone_search(self, ra, dec, radius):
+        """ Names of all sources within radius (in degrees) of (ra,dec),
+            sorted by distance. """
+        return self.names[self.cone_indices(ra, dec, radius)].tolist()
+
+
+_catalog_stores = dict()
+
+def get_catalog_store(filename, **kwargs):
+    """ Get a CatalogStore for filename, loading the catalog
+        only the first time it is requested. """
+    key = os.path.abspath(expandvars(filename))
+    if key not in _catalog_stores:
+        _catalog_stores[key] = CatalogStore(filename, **kwargs)
+    return _catalog_stores[key]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,8 +1,11 @@
 import os
 import math
-from os.path import exists, join
+import shutil
+import hashlib
+from os.path import exists, join, expandvars, getmtime, getsize
+from glob import glob
 from textwrap import dedent
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 
 import numpy as np
 import pyfits
@@ -12,8 +15,10 @@ import skymaps
 
 from uw.like.roi_monte_carlo import MonteCarlo
 
-from lande.utilities.jobtools import JobBuilder
+from lande.utilities.jobtools import JobBuilder, run_jobs_locally
 from lande.utilities.shell import format_command
+from lande.utilities.files import file_hash
+from lande.utilities.parallel import fork_map, default_processes
 
 def fix_pointlike_ltcube(ltcube):
     """ Modify a pointlike ltcube so that it can be used in gtlike. """
@@ -62,7 +67,7 @@ def batch_gtltcube(evfile, scfile, outfile, savedir, njobs=100, **kwargs):
 
         if not exists(subdir): os.makedirs(subdir)
 
-        cut_evfile=os.path.basename(evfile).replace('.fits','_%s_%s.fits')
+        cut_evfile=os.path.basename(evfile).replace('.fits','_%s_%s.fits' % (tmin_fmt,tmax_fmt))
         gtselect_command = format_command('gtselect',
                                           infile=evfile,
                                           outfile=cut_evfile,
@@ -89,9 +94,24 @@ def batch_gtltcube(evfile, scfile, outfile, savedir, njobs=100, **kwargs):
 
     merge = join(savedir,'merge.py')
     open(merge,'w').write(dedent("""\
-        from lande.fermi.data.livetime import recursive_gtltsum
-        from glob import iglob
-        recursive_gtltsum(iglob("*/ltcube*.fits"),"%s")""" % outfile))
+        from lande.fermi.data.livetime import sum_ltcubes
+        from glob import glob
+        sum_ltcubes(glob("*/ltcube*.fits"),"%s")""" % outfile))
+
+
+def local_gtltcube(evfile, scfile, outfile, savedir, njobs=100, processes=None, retries=2, **kwargs):
+    """ Compute a livetime cube in time slices on this computer (see batch_gtltcube),
+        running up to processes slices at once, and then sum the slices into outfile. 
+        
+        Slices which are already finished (for example from
+        an interrupted earlier run) are not recomputed. """
+    batch_gtltcube(evfile, scfile, outfile, savedir, njobs=njobs, **kwargs)
+
+    failed = run_jobs_locally(sorted(glob(join(savedir,'*','run.sh'))), processes=processes, retries=retries)
+    if len(failed) > 0:
+        raise Exception("Unable to compute %s livetime cube slices: %s" % (len(failed), ', '.join(failed)))
+
+    sum_ltcubes(glob(join(savedir,'*','ltcube*.fits')), outfile, parallel=True, processes=processes)
 
 
 def recursive_gtltsum(infiles, outfile):
@@ -116,29 +136,224 @@ def recursive_gtltsum(infiles, outfile):
 
     accum=reduce(sum_ltcube, infiles)
     if accum == tempfile:
-        os.move(tempfile, outfile)
+        shutil.move(tempfile, outfile)
     else:
         os.remove(tempfile)
 
 
-def pointlike_ltcube(evfile,scfile,outfile,dcostheta,binsz, zmax, cone_angle,dir,quiet=False):
-    """ Run the pointlike ltcube code. """
+_exposure_extensions = ['EXPOSURE', 'WEIGHTED_EXPOSURE']
+
+def merge_gtis(starts, stops):
+    """ Merge a list of good time intervals into sorted, 
+        non-overlapping intervals. Touching intervals are joined.
+
+            >>> starts, stops = merge_gtis([5, 0, 7], [7, 5, 20])
+            >>> print starts, stops
+            [0] [20]
+            >>> starts, stops = merge_gtis([10, 0], [20, 5])
+            >>> print starts, stops
+            [ 0 10] [ 5 20]
+
+        Summing livetime cubes with overlapping intervals would count
+        the same exposure twice, so this is an error:
+
+            >>> merge_gtis([0, 4], [5, 10])
+            Traceback (most recent call last):
+                ...
+            Exception: Overlapping GTIs: [0, 5] and [4, 10]
+    """
+    starts, stops = np.asarray(starts), np.asarray(stops)
+    order = np.argsort(starts, kind='mergesort')
+    starts, stops = starts[order], stops[order]
+
+    overlap = np.flatnonzero(starts[1:] < stops[:-1])
+    if len(overlap) > 0:
+        i = overlap[0]
+        raise Exception("Overlapping GTIs: [%s, %s] and [%s, %s]" % (starts[i],stops[i],starts[i+1],stops[i+1]))
+
+    # join intervals where one starts when the previous stops
+    new = np.append(True, starts[1:] > stops[:-1])
+    return starts[new], stops[np.append(new[1:], True)]
+
+
+def _sum_ltcube_files(infiles, outfile):
+    """ Sum the livetime cubes infiles into outfile.
+
+        The exposure tables of one cube at a time are memory mapped
+        and added into an accumulator, so the memory used does
+        not depend on the number of cubes. """
+    template = pyfits.open(infiles[0])
+    extensions = [e for e in _exposure_extensions if e in [i.name for i in template]]
+
+    accumulators = dict()
+    for e in extensions:
+        data = template[e].data
+        accumulators[e] = dict((c,np.array(data.field(c), dtype=float)) for c in data.columns.names)
+
+    starts, stops = [template['GTI'].data.field('START')], [template['GTI'].data.field('STOP')]
+
+    for infile in infiles[1:]:
+        f = pyfits.open(infile, memmap=True)
+        if [e for e in _exposure_extensions if e in [i.name for i in f]] != extensions:
+            raise Exception("Livetime cube %s has different extensions from %s" % (infile, infiles[0]))
+
+        for e in extensions:
+            data = f[e].data
+            for c,accumulator in accumulators[e].items():
+                column = data.field(c)
+                if column.shape != accumulator.shape:
+                    raise Exception("Column %s of %s in livetime cube %s has shape %s (expected %s)" % \
+                                    (c, e, infile, column.shape, accumulator.shape))
+                accumulator += column
+
+        starts.append(f['GTI'].data.field('START'))
+        stops.append(f['GTI'].data.field('STOP'))
+        f.close()
+
+    for e in extensions:
+        for c,accumulator in accumulators[e].items():
+            template[e].data.field(c)[:] = accumulator
+
+    start, stop = merge_gtis(np.concatenate(starts), np.concatenate(stops))
+    old_gti = template['GTI']
+    gti = pyfits.new_table(old_gti.columns, nrows=len(start))
+    gti.data.field('START')[:] = start
+    gti.data.field('STOP')[:] = stop
+    for key in old_gti.header.keys():
+        if key not in gti.header.keys() and key not in ['COMMENT', 'HISTORY', '']:
+            gti.header.update(key, old_gti.header[key])
+    template[template.index_of('GTI')] = gti
+
+    tstart, tstop = float(start[0]), float(stop[-1])
+    for hdu in template:
+        h = hdu.header
+        if 'TSTART' in h.keys(): h.update('TSTART', tstart)
+        if 'TSTOP' in h.keys(): h.update('TSTOP', tstop)
+        if 'TELAPSE' in h.keys(): h.update('TELAPSE', tstop-tstart)
+        if 'ONTIME' in h.keys(): h.update('ONTIME', float(np.sum(stop-start)))
+
+    template.writeto(outfile, clobber=True)
+    fix_pointlike_ltcube(outfile)
+
 
-    gti = skymaps.Gti(evfile)
+def sum_ltcubes(infiles, outfile, parallel=False, processes=None, verbosity=True):
+    """ Sum livetime cubes (created by gtltcube or pointlike_ltcube 
+        over non-overlapping time ranges) without running gtltsum.
 
-    for weighted,clobber in [[False,True],[True,False]]:
+        The exposures are summed in numpy and the GTIs of all cubes
+        are merged. The output has the header keywords required by gtlike.
 
-        lt = skymaps.LivetimeCube(
-            cone_angle = cone_angle,
-            dir        = dir,
-            zcut       = math.cos(math.radians(zmax)),
-            pixelsize  = binsz,
-            quiet      = quiet,
-            weighted   = weighted)
+        If parallel, the cubes are split into one group per worker
+        process, each group is summed into a temporary cube, and then
+        the temporary cubes are summed together. """
+    infiles = [expandvars(i) for i in infiles]
+    outfile = expandvars(outfile)
+    if len(infiles) < 1: raise Exception('Must sum >= 1 livetime cubes')
 
-        lt.load(scfile,gti)
+    if processes is None: processes = default_processes()
 
-        extension = 'WEIGHTED_EXPOSURE' if weighted else 'EXPOSURE'
-        lt.write(outfile,extension,clobber)
+    if not parallel or processes < 2 or len(infiles) <= processes:
+        if verbosity: print 'Summing %s livetime cubes into %s' % (len(infiles), outfile)
+        _sum_ltcube_files(infiles, outfile)
+        return
 
-    fix_pointlike_ltcube(outfile)
+    tempdir = mkdtemp(prefix='sum_ltcubes_')
+    try:
+        groups = [infiles[i::processes] for i in range(processes)]
+        partials = [join(tempdir, 'ltcube_%s.fits' % i) for i in range(processes)]
+
+        if verbosity: print 'Summing %s livetime cubes in %s groups' % (len(infiles), len(groups))
+        fork_map(lambda i: _sum_ltcube_files(groups[i], partials[i]), range(len(groups)), processes=processes)
+
+        if verbosity: print 'Summing %s partial livetime cubes into %s' % (len(partials), outfile)
+        _sum_ltcube_files(partials, outfile)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+_ft2_hashes = dict()
+
+def pointlike_ltcube_key(evfile, scfile, binsz, zmax, cone_angle, dir):
+    """ A key which uniquely identifies a pointlike livetime cube. 
+
+        The ft2 file is only hashed again when its size or mtime changes. """
+    gti = pyfits.open(evfile)['GTI'].data
+    gti_hash = hashlib.sha1(np.asarray(gti.field('START'),dtype=float).tostring() + 
+                            np.asarray(gti.field('STOP'),dtype=float).tostring()).hexdigest()
+
+    # only hash each (unchanged) file once per process
+    scfile = expandvars(scfile)
+    id = (os.path.abspath(scfile), getsize(scfile), getmtime(scfile))
+    if id not in _ft2_hashes: _ft2_hashes[id] = file_hash(scfile)
+
+    key = (_ft2_hashes[id], gti_hash, 
+           float(cone_angle), round(dir.ra(),6), round(dir.dec(),6), 
+           float(zmax), float(binsz))
+    return hashlib.sha1(repr(key)).hexdigest()
+
+
+def _pointlike_ltcube_extension(evfile, scfile, outfile, binsz, zmax, cone_angle, dir, quiet, weighted):
+    gti = skymaps.Gti(evfile)
+
+    lt = skymaps.LivetimeCube(
+        cone_angle = cone_angle,
+        dir        = dir,
+        zcut       = math.cos(math.radians(zmax)),
+        pixelsize  = binsz,
+        quiet      = quiet,
+        weighted   = weighted)
+
+    lt.load(scfile,gti)
+
+    extension = 'WEIGHTED_EXPOSURE' if weighted else 'EXPOSURE'
+    lt.write(outfile,extension,True)
+
+
+def pointlike_ltcube(evfile,scfile,outfile,dcostheta,binsz, zmax, cone_angle,dir,quiet=False,cachedir=None):
+    """ Run the pointlike ltcube code. 
+    
+        N.B. skymaps.LivetimeCube can only fill one extension at a time,
+        so the spacecraft file is still read and integrated twice: once
+        for EXPOSURE and once for WEIGHTED_EXPOSURE. The two passes run
+        at the same time in two processes, which reduces the wall
+        time but not the cpu time. The savings for repeated ROIs
+        come from the cache.
+
+        If cachedir is given, the livetime cube is cached there, keyed by
+        the spacecraft file, GTIs, cone_angle, dir, zmax, and binsz. 
+        A livetime cube which has already been computed is copied from the cache. """
+    evfile, scfile, outfile = expandvars(evfile), expandvars(scfile), expandvars(outfile)
+
+    if cachedir is not None:
+        cachedir = expandvars(cachedir)
+        if not exists(cachedir): os.makedirs(cachedir)
+        key = pointlike_ltcube_key(evfile, scfile, binsz, zmax, cone_angle, dir)
+        cached = join(cachedir, 'ltcube_%s.fits' % key)
+        if exists(cached):
+            if not quiet: print 'Using cached livetime cube %s' % cached
+            shutil.copy(cached, outfile)
+            return
+
+    tempdir = mkdtemp(prefix='pointlike_ltcube_')
+    try:
+        outfiles = [join(tempdir, 'ltcube_%s.fits' % i) for i in ['EXPOSURE', 'WEIGHTED_EXPOSURE']]
+        compute = lambda weighted: _pointlike_ltcube_extension(evfile, scfile, outfiles[weighted], 
+                                                               binsz, zmax, cone_angle, dir, quiet, weighted)
+        fork_map(compute, [False, True])
+
+        f = pyfits.open(outfiles[0])
+        weighted = pyfits.open(outfiles[1])['WEIGHTED_EXPOSURE']
+        f.append(pyfits.BinTableHDU(data=weighted.data, header=weighted.header))
+        temp = join(tempdir, 'ltcube.fits')
+        f.writeto(temp)
+        fix_pointlike_ltcube(temp)
+
+        if cachedir is not None:
+            # copy, then rename, so other jobs never see a partial file
+            partial = NamedTemporaryFile(dir=cachedir, suffix='.fits', delete=False).name
+            shutil.copy(temp, partial)
+            os.rename(partial, cached)
+
+        shutil.move(temp, outfile)
+    finally:
+        shutil.rmtree(tempdir)
@@ -1,8 +1,13 @@
 import os
+import re
 import math
+import hashlib
+from os.path import exists, join, expandvars, dirname
+from tempfile import NamedTemporaryFile
 
 import pylab as P
 import numpy as np
+import pyfits
 import pywcsgrid2
 
 from mpl_toolkits.axes_grid1.axes_grid import ImageGrid
@@ -13,10 +18,32 @@ from uw.like.mapplots import ROITSMapPlotter, ROISmoothedSources, ROISmoothedSou
 from uw.like.roi_state import PointlikeState
 from uw.like.roi_plotting import tight_layout
 
+from lande.utilities.parallel import fork_map
+from lande.fermi.likelihood.counts import pointlike_state_key
+
 
 class ROIBandPlotter(object):
+    """ Plot a map (TS map, smoothed counts, ...) of an ROI
+        in each of several energy bands.
+
+        Only the image of each map (a numpy array and its header)
+        is kept and plotted, so the result does not depend on
+        where (or whether) the map was computed.
+
+        If parallel, each band is computed in its own worker process,
+        which changes the binning of its own copy of the ROI.
+
+        If cachedir is given, the band images are cached as FITS files
+        there, keyed by the state of the ROI and the options
+        which change the map. Options which only change
+        how the map looks (title, figsize, ...) do not
+        cause the maps to be recomputed. """
 
-    def __init__(self,roi,bin_edges,nrows=1,grid_kwargs=dict(),**kwargs):
+    # options of the map objects which do not change the computed map
+    style_options = ['title', 'figsize', 'fignum', 'colorbar_radius', 'cmap']
+
+    def __init__(self,roi,bin_edges,nrows=1,grid_kwargs=dict(),
+                 parallel=True,processes=None,cachedir=None,**kwargs):
 
         default_grid_kwargs = dict(axes_pad=0.1, 
                                    cbar_location="top",
@@ -42,23 +69,99 @@ class ROIBandPlotter(object):
         self.lower_energies = bin_edges[:-1]
         self.upper_energies = bin_edges[1:]
 
-        state = PointlikeState(roi)
- 
-        # step 1, test consistentcy of each energy with binning in pointlike
+        self.parallel = parallel
+        self.processes = processes
+        self.cachedir = expandvars(cachedir) if cachedir is not None else None
 
         kwargs['title'] = '' # dont title the subplots
-        self.maps = []
-        for i,(lower,upper) in enumerate(zip(self.lower_energies, self.upper_energies)):
+        self.images = self._compute_images(kwargs)
+
+    def _compute_images(self, kwargs):
+        """ The (data, header) of the image in each band. """
+        roi = self.roi
+        bands = zip(self.lower_energies, self.upper_energies)
+
+        def compute(band):
+            # Note, when run in parallel, this modifies
+            # only the worker's copy of the ROI.
+            state = PointlikeState(roi)
+            lower,upper = band
             roi.change_binning(fit_emin=lower,fit_emax=upper)
-            self.maps.append(self.object(roi,**kwargs))
-
-        state.restore()
+            image = ROIBandPlotter._get_image(self.object(roi,**kwargs))
+            state.restore()
+            return image
+
+        images = [None]*len(bands)
+        if self.cachedir is not None:
+            if not exists(self.cachedir): os.makedirs(self.cachedir)
+            cachefiles = [join(self.cachedir, 'band_image_%s.fits' % self._cache_key(band, kwargs)) for band in bands]
+            for i,cachefile in enumerate(cachefiles):
+                if exists(cachefile): images[i] = ROIBandPlotter._read_image(cachefile)
+
+        todo = [i for i,image in enumerate(images) if image is None]
+        if self.parallel and len(todo) > 1:
+            computed = fork_map(compute, [bands[i] for i in todo], processes=self.processes)
+        else:
+            computed = [compute(bands[i]) for i in todo]
+
+        for i,image in zip(todo, computed):
+            images[i] = image
+            if self.cachedir is not None:
+                ROIBandPlotter._write_image(image, cachefiles[i])
+
+        return images
+
+    def _cache_key(self, band, kwargs):
+        roi = self.roi
+        options = sorted((k,v) for k,v in kwargs.items() if k not in self.style_options)
+        key = (self.object.__name__, pointlike_state_key(roi), tuple(roi.bin_edges), 
+               roi.roi_dir.ra(), roi.roi_dir.dec(), tuple(band), repr(options))
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    @staticmethod
+    def _get_image(map):
+        """ The image of a map object (from its pyfits HDUList pf) 
+            as a numpy array and a list of the (key, value) header cards,
+            so that it can be pickled and sent back from a worker. """
+        hdu = map.pf['PRIMARY']
+        return np.array(hdu.data), ROIBandPlotter._cards(hdu.header)
+
+    @staticmethod
+    def _cards(header):
+        """ The header cards which describe the image (and not the FITS file structure). """
+        structure = re.compile('(SIMPLE|BITPIX|NAXIS[0-9]*|EXTEND|COMMENT|HISTORY|)$')
+        return [(k,v) for k,v in header.items() if not structure.match(k)]
+
+    @staticmethod
+    def _header(cards):
+        header = pyfits.Header()
+        for k,v in cards: header.update(k,v)
+        return header
+
+    @staticmethod
+    def _write_image(image, filename):
+        """ Write atomically so that other jobs sharing
+            the cachedir never see a partial file. """
+        data, cards = image
+        temp = NamedTemporaryFile(dir=dirname(filename), suffix='.fits', delete=False)
+        temp.close()
+        pyfits.PrimaryHDU(data=data, header=ROIBandPlotter._header(cards)).writeto(temp.name, clobber=True)
+        os.rename(temp.name, filename)
+
+    @staticmethod
+    def _read_image(filename):
+        f = pyfits.open(filename, memmap=False)
+        hdu = f['PRIMARY']
+        image = np.array(hdu.data), ROIBandPlotter._cards(hdu.header)
+        f.close()
+        return image
 
     def show(self,filename=None):
         self.fig = fig = P.figure(self.fignum,self.figsize)
         P.clf()
 
-        header = self.maps[0].header
+        data, cards = self.images[0]
+        header = ROIBandPlotter._header([('NAXIS',2), ('NAXIS1',data.shape[-1]), ('NAXIS2',data.shape[-2])] + cards)
 
         self.grid = grid = ImageGrid(fig, (1, 1, 1), 
                                      nrows_ncols = (self.nrows, self.ncols),
@@ -67,8 +170,10 @@ class ROIBandPlotter(object):
                                                  dict(header=header)),
                                     **self.grid_kwargs)
 
-        for i,(map,lower,upper) in enumerate(zip(self.maps,self.lower_energies,self.upper_energies)):
-            map.show(axes=grid[i], cax=grid[i].cax)
+        for i,((data,cards),lower,upper) in enumerate(zip(self.images,self.lower_energies,self.upper_energies)):
+            im = grid[i].imshow(data, origin='lower', interpolation='nearest', 
+                                cmap=getattr(self, 'cmap', None))
+            grid[i].cax.colorbar(im)
             format_energy=lambda x: '%.1f' % (x/1000.) if x < 1000 else '%.0f' % (x/1000.)
             lower_string=format_energy(lower)
             upper_string=format_energy(upper)
@@ -1,14 +1,166 @@
-import pyfits
 import os
-from subprocess import check_call
+import gzip
+from os.path import dirname, abspath, basename, exists
+from tempfile import NamedTemporaryFile
+
+import numpy as np
 from skymaps import DiffuseFunction
 
 from uw.like.Models import Constant
 from uw.like.roi_diffuse import DiffuseSource
 from uw.like.roi_monte_carlo import MCModelBuilder
 
-def merge_diffuse(diffuse_sources, scaling_model=None, mergefile=None, verbosity=False, short_name=False , compress=False):
-    """ merge diffuse files into one file. """
+_block = 2880
+_dtypes = {8:'>u1', 16:'>i2', 32:'>i4', 64:'>i8', -32:'>f4', -64:'>f8'}
+
+def _open(filename):
+    """ Open a (possibly gzipped) file for sequential reading. """
+    f = open(filename,'rb')
+    gzipped = f.read(2) == '\x1f\x8b'
+    f.close()
+    if gzipped:
+        return gzip.open(filename,'rb')
+    return open(filename,'rb')
+
+def _read_header(f):
+    """ Read the primary header of an open FITS file (as a string),
+        leaving the file at the start of the data. """
+    blocks = []
+    while True:
+        block = f.read(_block)
+        if len(block) < _block: raise Exception("No END card in FITS header")
+        blocks.append(block)
+        if any(block[i:i+8] == 'END     ' for i in range(0,_block,80)): break
+    return ''.join(blocks)
+
+def _cards(header):
+    return [header[i:i+80] for i in range(0,len(header),80)]
+
+def _header_values(header):
+    """ The values of the keywords in a FITS header string:
+
+            >>> header = 'SIMPLE  =                    T'.ljust(80) + 'BITPIX  =                  -32 / comment'.ljust(80) + 'END'.ljust(80)
+            >>> _header_values(header)['BITPIX']
+            -32
+    """
+    values = dict()
+    for card in _cards(header):
+        if card[8:10] != '= ': continue
+        value = card[10:].split('/')[0].strip()
+        try:
+            value = int(value)
+        except ValueError:
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        values[card[:8].strip()] = value
+    return values
+
+def _set_bitpix(header, bitpix):
+    return ''.join(('BITPIX  = %20d' % bitpix).ljust(80) if card[:8] == 'BITPIX  ' else card for card in _cards(header))
+
+def _remove_cards(header, keys):
+    """ Remove the cards with keywords in keys from a FITS header string
+        (keeping it a whole number of blocks):
+
+            >>> header = 'SIMPLE  =                    T'.ljust(80) + "CHECKSUM= 'abc'".ljust(80) + 'END'.ljust(80)
+            >>> header = header.ljust(_block)
+            >>> new = _remove_cards(header, ['CHECKSUM'])
+            >>> len(new), sorted(_header_values(new).keys())
+            (2880, ['SIMPLE'])
+    """
+    header = ''.join(card for card in _cards(header) if card[:8].strip() not in keys)
+    return header.ljust(len(header) + (-len(header) % _block))
+
+def merge_mapcubes(infiles, outfile, scales=None, verbosity=False):
+    """ Sum the mapcubes in infiles (multiplying each by the
+        corresponding value in scales) and save to outfile.
+
+        The mapcubes are read and summed one energy plane at a time
+        and the output is written as it is computed, so the memory
+        needed is only a few planes, no matter how many or how large
+        the mapcubes are. The inputs can be gzipped, and the output
+        is gzipped (as it is written) if outfile ends in '.gz'.
+
+        The output is written with the widest floating point type
+        of the inputs (or 32 bit floats, if they are all integers). The
+        extensions (e.g. the ENERGIES table) are copied from the first
+        mapcube, and the CHECKSUM and DATASUM cards (which no longer
+        describe the merged data) are removed from the primary header. """
+    if scales is None: scales = np.ones(len(infiles))
+    assert len(scales) == len(infiles)
+
+    inputs = [_open(i) for i in infiles]
+    headers = [_read_header(i) for i in inputs]
+    values = [_header_values(h) for h in headers]
+
+    first = values[0]
+    shape = [first['NAXIS%d' % i] for i in range(first['NAXIS'],0,-1)]
+    for infile,h,v in zip(infiles[1:], headers[1:], values[1:]):
+        assert shape == [v['NAXIS%d' % i] for i in range(v['NAXIS'],0,-1)], 'Mapcube %s has a different shape' % infile
+        if headers[0] != h:
+            print 'WARNING: HEADER FILES DISAGREE. PERFORMING MERGE ANYWAY'
+
+    for v in values:
+        if v.get('BSCALE',1) != 1 or v.get('BZERO',0) != 0:
+            raise Exception("Scaled mapcubes are not supported")
+
+    dtypes = [np.dtype(_dtypes[v['BITPIX']]) for v in values]
+    float_sizes = [d.itemsize for d in dtypes if d.kind == 'f']
+    out_dtype = np.dtype('>f%d' % max(float_sizes)) if len(float_sizes) > 0 else np.dtype('>f4')
+    header = _set_bitpix(headers[0], -8*out_dtype.itemsize)
+    header = _remove_cards(header, ['CHECKSUM', 'DATASUM'])
+
+    # a plane is one energy of the mapcube
+    nplanes = int(np.prod(shape[:-2]))
+    plane_size = shape[-2]*shape[-1]
+
+    temp = NamedTemporaryFile(dir=dirname(abspath(outfile)), prefix=basename(outfile), delete=False)
+    try:
+        out = gzip.GzipFile(fileobj=temp, mode='wb') if outfile.endswith('.gz') else temp
+
+        out.write(header)
+        for plane in range(nplanes):
+            if verbosity: print 'Merging plane %s/%s' % (plane+1,nplanes)
+            total = np.zeros(plane_size, dtype=float)
+            for f,dtype,scale in zip(inputs,dtypes,scales):
+                raw = f.read(plane_size*dtype.itemsize)
+                if len(raw) != plane_size*dtype.itemsize: raise Exception("Mapcube data is truncated")
+                data = np.fromstring(raw, dtype=dtype)
+                total += scale*data
+            out.write(total.astype(out_dtype).tostring())
+
+        # pad the data out to a full block
+        nbytes = nplanes*plane_size*out_dtype.itemsize
+        out.write('\0'*(-nbytes % _block))
+
+        # copy over the extensions of the first file
+        f = inputs[0]
+        f.read(-nplanes*plane_size*dtypes[0].itemsize % _block)
+        for chunk in iter(lambda: f.read(2**20), ''):
+            out.write(chunk)
+
+        out.close()
+        temp.close()
+
+        # NamedTemporaryFile is only readable by the user, so
+        # give the output the usual permissions of a new file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp.name, 0666 & ~umask)
+
+        os.rename(temp.name, outfile)
+    finally:
+        for i in inputs: i.close()
+        temp.close()
+        if exists(temp.name): os.remove(temp.name)
+
+def merge_diffuse(diffuse_sources, scaling_model=None, mergefile=None, verbosity=False, short_name=False , compress=False, scales=None):
+    """ merge diffuse files into one file.
+
+        scales is an optional list of factors to multiply
+        each of the diffuse sources by before merging. """
 
     for i in diffuse_sources:
         assert MCModelBuilder.isone(i.smodel)
@@ -34,33 +186,11 @@ def merge_diffuse(diffuse_sources, scaling_model=None, mergefile=None, verbosity
         else:
             mergefile = 'merged.fits.gz'
 
-    
-    if compress:
-        if mergefile.find(".gz")>0:
-            temp_file=mergefile.remove(".gz")
-        else:
-            temp_file=mergefile
-            mergefile=mergefile+".gz"
-    
-
-    pf = [pyfits.open(i) for i in filenames]
+    if compress and not mergefile.endswith('.gz'):
+        mergefile=mergefile+".gz"
 
-    first = pf.pop(0)
-    for i in pf:
-        assert first['PRIMARY'].data.shape == i['PRIMARY'].data.shape
-        if first['PRIMARY'].header != i['PRIMARY'].header:
-            print 'WARNING: HEADER FILES DISAGREE. PERFORMING MERGE ANYWAY'
-        first['PRIMARY'].data += i['PRIMARY'].data
+    merge_mapcubes(filenames, mergefile, scales=scales, verbosity=verbosity)
 
-    if not compress:
-        first.writeto(mergefile, clobber=True)
-    else:
-        first.writeto(temp_file, clobber=True)
-        
-        if os.path.exists(mergefile):
-                os.remove(mergefile)
-        check_call(['gzip', temp_file])
-        
     merged_dmodel=DiffuseFunction(mergefile)
 
     new_source = DiffuseSource(
@@ -69,3 +199,7 @@ def merge_diffuse(diffuse_sources, scaling_model=None, mergefile=None, verbosity
         diffuse_model=merged_dmodel)
     return new_source
 
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
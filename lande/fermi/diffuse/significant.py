@@ -43,8 +43,8 @@ def get_most_significant_diffuse(roi, allowed_fraction,max_n_models=1, verbosity
     
     significant_list = []
                 
+    oc=observed_counts(roi)
     for name in get_background(roi):
-        oc=observed_counts(roi)
         mc=model_counts(roi,name)
         fraction=float(mc)/oc
         if verbosity:
@@ -1 +1,61 @@
-pass
+""" Likelihood analysis of Fermi data with gtlike and pointlike.
+
+    Importing this package is cheap. The submodules (and the ScienceTools,
+    pointlike, and matplotlib which they depend upon) are only imported
+    the first time one of the objects below is used:
+
+        from lande.fermi.likelihood import LandeROI
+
+    The submodules themselves import pyLikelihood and pointlike in the
+    functions which need them. (myroi still imports uw.like.roi_analysis,
+    which LandeROI subclasses.) The import time of each module
+    can be benchmarked with
+
+        python -m lande.utilities.importtime lande.fermi.likelihood.myroi
+"""
+from lande.utilities.lazy import lazy_package
+
+lazy_package(__name__, dict(
+    LandeROI='myroi',
+    VerboseROI='myroi',
+    BaseFitter='basefit',
+    SuperState='superstate',
+    paranoid_gtlike_fit='fit',
+    race_gtlike_fit='fit',
+    FitCache='fit',
+    set_default_fit_cache='fit',
+    fit_prefactor='fit',
+    fit_only_source='fit',
+    source_dict='save',
+    spectrum_to_dict='save',
+    flux_dict='save',
+    logLikelihood='save',
+    get_sources='save',
+    get_background='save',
+    dict_to_spectrum='load',
+    dicts_to_spectra='load',
+    build_gtlike_spectrum='models',
+    build_pointlike_model='models',
+    build_gtlike_spectra='models',
+    build_pointlike_models='models',
+    gtlike_set_spectra='models',
+    summary='printing',
+    SpectrumPlotter='specplot',
+    SpectralAxes='specplot',
+    GtlikeUpperLimit='limits',
+    GtlikePowerLawUpperLimit='limits',
+    GtlikeCutoffUpperLimit='limits',
+    PointlikeUpperLimit='limits',
+    PointlikePowerLawUpperLimit='limits',
+    PointlikeCutoffUpperLimit='limits',
+    GtlikeProfileUpperLimits='limits',
+    PointlikeProfileUpperLimits='limits',
+    GtlikeCutoffTester='cutoff',
+    PointlikeCutoffTester='cutoff',
+    GtlikeHypothesisTester='cutoff',
+    PointlikeHypothesisTester='cutoff',
+    ExtensionProfile='extended',
+    MinuitLocalizer='localize',
+    Gtlike='roi_gtlike',
+    ModelMapEngine='gtlike_map',
+))
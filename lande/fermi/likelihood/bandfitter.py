@@ -19,7 +19,7 @@ from . limits import UpperLimit,GtlikePowerLawUpperLimit
 from . fit import paranoid_gtlike_fit
 from . superstate import SuperState
 from . specplot import SpectrumPlotter,SpectralAxes
-from . basefit import BaseFitter
+from . basefit import BaseFitter, instrumented
 from . printing import summary
 
 class BandFitter(BaseFitter):
@@ -132,6 +132,7 @@ class GtlikeBandFitter(BandFitter):
 
         self._calculate()
 
+    @instrumented
     def _calculate(self):
         """ Compute the flux data points for each energy. """
 
@@ -1,9 +1,88 @@
+import json
+import time
+from functools import wraps
+from os.path import expandvars
+
 import yaml
 
 from uw.utilities import keyword_options
 
 from lande.utilities.tools import tolist
 from lande.utilities.save import loaddict
+from lande.utilities.instrument import Instrument
+
+
+def _count_calls(fitter, instrument):
+    """ Count the fits, likelihood evaluations, and
+        ScienceTools run by a BaseFitter object. """
+    roi = getattr(fitter, 'roi', None)
+    if hasattr(roi, 'logLikelihood'):
+        instrument.count_calls(roi, 'fit', 'fits')
+        instrument.count_calls(roi, 'logLikelihood', 'likelihood_evaluations')
+
+    like = getattr(fitter, 'like', None)
+    if hasattr(like, 'logLike'):
+        instrument.count_calls(like, 'fit', 'fits')
+        instrument.count_calls(like.logLike, 'value', 'likelihood_evaluations')
+
+    try:
+        from GtApp import GtApp
+    except ImportError:
+        pass
+    else:
+        instrument.count_calls(GtApp, 'run', 'tool_invocations')
+
+
+def instrumented(func):
+    """ Decorator for the method of a BaseFitter which performs
+        the calculation. It records the wall time, cpu time, peak
+        memory (see lande.utilities.instrument), number of fits and likelihood evaluations (of self.roi
+        or self.like), and number of ScienceTools run while the method
+        is executing. The measurements are stored in self.instrumentation 
+        (and so are saved by todict), and if self.trace is set,
+        appended as a JSON line to the file self.trace. The strategy
+        of each paranoid_gtlike_fit of self.like during the method
+        is stored as fit_strategies.
+
+        N.B. For gtlike, only likelihood evaluations performed
+        from python (not from inside the optimizers) are counted.
+
+        When an instrumented method calls another one on the same
+        object (for example, an instrumented override calling the
+        instrumented method of its base class), only the outermost
+        call is measured, so nothing is counted twice. """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if getattr(self, '_instrumenting', False):
+            return func(self, *args, **kwargs)
+
+        like = getattr(self, 'like', None)
+        nstrategies = len(getattr(like, 'fit_strategies', []))
+
+        instrument = Instrument()
+        self._instrumenting = True
+        try:
+            with instrument:
+                _count_calls(self, instrument)
+                return func(self, *args, **kwargs)
+        finally:
+            self._instrumenting = False
+            measurements = instrument.results
+            strategies = getattr(like, 'fit_strategies', [])[nstrategies:]
+            if len(strategies) > 0: measurements['fit_strategies'] = strategies
+            if not hasattr(self, 'instrumentation'): self.instrumentation = dict()
+            self.instrumentation[func.__name__] = measurements
+
+            trace = getattr(self, 'trace', None)
+            if trace is not None:
+                line = dict(fitter=self.__class__.__name__, method=func.__name__,
+                            name=getattr(self, 'name', None), time=time.time())
+                line.update(measurements)
+                f = open(expandvars(trace), 'a')
+                f.write(json.dumps(line) + '\n')
+                f.close()
+    return wrapper
+
 
 class BaseFitter(object):
     """ BaseFitter is a base class for all of my
@@ -25,6 +104,7 @@ class BaseFitter(object):
 
     defaults = (
         ('verbosity', False, 'Make lots of noise'),
+        ('trace',      None, 'Append profiling measurements to this JSON-lines file.'),
     )
 
     @keyword_options.decorate(defaults)
@@ -41,7 +121,11 @@ class BaseFitter(object):
     def todict(self):
         """ Pacakge up the results of the SED fit into
             a nice dictionary. """
-        return tolist(self.results)
+        results = tolist(self.results)
+        instrumentation = getattr(self, 'instrumentation', None)
+        if instrumentation is not None and isinstance(results, dict):
+            results = dict(results, instrumentation=tolist(instrumentation))
+        return results
 
     def __str__(self):
         results = self.todict()
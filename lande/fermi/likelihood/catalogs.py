@@ -0,0 +1,55 @@
+""" Pointlike source catalogs which find the sources in an ROI
+    with a CatalogStore (see lande.fermi.data.catalogs) instead
+    of by computing the distance to every source in the catalog.
+
+    Usage:
+
+        catalog = StoreCatalog2FGL('$FERMI/catalogs/gll_psc_v05.fit',
+                                   latextdir='$FERMI/extended_archives/gll_psc_v05_templates')
+        roi = sa.roi(catalogs=catalog, ...)
+"""
+import numpy as np
+
+from uw.like.roi_catalogs import Catalog2FGL
+
+from lande.fermi.data.catalogs import get_catalog_store, unit_vectors
+
+
+class StoreCatalog2FGL(Catalog2FGL):
+    """ A Catalog2FGL which does its cone searches with the
+        (cached) CatalogStore for the catalog file.
+
+        Everything else (building the models and the extended
+        sources, choosing which sources are free) is still done
+        by Catalog2FGL, but only for the sources near the ROI. """
+
+    def __init__(self, catalog, *args, **kwargs):
+        Catalog2FGL.__init__(self, catalog, *args, **kwargs)
+
+        self.store = get_catalog_store(catalog)
+
+        # Match each source to the nearest row of the catalog
+        # by position, since extended sources are not named
+        # as in the catalog file.
+        ra = [source.skydir.ra() for source in self.sources]
+        dec = [source.skydir.dec() for source in self.sources]
+        chords, rows = self.store.tree.query(unit_vectors(ra, dec))
+
+        self.source_indices = dict()
+        for i,row in enumerate(rows):
+            self.source_indices.setdefault(row, []).append(i)
+
+        # Pad the cone searches by the largest distance from
+        # a source to its row so that no source can be missed.
+        self.pad = np.degrees(2*np.arcsin(np.max(chords)/2)) if len(chords) > 0 else 0
+
+    def get_sources(self, skydir, radius=15, *args, **kwargs):
+        rows = self.store.cone_indices(skydir.ra(), skydir.dec(), radius + self.pad + 1e-6)
+        indices = sorted(i for row in rows for i in self.source_indices.get(row, []))
+
+        all_sources = self.sources
+        self.sources = [all_sources[i] for i in indices]
+        try:
+            return Catalog2FGL.get_sources(self, skydir, radius, *args, **kwargs)
+        finally:
+            self.sources = all_sources
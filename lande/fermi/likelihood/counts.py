@@ -1,15 +1,75 @@
 import numpy as np
 
+from . tools import gtlike_or_pointlike
+from . save import pointlike_get_all_names, gtlike_get_all_names, gtlike_cache
+
+def pointlike_state_key(roi):
+    """ A hashable description of the current state of the
+        pointlike ROI: the energy range and binning of the bands
+        (which roi.change_binning modifies), and the spectral and
+        spatial parameters of all of the sources. """
+    key = [tuple((b.emin, b.emax, b.ct) for b in roi.bands)]
+    for source in roi.psm.point_sources:
+        key.append((source.name, source.skydir.ra(), source.skydir.dec(),
+                    tuple(source.model.get_all_parameters())))
+    for source in roi.dsm.diffuse_sources:
+        spatial_model = getattr(source, 'spatial_model', None)
+        spatial = tuple(np.asarray(spatial_model.p).ravel()) if spatial_model is not None else ()
+        key.append((source.name, tuple(source.smodel.get_all_parameters()), spatial))
+    return tuple(key)
+
+def _pointlike_band_counts(roi):
+    """ Everything pointlike_counts needs, plus the
+        total model counts (of all sources, including
+        the overlap of the sources with the ROI) in each band.
+        Cached on the roi until the state of the ROI changes. """
+    key = pointlike_state_key(roi)
+    cache = getattr(roi, '_counts_cache', None)
+    if cache is None or cache[0] != key:
+        names = pointlike_get_all_names(roi)
+        model_counts = np.asarray([np.append(b.ps_counts, b.bg_counts) for b in roi.bands], dtype=float)
+        observed_counts = np.asarray([np.sum(b.pix_counts) for b in roi.bands], dtype=float)
+        total_counts = np.asarray([b.bg_all_counts + b.ps_all_counts for b in roi.bands], dtype=float)
+        cache = roi._counts_cache = (key, (names, model_counts, observed_counts, total_counts))
+    return cache[1]
+
+def pointlike_counts(roi):
+    """ Compute in one pass over the bands
+
+            names, model_counts, observed_counts = pointlike_counts(roi)
+
+        where model_counts is a (band x source) matrix of the
+        model counts predicted by each source in names and
+        observed_counts is the number of counts in each band.
+
+        The counts are cached on the roi until any source
+        (or the binning of the ROI) changes.
+
+        Note: pix_counts is 0 when there are no counts in band.
+    """
+    return _pointlike_band_counts(roi)[:3]
+
+def gtlike_counts(like):
+    """ Same as pointlike_counts, but for a gtlike ROI. The
+        bands are the energy bins of the analysis. """
+    def counts():
+        names = gtlike_get_all_names(like)
+        model_counts = np.asarray([like._srcCnts(name) for name in names], dtype=float).T
+        observed_counts = np.asarray(like.nobs, dtype=float)
+        return names, model_counts, observed_counts
+    return gtlike_cache(like, ('counts',), counts)
+
+def counts(*args, **kwargs):
+    return gtlike_or_pointlike(gtlike_counts, pointlike_counts, *args, **kwargs)
+
 def pointlike_observed_counts(roi):
     """ Usage:
             observed_counts = pointlike_observed_counts(roi)
-
-        Note: pix_counts is 0 when there are no counts in band.
     """
-    observed_counts = sum(b.pix_counts if type(b.pix_counts)==float and b.pix_counts==0 else b.pix_counts.sum() 
-                          for b in roi.bands)
-    return observed_counts
+    return pointlike_counts(roi)[2].sum()
 
+def gtlike_observed_counts(like):
+    return gtlike_counts(like)[2].sum()
 
 def pointlike_model_counts(roi,which):
     """ Usage:
@@ -17,20 +77,27 @@ def pointlike_model_counts(roi,which):
     """
     manager,index=roi.mapper(which)
     assert manager in [roi.psm,roi.dsm]
-    if manager == roi.psm:
-        model_counts=sum(b.ps_counts[index] for b in roi.bands)
-    elif manager == roi.dsm:
-        model_counts=sum(b.bg_counts[index] for b in roi.bands)
-    return model_counts
+    if manager == roi.dsm:
+        index += len(roi.psm.point_sources)
+    return pointlike_counts(roi)[1][:,index].sum()
+
+def gtlike_model_counts(like,name):
+    names, model_counts, observed_counts = gtlike_counts(like)
+    return model_counts[:,list(names).index(name)].sum()
 
 def pointlike_total_model_counts(roi):
-    model_counts=sum(b.bg_all_counts+b.ps_all_counts for b in roi.bands)
-    return model_counts
+    """ N.B. This is the sum of bg_all_counts+ps_all_counts, which
+        (unlike the sum of model_counts) includes all sources. """
+    return _pointlike_band_counts(roi)[3].sum()
+
+def gtlike_total_model_counts(like):
+    return gtlike_counts(like)[1].sum()
 
+def observed_counts(*args, **kwargs):
+    return gtlike_or_pointlike(gtlike_observed_counts, pointlike_observed_counts, *args, **kwargs)
 
+def model_counts(*args, **kwargs):
+    return gtlike_or_pointlike(gtlike_model_counts, pointlike_model_counts, *args, **kwargs)
 
-# Kluge for now
-# TODO, write gtlike equivalent code
-observed_counts=pointlike_observed_counts
-model_counts=pointlike_model_counts
-total_model_counts=pointlike_total_model_counts
+def total_model_counts(*args, **kwargs):
+    return gtlike_or_pointlike(gtlike_total_model_counts, pointlike_total_model_counts, *args, **kwargs)
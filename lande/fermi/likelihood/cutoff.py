@@ -7,10 +7,11 @@ import pylab as P
 import numpy as np
 
 from uw.utilities import keyword_options
-from uw.like.Models import Model,PowerLaw,PLSuperExpCutoff
+from uw.like.Models import Model,PowerLaw,PLSuperExpCutoff,LogParabola,BrokenPowerLaw
 from uw.like.roi_state import PointlikeState
 
 from lande.utilities.tools import tolist
+from lande.utilities.parallel import fork_map, WorkerException
 
 from lande.pysed import units
 from lande.fermi.spectra.sed import SED
@@ -19,10 +20,10 @@ from . superstate import SuperState
 
 from . tools import gtlike_or_pointlike
 from . save import get_full_energy_range, spectrum_to_dict, energy_dict, source_dict
-from . fit import paranoid_gtlike_fit
+from . fit import paranoid_gtlike_fit, pointlike_fit
 from . printing import summary
 from . models import build_gtlike_spectrum
-from . basefit import BaseFitter
+from . basefit import BaseFitter, instrumented
 from . specplot import SpectrumPlotter,SpectralAxes
 
 class CutoffTester(BaseFitter):
@@ -101,6 +102,7 @@ class PointlikeCutoffTester(CutoffTester):
         self.name = name
         self._calculate()
 
+    @instrumented
     def _calculate(self):
         roi = self.roi
         name = self.name
@@ -126,7 +128,7 @@ class PointlikeCutoffTester(CutoffTester):
 
             roi.modify(which=name, model=powerlaw_model, keep_old_flux=False)
 
-        fit = lambda: roi.fit(**self.fit_kwargs)
+        fit = lambda: pointlike_fit(roi, **self.fit_kwargs)
         def ts():
             old_quiet = roi.quiet; roi.quiet=True
             ts = roi.TS(name,quick=False)
@@ -222,6 +224,7 @@ class GtlikeCutoffTester(CutoffTester):
         self.name = name
         self._calculate()
 
+    @instrumented
     def _calculate(self):
         like = self.like
         name = self.name
@@ -340,6 +343,158 @@ class GtlikeCutoffTester(CutoffTester):
             saved_state.restore()
 
 
+
+class HypothesisTester(BaseFitter):
+    """ Fit several spectral hypotheses for a source at
+        the same time and compute the TS of each hypothesis
+        against the null hypothesis (the first one):
+
+            h = PointlikeHypothesisTester(roi, name)
+            print h.results['TS']['PLSuperExpCutoff']
+
+        Each hypothesis is fit in a forked copy of the ROI, so
+        the hypotheses are fit in parallel and the input ROI is never modified.
+        Set processes=1 (or parallel=False) to fit them one at a time.
+
+        The results contain, for each hypothesis, a source_dict of 
+        the fit and TS=2*(logLikelihood - logLikelihood of the null hypothesis).
+    """
+
+    defaults = CutoffTester.defaults + (
+        ('hypotheses', None, """ List of (name, pointlike model) pairs. The first is the null hypothesis.
+                                 The spectral models are started at the flux of the source.
+                                 Default is PowerLaw, PLSuperExpCutoff, LogParabola, BrokenPowerLaw."""),
+        ('parallel', True, 'Fit the hypotheses in parallel'),
+        ('processes', None, 'Maximum number of hypotheses to fit at once. Default is number of CPUs'),
+    )
+
+    @staticmethod
+    def default_hypotheses():
+        cutoff=PLSuperExpCutoff(norm=1e-9, index=1, cutoff=1000, e0=1000, b=1)
+        cutoff.set_free('b', False)
+        return [
+            ('PowerLaw', PowerLaw(norm=1e-11, index=2)),
+            ('PLSuperExpCutoff', cutoff),
+            ('LogParabola', LogParabola()),
+            ('BrokenPowerLaw', BrokenPowerLaw()),
+        ]
+
+    @instrumented
+    def _calculate(self):
+        emin,emax=get_full_energy_range(self.like_or_roi)
+
+        if self.hypotheses is None: 
+            self.hypotheses = self.default_hypotheses()
+
+        names = [name for name,model in self.hypotheses]
+
+        old_flux = self._get_flux(emin, emax)
+
+        def fit(hypothesis):
+            name, model = hypothesis
+            model = model.copy()
+            model.set_flux(old_flux,emin=emin,emax=emax)
+            if self.verbosity: print 'Fitting hypothesis %s: %s' % (name, model)
+            return self._fit(model, emin, emax)
+
+        if self.parallel:
+            fits = fork_map(fit, self.hypotheses, processes=self.processes, raise_exceptions=False)
+        else:
+            fits = []
+            for hypothesis in self.hypotheses:
+                try:
+                    fits.append(fit(hypothesis))
+                except Exception, ex:
+                    print 'ERROR fitting hypothesis %s: ' % hypothesis[0], ex
+                    traceback.print_exc(file=sys.stdout)
+                    fits.append(WorkerException(str(ex)))
+
+        self.results = d = dict(
+            energy = energy_dict(emin=emin, emax=emax, energy_units=self.energy_units),
+            null_hypothesis = names[0],
+            hypotheses = dict(),
+            TS = dict(),
+        )
+
+        for name,f in zip(names,fits):
+            d['hypotheses'][name] = None if isinstance(f,WorkerException) else f
+
+        null = d['hypotheses'][names[0]]
+        for name in names:
+            h = d['hypotheses'][name]
+            if null is None or h is None:
+                d['TS'][name] = np.nan
+            else:
+                d['TS'][name] = 2*(h['logLikelihood'] - null['logLikelihood'])
+
+        if self.verbosity:
+            for name in names:
+                print 'TS for hypothesis %s = %s' % (name, d['TS'][name])
+
+
+class PointlikeHypothesisTester(HypothesisTester):
+
+    defaults = HypothesisTester.defaults + (
+        ('fit_kwargs',dict(),'kwargs to pass into roi.fit()'),
+    )
+
+    @keyword_options.decorate(defaults)
+    def __init__(self, roi, name, *args, **kwargs):
+        keyword_options.process(self, kwargs)
+
+        self.roi = self.like_or_roi = roi
+        self.name = name
+        self._calculate()
+
+    def _get_flux(self, emin, emax):
+        return self.roi.get_model(self.name).i_flux(emin,emax)
+
+    def _fit(self, model, emin, emax):
+        roi = self.roi
+        name = self.name
+
+        saved_state = PointlikeState(roi)
+        try:
+            roi.modify(which=name, model=model, keep_old_flux=False)
+            pointlike_fit(roi, **self.fit_kwargs)
+            return source_dict(roi, name, emin=emin, emax=emax,
+                               flux_units=self.flux_units,
+                               energy_units=self.energy_units,
+                               verbosity=self.verbosity)
+        finally:
+            saved_state.restore()
+
+
+class GtlikeHypothesisTester(HypothesisTester):
+
+    @keyword_options.decorate(HypothesisTester.defaults)
+    def __init__(self, like, name, *args, **kwargs):
+        keyword_options.process(self, kwargs)
+
+        self.like = self.like_or_roi = like
+        self.name = name
+        self._calculate()
+
+    def _get_flux(self, emin, emax):
+        return self.like.flux(self.name, emin, emax)
+
+    def _fit(self, model, emin, emax):
+        like = self.like
+        name = self.name
+
+        saved_state = SuperState(like)
+        try:
+            model.set_default_limits(oomp_limits=True)
+            like.setSpectrum(name,build_gtlike_spectrum(model))
+            paranoid_gtlike_fit(like, verbosity=self.verbosity)
+            return source_dict(like, name, emin=emin, emax=emax,
+                               flux_units=self.flux_units,
+                               energy_units=self.energy_units,
+                               verbosity=self.verbosity)
+        finally:
+            saved_state.restore()
+
+
 def fix_bad_cutoffs(roi, exclude_names):
     """ Loop over all sources. When ExpCutoff souce has cutoff>10TeV, convert to powerlaw. """
     any_changed=False
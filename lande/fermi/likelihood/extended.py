@@ -19,6 +19,9 @@ from uw.utilities import keyword_options
 from lande.utilities.tools import tolist
 from lande.utilities.fits import expand_fits_header
 
+from . basefit import instrumented
+from . fit import pointlike_fit
+
 import pylab as P
 
 
@@ -31,6 +34,7 @@ class ExtensionProfile(object):
         ("use_gradient",  None, "use analytic gradient during spectral fit. Default is taken from roi.fit()."),
         ("fignum",        None, "passed to matplotlib."),
         ("figsize",      (4,4), "size of plot, in inches."),
+        ("trace",         None, "Append profiling measurements to this JSON-lines file."),
     )
 
     @keyword_options.decorate(defaults)
@@ -60,6 +64,7 @@ class ExtensionProfile(object):
 
         self.fill()
 
+    @instrumented
     def fill(self):
 
         roi = self.roi
@@ -93,13 +98,13 @@ class ExtensionProfile(object):
         for i,sigma in enumerate(self.extension_list):
             roi.modify(which=self.which, sigma=sigma)
 
-            roi.fit(**self.fit_kwargs)
+            pointlike_fit(roi, **self.fit_kwargs)
 
             params=roi.parameters()
             ll_a=-1*roi.logLikelihood(roi.parameters())
 
             roi.update_counts(init_p)
-            roi.fit(**self.fit_kwargs)
+            pointlike_fit(roi, **self.fit_kwargs)
             ll_b=-1*roi.logLikelihood(roi.parameters())
             if ll_a > ll_b: roi.update_counts(params)
 
@@ -115,6 +120,7 @@ class ExtensionProfile(object):
         d=dict(sigma=self.extension_list,
                TS_spectral=self.TS_spectral,
                TS_bandfits=self.TS_bandfits)
+        if hasattr(self, 'instrumentation'): d['instrumentation'] = self.instrumentation
 
         return tolist(d)
 
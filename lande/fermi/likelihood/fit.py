@@ -2,35 +2,287 @@
 """ This file contains various function which I have found useful. """
 import traceback
 import sys
+import os
+import time
+import hashlib
+import cPickle
+from os.path import expandvars, exists, join, getmtime, getsize
+from tempfile import NamedTemporaryFile
 
 import numpy as np
 
 from uw.like.Models import PowerLaw
 
 from lande.utilities.tools import tolist
+from lande.utilities.parallel import fork_race, WorkerException
 
 from . superstate import SuperState
-from . save import logLikelihood
+from . save import logLikelihood, gtlike_source_model_key, pointlike_get_all_names
+from . counts import pointlike_state_key
 from . tools import gtlike_or_pointlike
 from . printing import summary
-from . modify import modify
+from . modify import modify, pointlike_modify_many
 
 class FitterException(Exception): pass
 
 
-def paranoid_gtlike_fit(like, covar=True, niter=1, verbosity=False):
+# The chain of optimizers tried by paranoid_gtlike_fit. Each strategy
+# is a list of (optimizer, compute covariance) steps.
+gtlike_fit_strategies = [
+    ('MINUIT', [('MINUIT', True)]),
+    ('DRMNFB+NEWMINUIT', [('DRMNFB', False), ('NEWMINUIT', True)]),
+    ('LBFGS', [('LBFGS', False)]),
+]
+
+
+def gtlike_fit_results(like):
+    """ The (picklable) results of a fit: the parameter
+        values and errors, covariance matrix, and likelihood. """
+    return dict(
+        parameters=[(p.getValue(), p.error()) for p in like.params()],
+        covariance=like.covariance,
+        logLikelihood=logLikelihood(like))
+
+
+def gtlike_load_fit_results(like, results):
+    """ Load into like results created by gtlike_fit_results. """
+    for p,(value,error) in zip(like.params(), results['parameters']):
+        p.setValue(value)
+        p.setError(error)
+    like.syncSrcParams()
+    like.covariance = results['covariance']
+
+
+def pointlike_fit_results(roi):
+    """ The (picklable) results of a pointlike fit: the spectral
+        models (with their errors) of all sources with free parameters,
+        and the likelihood. """
+    models = dict((name, roi.get_model(name).copy()) for name in pointlike_get_all_names(roi) \
+                  if np.any(roi.get_model(name).free))
+    return dict(models=models, logl=roi.logl)
+
+
+def pointlike_load_fit_results(roi, results):
+    """ Load into roi results created by pointlike_fit_results. """
+    pointlike_modify_many(roi, models=results['models'])
+    roi.prev_logl, roi.logl = roi.logl, results['logl']
+
+
+class FitCache(object):
+    """ A persistent, on-disk cache of gtlike and pointlike fit results.
+
+        The key of each fit is a hash of the data files (name, size and
+        modification time), the model of every source (spectral and
+        spatial model types, positions and spatial parameters), the value,
+        scale, bounds, and free state of all parameters, and the fit settings.
+        For pointlike, the model is described by pointlike_state_key (which
+        includes the binning of the ROI) and the free state of all parameters.
+        If like (or roi) is in a state which has been fit before, the stored
+        best fit parameters, errors, and covariance matrix are loaded directly
+        instead of refitting.
+
+        Usage:
+
+            cache = FitCache('$cachedir/fits')
+            paranoid_gtlike_fit(like, cache=cache)
+            pointlike_fit(roi, cache=cache)
+            print cache
+
+        Or, to cache all calls to paranoid_gtlike_fit and pointlike_fit
+        (including the ones in CutoffTester, ExtensionProfile, the upper
+        limit code, the pipelines, ...):
+
+            set_default_fit_cache(FitCache('$cachedir/fits'))
+
+        Each fit is saved to its own file, so jobs can safely share one cachedir.
+    """
+    def __init__(self, cachedir):
+        self.cachedir = expandvars(cachedir)
+        if not exists(self.cachedir): os.makedirs(self.cachedir)
+
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0
+
+    @staticmethod
+    def _file_key(v):
+        if isinstance(v, basestring) and exists(v):
+            return (v, getsize(v), getmtime(v))
+        if isinstance(v, (list, tuple)):
+            return tuple(FitCache._file_key(i) for i in v)
+        return v
+
+    @staticmethod
+    def _data_key(like):
+        data = getattr(like, 'binnedData', None) or getattr(like, 'observation', None)
+        return [(k, FitCache._file_key(getattr(data, k, None))) \
+                for k in ['srcMaps', 'expCube', 'binnedExpMap', 'eventFile', 'scFile', 'expMap', 'irfs']]
+
+    @staticmethod
+    def _model_key(like):
+        key = [gtlike_source_model_key(like, name) for name in like.sourceNames()]
+        for p in like.params():
+            key.append((p.getName(), p.getValue(), p.getScale(), p.getBounds(), p.isFree()))
+        return key
+
+    @staticmethod
+    def _pointlike_data_key(roi):
+        pixeldata = roi.sa.pixeldata
+        key = [(k, FitCache._file_key(getattr(pixeldata, k, None))) \
+               for k in ['ft1files', 'ft2files', 'ltcube', 'binfile']]
+        key.append(('irf', roi.sa.irf))
+        key.append(('roi_dir', roi.roi_dir.ra(), roi.roi_dir.dec()))
+        return key
+
+    @staticmethod
+    def _pointlike_model_key(roi):
+        free = [tuple(roi.get_model(name).free) for name in pointlike_get_all_names(roi)]
+        return (pointlike_state_key(roi), free)
+
+    def key(self, like, settings):
+        """ A hash of the state of like and the fit settings. """
+        key = (FitCache._data_key(like), FitCache._model_key(like), sorted(settings.items()))
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def pointlike_key(self, roi, settings):
+        """ A hash of the state of roi and the fit settings. """
+        key = (FitCache._pointlike_data_key(roi), FitCache._pointlike_model_key(roi), sorted(settings.items()))
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def _filename(self, key):
+        return join(self.cachedir, '%s.pickle' % key)
+
+    def get(self, key):
+        filename = self._filename(key)
+        if not exists(filename): return None
+        try:
+            return cPickle.load(open(filename,'rb'))
+        except Exception, ex:
+            print 'ERROR reading cached fit %s:' % filename, ex
+            return None
+
+    def put(self, key, results):
+        # write to a temporary file and rename so that other
+        # jobs never see a partially written file.
+        temp = NamedTemporaryFile(dir=self.cachedir, delete=False)
+        cPickle.dump(results, temp, cPickle.HIGHEST_PROTOCOL)
+        temp.close()
+        os.rename(temp.name, self._filename(key))
+
+    def _cached_fit(self, key, fit, fit_results, load_fit_results, verbosity):
+        """ Perform fit() unless it has been cached with key. fit_results(ret)
+            returns the results to cache (or None if the fit failed). """
+        results = self.get(key)
+
+        if results is not None:
+            if verbosity: print 'Loading cached fit %s' % key
+            load_fit_results(results)
+            self.hits += 1
+            self.time_saved += results['time']
+            return results['return']
+
+        start = time.time()
+        ret = fit()
+        self.misses += 1
+
+        results = fit_results(ret)
+        if results is not None:
+            results['return'] = ret
+            results['time'] = time.time() - start
+            self.put(key, results)
+        return ret
+
+    def gtlike_fit(self, like, fit, settings, verbosity=False):
+        """ Perform the fit fit() on like unless the same fit
+            has been cached. Return the value returned by fit(). """
+        return self._cached_fit(self.key(like, settings), fit,
+                                fit_results=lambda ret: gtlike_fit_results(like) if ret is not None else None,
+                                load_fit_results=lambda results: gtlike_load_fit_results(like, results),
+                                verbosity=verbosity)
+
+    def pointlike_fit(self, roi, fit, settings, verbosity=False):
+        """ Same as gtlike_fit, but for a pointlike ROI. A pointlike
+            fit which fails raises an exception, so is never cached. """
+        return self._cached_fit(self.pointlike_key(roi, settings), fit,
+                                fit_results=lambda ret: pointlike_fit_results(roi),
+                                load_fit_results=lambda results: pointlike_load_fit_results(roi, results),
+                                verbosity=verbosity)
+
+    def statistics(self):
+        return dict(hits=self.hits, misses=self.misses, time_saved=self.time_saved)
+
+    def __str__(self):
+        return 'FitCache %s: avoided %d of %d fits (saved %.1f seconds)' % \
+                (self.cachedir, self.hits, self.hits+self.misses, self.time_saved)
+
+
+_default_fit_cache = None
+
+def set_default_fit_cache(cache):
+    """ Set the FitCache used by paranoid_gtlike_fit and pointlike_fit (None to disable). """
+    global _default_fit_cache
+    _default_fit_cache = cache
+
+
+def pointlike_fit(roi, cache=None, verbosity=False, **kwargs):
+    """ Fit roi with roi.fit(**kwargs), unless the same
+        fit has been cached.
+
+        cache is a FitCache. By default, the cache set by set_default_fit_cache is used.
+        Set cache=False to always refit. """
+    if cache is None: cache = _default_fit_cache
+    if not cache:
+        return roi.fit(**kwargs)
+    return cache.pointlike_fit(roi, lambda: roi.fit(**kwargs),
+                               settings=dict(method='fit', **kwargs),
+                               verbosity=verbosity)
+
+
+def paranoid_gtlike_fit(like, covar=True, niter=1, verbosity=False, race=False, cache=None):
     """ Perform a sepctral fit in gtlike in
         a paranoid manner. 
         
         See here for description of method:
             http://fermi.gsfc.nasa.gov/ssc/data/analysis/documentation/Cicerone/Cicerone_Likelihood/Fitting_Models.html
+
+        If race=True, all strategies are run at the same time
+        (see race_gtlike_fit) instead of one after the other.
+
+        cache is a FitCache. By default, the cache set by set_default_fit_cache is used.
+        Set cache=False to always refit.
+
+        Returns the name of the strategy in gtlike_fit_strategies
+        which succeeded (or None if they all failed). The strategy is
+        also saved as like.fit_strategy and appended to the list
+        like.fit_strategies, so that the instrumented BaseFitter 
+        methods can save the strategies of their fits with their results.
     """
+    strategy = _paranoid_gtlike_fit(like, covar, niter, verbosity, race, cache)
+
+    like.fit_strategy = strategy
+    if not hasattr(like, 'fit_strategies'): like.fit_strategies = []
+    like.fit_strategies.append(strategy)
+    if verbosity: print 'Fit strategy used: %s' % strategy
+
+    return strategy
+
+def _paranoid_gtlike_fit(like, covar, niter, verbosity, race, cache):
+    if cache is None: cache = _default_fit_cache
+    if cache:
+        fit = lambda: _paranoid_gtlike_fit(like, covar, niter=niter, verbosity=verbosity, race=race, cache=False)
+        return cache.gtlike_fit(like, fit, 
+                                settings=dict(method='paranoid', covar=covar, niter=niter, race=race),
+                                verbosity=verbosity)
+
     if niter > 1:
         if verbosity: print 'Fitting %s times' % niter
         for i in range(niter):
             if verbosity: print "Fitting iteration %s" % i
-            paranoid_gtlike_fit(like, covar, niter=1, verbosity=verbosity)
-        return
+            strategy = _paranoid_gtlike_fit(like, covar, niter=1, verbosity=verbosity, race=race, cache=False)
+        return strategy
+
+    if race:
+        return race_gtlike_fit(like, covar=covar, verbosity=verbosity)
 
     optverbosity = max(verbosity-1, 0) # see IntegralUpperLimit.py
 
@@ -42,6 +294,7 @@ def paranoid_gtlike_fit(like, covar=True, niter=1, verbosity=False):
         final_likelihood = logLikelihood(like)
         if init_likelihood - final_likelihood > 10:
             raise FitterException("Error, the final likelihood=%.1d is much worse than the initial likelihood=%.1d (dLL=%.1d)." % (final_likelihood,init_likelihood,final_likelihood-init_likelihood))
+        return 'MINUIT'
 
     except Exception, ex:
         if verbosity: 
@@ -61,6 +314,7 @@ def paranoid_gtlike_fit(like, covar=True, niter=1, verbosity=False):
             final_likelihood = logLikelihood(like)
             if init_likelihood - final_likelihood > 10:
                 raise FitterException("Error, the final likelihood=%.1d is much worse than the initial likelihood=%.1d (dLL=%.1d)." % (final_likelihood,init_likelihood,final_likelihood-init_likelihood))
+            return 'DRMNFB+NEWMINUIT'
 
         except Exception, ex:
             traceback.print_exc(file=sys.stdout)
@@ -74,12 +328,60 @@ def paranoid_gtlike_fit(like, covar=True, niter=1, verbosity=False):
                 saved_state = SuperState(like)
                 if verbosity: print 'Restting the ROI and Refitting with LBFGS'
                 like.fit(optverbosity, optimizer='LBFGS', covar=False)
+                return 'LBFGS'
             except Exception, ex:
                 print 'ERROR spectral fitting with LBFGS', ex
                 traceback.print_exc(file=sys.stdout)
                 saved_state.restore()
 
 
+def _gtlike_fit_strategy(like, steps, covar, optverbosity):
+    """ Run one of the gtlike_fit_strategies on like and
+        return (in a picklable form) the fit results. """
+    init_likelihood = logLikelihood(like)
+    for optimizer, strategy_covar in steps:
+        like.fit(optverbosity, optimizer=optimizer, covar=covar and strategy_covar)
+    final_likelihood = logLikelihood(like)
+    if init_likelihood - final_likelihood > 10:
+        raise FitterException("Error, the final likelihood=%.1d is much worse than the initial likelihood=%.1d (dLL=%.1d)." % (final_likelihood,init_likelihood,final_likelihood-init_likelihood))
+
+    return gtlike_fit_results(like)
+
+
+def race_gtlike_fit(like, covar=True, verbosity=False, strategies=None):
+    """ Fit like by racing all of the gtlike_fit_strategies against each other.
+
+        Each strategy is run in a forked worker starting from the current
+        state of like. The first strategy to converge and pass the
+        same likelihood check as paranoid_gtlike_fit wins, the other workers
+        are killed, and the best fit parameters (and covariance matrix) of
+        the winning strategy are loaded back into like.
+
+        Returns the name of the winning strategy (or None if they all failed,
+        in which case like is left unchanged).
+    """
+    if strategies is None: strategies = gtlike_fit_strategies
+
+    optverbosity = max(verbosity-1, 0)
+
+    if verbosity: print 'Racing fit strategies %s' % ', '.join(name for name,steps in strategies)
+
+    funcs = [lambda steps=steps: _gtlike_fit_strategy(like, steps, covar, optverbosity) \
+             for name,steps in strategies]
+    try:
+        index, results = fork_race(funcs)
+    except WorkerException, ex:
+        print 'ERROR spectral fitting with all strategies:', ex
+        return None
+
+    name = strategies[index][0]
+    if verbosity: print 'Strategy %s won the race (logLikelihood=%s)' % (name, results['logLikelihood'])
+
+    gtlike_load_fit_results(like, results)
+
+    return name
+
+
 def gtlike_allow_fit_only_prefactor(like, name):
     """ Freeze everything but norm of source with name
         in pyLikelihood object. """
@@ -100,26 +402,30 @@ def pointlike_fit_only_source(roi, which, fit_only_prefactor=False, **kwargs):
         without varying any other parmters.
         
         Can help if one source has a very bad 
-        starting value. """
-    source = roi.get_source(which)
-    model = roi.get_model(which)
-    name = source.name
+        starting value. 
+        
+        which can also be a list of sources,
+        in which case they are fit jointly. """
+    if not isinstance(which, list): which = [which]
+    names = [roi.get_source(w).name for w in which]
 
     frozen_sources = dict()
     for other_source in roi.psm.point_sources.tolist() + roi.dsm.diffuse_sources.tolist():
         other_model = roi.get_model(other_source)
-        if np.any(other_model.free) and other_source.name != name:
+        if np.any(other_model.free) and other_source.name not in names:
             frozen_sources[other_source.name]=other_model.free.copy()
             roi.modify(which=other_source,free=False)
 
     if fit_only_prefactor:
-        old_free = roi.get_model(which).free.copy()
-        allow_fit_only_prefactor(roi, which)
+        old_free = dict((name,roi.get_model(name).free.copy()) for name in names)
+        for name in names:
+            allow_fit_only_prefactor(roi, name)
 
-    roi.fit(**kwargs)
+    pointlike_fit(roi, **kwargs)
 
     if fit_only_prefactor:
-        roi.modify(which=which, free=old_free)
+        for name,free in old_free.items():
+            roi.modify(which=name, free=free)
 
     for other_name,other_free in frozen_sources.items():
         roi.modify(which=other_name,free=other_free)
@@ -133,10 +439,32 @@ def allow_fit_only_prefactor(*args, **kwargs):
 
 
 
+def _freeze_to_catalog(roi, catalog, names, why):
+    """ Replace the spectra of the sources in names with the catalog 
+        predictions, allowing only the prefactor to vary. 
+        All of the sources are modified at once. Returns
+        True if any source was modified. """
+    models, free = dict(), dict()
+    for name in names:
+        try:
+            catalog_source = catalog.get_source(name)
+        except StopIteration:
+            pass
+        else:
+            print 'Freezing spectra of %s to 2FGL prediction b/c %s' % (name, why)
+            models[name] = catalog_source.model
+            free[name] = np.arange(len(catalog_source.model.free)) == 0
+
+    pointlike_modify_many(roi, models=models, free=free)
+    return len(models) > 0
+
 def freeze_insignificant_to_catalog(roi,catalog,exclude_names=[], min_ts=25):
     """ Replace all insigificant 2FGL catalog sources
         with the predictions of 2FGL and 
-        the spectral shape of the source frozen. """
+        the spectral shape of the source frozen. 
+        
+        N.B. Each source is frozen as soon as it is found to be insignificant,
+        so the TS of the later sources is computed with the earlier ones frozen. """
     any_changed=False
     for source in roi.get_sources():
         name = source.name
@@ -146,14 +474,7 @@ def freeze_insignificant_to_catalog(roi,catalog,exclude_names=[], min_ts=25):
         # Note only check sources with MORE than their
         # prefactor frozen!
         if np.any(source.model.free[1:]) and roi.TS(which=source)< min_ts:
-            try:
-                catalog_source = catalog.get_source(name)
-            except StopIteration:
-                pass
-            else:
-                print 'Freezing spectra of %s to 2FGL prediction b/c it is insignificant' % name
-                roi.modify(which=name, model=catalog_source.model, keep_old_flux=False)
-                allow_fit_only_prefactor(roi, name)
+            if _freeze_to_catalog(roi, catalog, [name], 'it is insignificant'):
                 any_changed=True
     return any_changed
 
@@ -162,7 +483,7 @@ def freeze_bad_index_to_catalog(roi,catalog,exclude_names=[], min_ts=25):
         index to the predictions from the catalog
         with the predictions of 2FGL and 
         the spectral shape of the source frozen. """
-    any_changed=False
+    names = []
     for source in roi.get_sources():
         name = source.name
 
@@ -171,16 +492,8 @@ def freeze_bad_index_to_catalog(roi,catalog,exclude_names=[], min_ts=25):
         if isinstance(source.model,PowerLaw):
             index =source.model['index']
             if index < -5 or index > 5:
-                try:
-                    catalog_source = catalog.get_source(name)
-                except StopIteration:
-                    pass
-                else:
-                    print 'Freezing spectra of %s to 2FGL prediction b/c fit index is bad' % name
-                    roi.modify(which=name, model = catalog_source.model, keep_old_flux=False)
-                    allow_fit_only_prefactor(roi, name)
-                    any_changed=True
-    return any_changed
+                names.append(name)
+    return _freeze_to_catalog(roi, catalog, names, 'fit index is bad')
 
 
 def gtlike_setp(like, name, parname, value, scale, lower, upper, free):
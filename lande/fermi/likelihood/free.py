@@ -1,28 +1,28 @@
-import copy
 import numpy as np
 
+from lande.utilities.math import angular_separation
+
+from . modify import pointlike_modify_many
+
+def source_separations(sources, skydir):
+    """ Distance (in degrees) from each source to a skydir. """
+    ra = [source.skydir.ra() for source in sources]
+    dec = [source.skydir.dec() for source in sources]
+    return angular_separation(ra, dec, skydir.ra(), skydir.dec())
+
 def sort_sources(sources, skydir):
     """ Sort soruces based upon distance from a skydir. """
-    sources = copy.copy(sources)
-    sources.sort(key=lambda src:src.skydir.difference(skydir))
-    return sources
+    separations = source_separations(sources, skydir)
+    return [sources[i] for i in np.argsort(separations, kind='mergesort')]
 
 def freeze_far_away(roi, skydir, max_free):
     """ Freeze sources far away from the ROI. keep at most max_free sources free. """
-    frozen = dict()
-
-    sources=roi.get_sources()
-    sorted = sort_sources(sources, skydir)
+    sorted = sort_sources(roi.get_sources(), skydir)
+    free_sources = [source for source in sorted if np.any(source.model.free==True)]
 
-    i=0
-    for source in sorted:
-        if np.any(source.model.free==True):
-            i+=1
-            if i > max_free:
-                frozen[source.name]=source.model.free.copy()
-                roi.modify(which=source, free=False)
+    frozen = dict((source.name,source.model.free.copy()) for source in free_sources[max_free:])
+    pointlike_modify_many(roi, free=dict((name,False) for name in frozen))
     return frozen
 
 def unfreeze_far_away(roi, frozen):
-    for name,free in frozen.items():
-        roi.modify(which=name, free=free)
+    pointlike_modify_many(roi, free=frozen)
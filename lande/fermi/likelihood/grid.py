@@ -5,7 +5,7 @@ from uw.utilities import keyword_options
 from uw.utilities.parmap import LimitMapper
 from uw.like.roi_state import PointlikeState
 
-from . basefit import BaseFitter
+from . basefit import BaseFitter, instrumented
 from . save import source_dict
 
 
@@ -31,6 +31,7 @@ class SpectralFitLimited(BaseFitter):
 
         self._calculate()
 
+    @instrumented
     def _calculate(self):
 
         self.results=dict()
@@ -103,6 +104,7 @@ class SpectralGrid(BaseFitter):
 
         self._calculate()
 
+    @instrumented
     def _calculate(self):
 
         roi = self.roi
@@ -1,6 +1,12 @@
 """ This is mostly Romain's code. """
 import os
+import shutil
+import tempfile
 import readXml
+
+import numpy as np
+import pyfits
+import pyLikelihood
 # pointlike
 from skymaps import SkyDir
 from uw.utilities import keyword_options
@@ -8,7 +14,6 @@ from uw.utilities import keyword_options
 # pylikelihood
 from GtApp import GtApp
 
-from datetime import date
 
 IRF="P7SOURCE_V6"
 
@@ -50,37 +55,40 @@ def modelmap(like,ft2,cmap,outfile):
     expcube=like.binnedData.expCube
     bexpmap=like.binnedData.binnedExpMap
 
-    like.srcModel = "srcmodel_%s.xml"%date.today()
-    like.writeXml()
-    srcModel = readXml.SourceModel("srcmodel_%s.xml"%date.today())
-
-
-    #creating a srcmap
-    gtsrcmaps = GtApp('gtsrcmaps')
-    gtsrcmaps['scfile'] = ft2
-    gtsrcmaps['expcube'] = expcube
-    gtsrcmaps['bexpmap'] = bexpmap
-    gtsrcmaps['irfs'] =IRF
-    gtsrcmaps['cmap'] = cmap
-    gtsrcmaps['srcmdl'] = "srcmodel_%s.xml"%date.today()
-    gtsrcmaps['outfile'] = "srcm_%s.fits"%date.today()
-    gtsrcmaps['ptsrc'] = 'no'
-    gtsrcmaps['debug'] = 'yes'
-    
-    gtsrcmaps.run()                                                                                         
+    # N.B. put temporary files in a private directory so
+    # that jobs running in the same directory do not collide
+    tempdir = tempfile.mkdtemp(prefix='modelmap_')
+    srcmdl = os.path.join(tempdir,"srcmodel.xml")
+    srcmaps = os.path.join(tempdir,"srcm.fits")
 
-    #creating the model map
-    gtmodel= GtApp('gtmodel')
-    gtmodel['srcmaps'] = "srcm_%s.fits"%date.today()
-    gtmodel['srcmdl'] = "srcmodel_%s.xml"%date.today()
-    gtmodel['outfile']=outfile
-    gtmodel['irfs']=IRF
-    gtmodel['expcube']=expcube
-    gtmodel['bexpmap']=bexpmap
-    gtmodel.run()
+    try:
+        like.writeXml(srcmdl)
 
-    os.system("rm -rf srcmodel_%s.xml"%date.today())
-    os.system("rm -rf srcm_%s.fits"%date.today())
+        #creating a srcmap
+        gtsrcmaps = GtApp('gtsrcmaps')
+        gtsrcmaps['scfile'] = ft2
+        gtsrcmaps['expcube'] = expcube
+        gtsrcmaps['bexpmap'] = bexpmap
+        gtsrcmaps['irfs'] =IRF
+        gtsrcmaps['cmap'] = cmap
+        gtsrcmaps['srcmdl'] = srcmdl
+        gtsrcmaps['outfile'] = srcmaps
+        gtsrcmaps['ptsrc'] = 'no'
+        gtsrcmaps['debug'] = 'yes'
+        
+        gtsrcmaps.run()                                                                                         
+
+        #creating the model map
+        gtmodel= GtApp('gtmodel')
+        gtmodel['srcmaps'] = srcmaps
+        gtmodel['srcmdl'] = srcmdl
+        gtmodel['outfile']=outfile
+        gtmodel['irfs']=IRF
+        gtmodel['expcube']=expcube
+        gtmodel['bexpmap']=bexpmap
+        gtmodel.run()
+    finally:
+        shutil.rmtree(tempdir)
 
 
 def excess_and_residual(roi,glike,ft1,ft2,outdir,name):
@@ -92,22 +100,171 @@ def excess_and_residual(roi,glike,ft1,ft2,outdir,name):
     #generating counts map
     cmap(roi,glike,ft1[0],ft2[0],cmap="%s/CMAP_2D_%s.fits"%(outdir,name),ccube=cmap3D,npix=200,binsz=0.1,proj="ZEA")
     like=glike.like
-    
-    #saving old data 
-    like.srcModel = "srcmodel_save_%s.xml"%date.today()
-    like.writeXml()
-    
-    
-    #Create a model counts map including the source
-    modelmap(like,ft2,cmap3D,"%s/model_countsmap_with_%s.fits"%(outdir,name))
 
-    #Delete the source
-    like.deleteSource(name)
-    modelmap(like,ft2,cmap3D,"%s/model_countsmap_without_%s.fits"%(outdir,name))
+    # N.B. put the saved model in a private directory so
+    # that jobs running in the same directory do not collide
+    tempdir = tempfile.mkdtemp(prefix='excess_and_residual_')
+    srcmdl = os.path.join(tempdir,"srcmodel_save.xml")
 
-    #Reload initial roi
+    try:
+        #saving old data 
+        like.writeXml(srcmdl)
 
-    srcModel = readXml.SourceModel("srcmodel_%s.xml"%date.today())
+        #Create a model counts map including the source
+        modelmap(like,ft2,cmap3D,"%s/model_countsmap_with_%s.fits"%(outdir,name))
 
-    
-    os.system("rm -rf srcmodel_%s.xml"%date.today())
+        #Delete the source, and add it back even if gtmodel fails
+        source = like.deleteSource(name)
+        try:
+            modelmap(like,ft2,cmap3D,"%s/model_countsmap_without_%s.fits"%(outdir,name))
+        finally:
+            like.addSource(source)
+
+        #Reload initial roi
+        srcModel = readXml.SourceModel(srcmdl)
+    finally:
+        shutil.rmtree(tempdir)
+
+    return srcModel
+
+
+class ModelMapEngine(object):
+    """ Compute gtlike model counts maps in-process from a 
+        srcmaps file (created by gtsrcmaps) instead
+        of running gtsrcmaps+gtmodel.
+
+        The model counts for each source are computed the same way as BinnedLikelihood:
+        each plane of the source map (evaluated at the energy bin edges) is weighted by the
+        spectrum of the source and integrated over each energy bin with the trapezoid rule.
+
+        The source maps are read from the srcmaps file only once, and
+        the counts cube of each source is cached, so after a fit only the
+        sources whose spectral parameters changed have to be recomputed.
+
+        Usage:
+
+            engine = ModelMapEngine(like)
+            engine.save_model_map('model.fits')
+            engine.save_residual_map('residual.fits')
+
+        Sources which are not in the srcmaps file (for example point
+        sources when gtsrcmaps was run with ptsrc=no) have their
+        source maps computed by BinnedLikelihood instead.
+    """
+    def __init__(self, like, srcmaps=None):
+        self.like = like
+        self.srcmaps = srcmaps if srcmaps is not None else like.binnedData.srcMaps
+
+        self.fits = pyfits.open(self.srcmaps, memmap=True)
+        self.header = self.fits['PRIMARY'].header
+        self.energies = np.asarray(self.fits['ENERGIES'].data.field('Energy'), dtype=float)
+
+        self._planes = dict()
+        self._model_counts = dict()
+
+    def counts(self):
+        """ The observed counts cube. """
+        return np.asarray(self.fits['PRIMARY'].data, dtype=float)
+
+    def _source_planes(self, name):
+        """ The source map of source name, read (or computed) the first
+            time it is needed. The planes are kept in the dtype of the
+            srcmaps file. """
+        if name not in self._planes:
+            try:
+                self._planes[name] = np.asarray(self.fits[name].data)
+            except KeyError:
+                self._planes[name] = self._compute_planes(name)
+        return self._planes[name]
+
+    def _compute_planes(self, name):
+        """ Compute the source map for a source which is not in
+            the srcmaps file with BinnedLikelihood. """
+        shape = (len(self.energies), self.header['NAXIS2'], self.header['NAXIS1'])
+        try:
+            planes = np.asarray(self.like.logLike.sourceMap(name).model(), dtype=np.float32)
+        except Exception, ex:
+            raise Exception("Source %s is not in srcmaps file %s and its source map could not be computed: %s. "
+                            "Write a srcmaps file with all sources with like.logLike.saveSourceMaps(filename)." % (name,self.srcmaps,ex))
+        if planes.size != np.prod(shape):
+            raise Exception("Source map computed for %s has %s pixels, but srcmaps file %s has shape %s." % (name,planes.size,self.srcmaps,shape))
+        return planes.reshape(shape)
+
+    def _spectrum_key(self, spectrum):
+        parameters=pyLikelihood.ParameterVector()
+        spectrum.getParams(parameters)
+        return (spectrum.genericName(),) + tuple((p.getName(), p.getValue(), p.getScale()) for p in parameters)
+
+    def source_model_counts(self, name):
+        """ The model counts cube for source name. Only recomputed
+            if the spectrum of the source has changed. """
+        from . specplot import SpectrumPlotter
+
+        spectrum = self.like.logLike.getSource(name).spectrum()
+        key = self._spectrum_key(spectrum)
+
+        if name not in self._model_counts or self._model_counts[name][0] != key:
+            planes = self._source_planes(name)
+            dnde = SpectrumPlotter.get_dnde_mev_gtlike(spectrum, self.energies)
+            weighted = planes*dnde[:,np.newaxis,np.newaxis]
+            de = np.diff(self.energies)[:,np.newaxis,np.newaxis]
+            counts = 0.5*(weighted[:-1]+weighted[1:])*de
+            self._model_counts[name] = (key, counts)
+
+        return self._model_counts[name][1]
+
+    def model_counts(self, exclude=[]):
+        """ Total model counts cube of all sources in like, except the ones in exclude.
+            If every source is excluded, the model is all zeros. """
+        names = [name for name in self.like.sourceNames() if name not in exclude]
+
+        # forget sources which have been deleted
+        for name in self._model_counts.keys():
+            if name not in names and name not in exclude:
+                self._model_counts.pop(name)
+
+        model = np.zeros((len(self.energies)-1, self.header['NAXIS2'], self.header['NAXIS1']))
+        for name in names:
+            model += self.source_model_counts(name)
+        return model
+
+    def residual_counts(self, exclude=[]):
+        return self.counts() - self.model_counts(exclude=exclude)
+
+    def _save(self, filename, data, sum_energy):
+        header = self.header.copy()
+        if sum_energy:
+            data = data.sum(axis=0)
+            for k in ['CTYPE3','CRPIX3','CRVAL3','CDELT3','CUNIT3']:
+                if header.has_key(k): del header[k]
+        hdu = pyfits.PrimaryHDU(data=data, header=header)
+        hdulist = pyfits.HDUList([hdu])
+        if not sum_energy:
+            ebounds = self.fits['EBOUNDS']
+            hdulist.append(pyfits.BinTableHDU(data=ebounds.data, header=ebounds.header))
+        hdulist.writeto(filename, clobber=True)
+
+    def save_model_map(self, filename, exclude=[], sum_energy=False):
+        self._save(filename, self.model_counts(exclude=exclude), sum_energy)
+
+    def save_residual_map(self, filename, exclude=[], sum_energy=False):
+        self._save(filename, self.residual_counts(exclude=exclude), sum_energy)
+
+
+def get_model_map_engine(like):
+    """ Get a ModelMapEngine for like, cached on the like object
+        so that the source maps are reused across calls. """
+    engine = getattr(like, '_model_map_engine', None)
+    if engine is None or engine.srcmaps != like.binnedData.srcMaps:
+        engine = like._model_map_engine = ModelMapEngine(like)
+    return engine
+
+
+def gtlike_residual_maps(like, outdir, name, sum_energy=True):
+    """ In-process replacement for excess_and_residual. Save the model counts
+        with and without source name and the residual maps to outdir. """
+    engine = get_model_map_engine(like)
+    engine.save_model_map("%s/model_countsmap_with_%s.fits" % (outdir,name), sum_energy=sum_energy)
+    engine.save_model_map("%s/model_countsmap_without_%s.fits" % (outdir,name), exclude=[name], sum_energy=sum_energy)
+    engine.save_residual_map("%s/residual_with_%s.fits" % (outdir,name), sum_energy=sum_energy)
+    engine.save_residual_map("%s/residual_without_%s.fits" % (outdir,name), exclude=[name], sum_energy=sum_energy)
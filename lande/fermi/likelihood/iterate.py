@@ -2,15 +2,22 @@
     and doing otherwise repeative tasks. """
 import os
 import sys
+from os.path import expandvars
 
 import numpy as np
+import pyfits
+import pywcs
+from scipy.ndimage import maximum_filter
 
 from skymaps import SkyDir
 
 from uw.like.pointspec_helpers import PointSource
 from uw.like.Models import PowerLaw
 
+from lande.utilities.parallel import fork_map, WorkerException
+
 from . fit import fit_prefactor
+from . save import pointlike_get_all_names
 from . pretty import pformat
 from . localize import MinuitLocalizer
 
@@ -79,6 +86,148 @@ Code to create point source:
                    **tsmap_kwargs)
 
 
+def find_tsmap_peaks(tsmap, threshold=25, min_separation=0.5):
+    """ Find all local maxima in a TS map (the fitsfile written
+        by roi.plot_tsmap) with TS larger than threshold.
+
+        Peaks closer than min_separation (in degrees) to a brighter
+        peak are discarded. Returns a list of (skydir, TS) tuples,
+        sorted by decreasing TS. """
+    f = pyfits.open(expandvars(tsmap))
+    header, data = f[0].header, f[0].data.squeeze()
+    wcs = pywcs.WCS(header, naxis=2)
+
+    galactic = header['CTYPE1'].startswith('GLON')
+    coordsystem = SkyDir.GALACTIC if galactic else SkyDir.EQUATORIAL
+
+    is_peak = (data == maximum_filter(data, size=3, mode='nearest')) & (data > threshold)
+    y, x = np.where(is_peak)
+    ts = data[y,x]
+    lon, lat = wcs.wcs_pix2sky(x, y, 0)
+
+    peaks = []
+    for i in np.argsort(ts)[::-1]:
+        skydir = SkyDir(float(lon[i]), float(lat[i]), coordsystem)
+        if all(np.degrees(skydir.difference(other)) > min_separation for other,other_ts in peaks):
+            peaks.append((skydir, float(ts[i])))
+    return peaks
+
+
+def _localize_candidate(roi, name, minuit_localizer, fit_kwargs):
+    if minuit_localizer:
+        m = MinuitLocalizer(roi, name, fit_kwargs=fit_kwargs)
+        localization = m.results
+    else:
+        roi.localize(which=name, update=True)
+        localization = roi.get_ellipse()
+    skydir = roi.get_source(name).skydir
+    return skydir.ra(), skydir.dec(), localization
+
+
+def _new_source_names(existing, prefix, n):
+    """ n new source names prefix_N which continue the numbering after
+        the largest prefix_N already in existing:
+
+            >>> _new_source_names(['seed_0', 'seed_1', 'seed_x', 'other_5'], 'seed', 2)
+            ['seed_2', 'seed_3']
+            >>> _new_source_names([], 'seed', 2)
+            ['seed_0', 'seed_1']
+    """
+    numbers = [-1]
+    for name in existing:
+        if name.startswith(prefix + '_') and name[len(prefix)+1:].isdigit():
+            numbers.append(int(name[len(prefix)+1:]))
+    first = max(numbers) + 1
+    return ['%s_%s' % (prefix, i) for i in range(first, first + n)]
+
+def new_ps_from_tsmap(roi, tsmap='residual_tsmap.fits', 
+                      prefix='seed', threshold=25, min_separation=0.5,
+                      tsmap_kwargs=dict(size=10),
+                      fit_kwargs=dict(use_gradient=False),
+                      print_kwargs=dict(galactic=True, maxdist=15),
+                      localize=True,
+                      minuit_localizer=False,
+                      parallel=True,
+                      processes=None,
+                     ):
+    """ Like new_ps, but add in one go a new point source at every
+        peak in the TS map tsmap (see find_tsmap_peaks).
+
+        The prefactors of all the new sources are fit jointly,
+        the sources are localized independently (in parallel
+        if parallel=True), and then the ROI is fit once at the end. 
+
+        The new sources are named prefix_N, numbered after any
+        prefix_N sources already in the ROI, so this can be run
+        repeatedly on the regenerated residual TS map.
+        
+        Returns the names of the new sources. """
+
+    peaks = find_tsmap_peaks(tsmap, threshold=threshold, min_separation=min_separation)
+
+    if len(peaks) == 0:
+        print 'No peaks in %s with TS>%s' % (tsmap, threshold)
+        return []
+
+    roi.print_summary(**print_kwargs)
+
+    emin,emax=roi.bin_edges[[0,-1]]
+
+    names = _new_source_names(pointlike_get_all_names(roi), prefix, len(peaks))
+    for name,(skydir,ts) in zip(names, peaks):
+        print 'Adding source %s at %s (TS map peak=%.1f)' % (name, skydir, ts)
+
+        ps = PointSource(
+            name=name,
+            skydir=skydir,
+            model=PowerLaw(e0=np.sqrt(emin*emax)))
+        roi.add_source(ps)
+
+    fit_prefactor(roi, names, **fit_kwargs)
+
+    if localize:
+        f = lambda name: _localize_candidate(roi, name, minuit_localizer, fit_kwargs)
+        if parallel:
+            results = fork_map(f, names, processes=processes, raise_exceptions=False)
+        else:
+            results = map(f, names)
+
+        for name,result in zip(names, results):
+            if isinstance(result, WorkerException):
+                print 'ERROR localizing source %s:' % name, result
+                continue
+            ra, dec, localization = result
+            roi.modify(which=name, skydir=SkyDir(ra, dec))
+            roi.get_source(which=name).localization = localization
+
+    roi.fit(**fit_kwargs)
+
+    roi.print_summary(**print_kwargs)
+
+    print roi
+
+    for name in names:
+        ts = roi.TS(which=name, quick=False, fit_kwargs=fit_kwargs)
+        print 'TS for source %s is %.1f' % (name,ts)
+
+    path=os.path.abspath(sys.argv[0])
+    print """
+Code to create point sources:
+
+    # Analysis came from %s""" % path
+    for name in names:
+        print """    ps=%s
+    roi.add_source(ps)""" % pformat(roi.get_source(name))
+
+    roi.save('roi.dat')
+
+    roi.plot_tsmap(filename='residual_tsmap.pdf', 
+                   fitsfile='residual_tsmap.fits',
+                   **tsmap_kwargs)
+
+    return names
+
+
 def free_src(roi, name, 
              tsmap_kwargs=dict(size=10),
              fit_kwargs=dict(use_gradient=False),
@@ -146,3 +295,8 @@ Code to fix convergence
                    fitsfile='residual_tsmap.fits',
                    **tsmap_kwargs)
 
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -6,6 +6,7 @@ import sys
 import sympy
 import pylab as P
 import numpy as np
+from scipy.stats import chi2
 
 from uw.like.Models import PowerLaw, PLSuperExpCutoff
 from uw.like.roi_state import PointlikeState
@@ -21,12 +22,38 @@ from lande.pysed import units
 from . printing import summary
 from . superstate import SuperState
 from . tools import gtlike_or_pointlike
-from . save import get_full_energy_range, spectrum_to_dict, pointlike_model_to_flux, flux_dict
+from . save import get_full_energy_range, spectrum_to_dict, pointlike_model_to_flux, flux_dict, logLikelihood
+from . load import dict_to_spectrum
 from . fit import gtlike_allow_fit_only_prefactor, paranoid_gtlike_fit
 from . models import build_gtlike_spectrum, build_pointlike_model
-from . basefit import BaseFitter
+from . basefit import BaseFitter, instrumented
 from . specplot import SpectralAxes, SpectrumPlotter
 
+def gtlike_rescale_norm(like, name, verbosity=False):
+    """ Widen the limits on the normalization of source name to (at least) the 
+        pointlike default limits and set its scale to 1. This gives
+        the upper limit code a large enough range to integrate over. """
+    source=like.logLike.getSource(name)
+    spectrum=source.spectrum()
+    model = build_pointlike_model(spectrum)
+    if verbosity:
+        print 'Rescaling %s model parameters before limits' % model.name
+        print ' * Initial mappers:',model.mappers
+    norm_name = model.param_names[0]
+    default_norm_limits = model.default_limits[norm_name]
+    lower,upper = model.get_limits(norm_name)
+    norm_min = min(lower, default_norm_limits.lower)
+    norm_max = max(upper, default_norm_limits.upper)
+
+    model.set_limits(norm_name, norm_min, norm_max, scale=1)
+    if verbosity:
+        print ' * New mappers:',model.mappers
+
+    spectrum = build_gtlike_spectrum(model)
+    like.setSpectrum(name,spectrum)
+    like.syncSrcParams(name)
+
+
 class UpperLimit(BaseFitter):
 
     defaults = BaseFitter.defaults + (
@@ -105,6 +132,7 @@ class GtlikeUpperLimit(UpperLimit):
 
         self._compute()
 
+    @instrumented
     def _compute(self):
         if self.verbosity: print 'Calculating gtlike upper limit'
 
@@ -142,25 +170,7 @@ class GtlikeUpperLimit(UpperLimit):
                 like.syncSrcParams(like[i].srcName)
 
             if self.rescale_parameters_before_limit:
-                source=like.logLike.getSource(name)
-                spectrum=source.spectrum()
-                model = build_pointlike_model(spectrum)
-                if self.verbosity:
-                    print 'Rescaling %s model parameters before limits' % model.name
-                    print ' * Initial mappers:',model.mappers
-                norm_name = model.param_names[0]
-                default_norm_limits = model.default_limits[norm_name]
-                lower,upper = model.get_limits(norm_name)
-                norm_min = min(lower, default_norm_limits.lower)
-                norm_max = max(upper, default_norm_limits.upper)
-
-                model.set_limits(norm_name, norm_min, norm_max, scale=1)
-                if self.verbosity:
-                    print ' * New mappers:',model.mappers
-
-                spectrum = build_gtlike_spectrum(model)
-                like.setSpectrum(name,spectrum)
-                like.syncSrcParams(name)
+                gtlike_rescale_norm(like, name, verbosity=self.verbosity)
 
             # Note, I think freeze_all is redundant, but flag it just 
             # to be paranoid
@@ -233,6 +243,7 @@ class GtlikePowerLawUpperLimit(GtlikeUpperLimit):
     def __init__(self, *args, **kwargs):
         super(GtlikePowerLawUpperLimit,self).__init__(*args, **kwargs)
 
+    @instrumented
     def _compute(self):
         """ Wrap up calculating the flux upper limit for a powerlaw
             source.  This function employes the pyLikelihood function
@@ -310,6 +321,7 @@ class GtlikeCutoffUpperLimit(GtlikeUpperLimit):
     def __init__(self, *args, **kwargs):
         super(GtlikeCutoffUpperLimit,self).__init__(*args, **kwargs)
 
+    @instrumented
     def _compute(self):
         if self.verbosity: print 'calculating gtlike cutoff upper limit'
         like = self.like
@@ -354,6 +366,7 @@ class PointlikeUpperLimit(UpperLimit):
 
         self._compute()
 
+    @instrumented
     def _compute(self):
 
         roi = self.roi
@@ -401,6 +414,7 @@ class PointlikePowerLawUpperLimit(PointlikeUpperLimit):
     def __init__(self, *args, **kwargs):
         super(PointlikePowerLawUpperLimit,self).__init__(*args, **kwargs)
 
+    @instrumented
     def _compute(self):
         if self.verbosity: 
             print 'Calculating pointlike upper limit'
@@ -436,6 +450,7 @@ class PointlikeCutoffUpperLimit(PointlikeUpperLimit):
     def __init__(self, *args, **kwargs):
         super(PointlikeCutoffUpperLimit,self).__init__(*args, **kwargs)
 
+    @instrumented
     def _compute(self):
         if self.verbosity: print 'calculating pointlike cutoff upper limit'
 
@@ -451,3 +466,270 @@ class PointlikeCutoffUpperLimit(PointlikeUpperLimit):
 
         saved_state.restore(just_spectra=True)
 
+
+class ProfileUpperLimits(BaseFitter):
+    """ Compute the likelihood of a source as a function of its
+        normalization once and derive any number of upper
+        limits from this one likelihood profile:
+
+            ul = GtlikeProfileUpperLimits(like, name)
+            for cl in [0.95, 0.99]:
+                for emin,emax in [[1e2,1e3],[1e3,1e4],[1e4,1e5]]:
+                    r = ul.upper_limit(cl=cl, emin=emin, emax=emax, method='bayesian')
+
+        Both Bayesian limits (integrating the likelihood with a flat
+        prior in the normalization) and frequentist limits (one-sided
+        profile likelihood) can be computed, for any confidence level. Because
+        the spectral shape is fixed during the scan, the flux and energy flux
+        upper limits for any energy range follow from the normalization upper limit.
+        A different spectral shape requires a new scan.
+
+        Each limit is a dictionary in the same format as the results of
+        GtlikeUpperLimit and PointlikeUpperLimit, so it can be plotted
+        with UpperLimit(r).plot().
+
+        The profile can be saved and reloaded:
+
+            ul.save('profile.yaml')
+            ul = ProfileUpperLimits('profile.yaml')
+
+        For example, for a gaussian likelihood profile (with a
+        width of 1) peaked at a normalization of 0, the Bayesian
+        limit is the 95% quantile of a half-normal distribution
+        and the frequentist limit is where the log likelihood has 
+        dropped by chi2.ppf(0.9,1)/2:
+
+            >>> norms = np.linspace(0, 10, 1001)
+            >>> ul = ProfileUpperLimits(dict(norms=norms, logLikelihood=-norms**2/2))
+            >>> print '%.2f' % ul.norm_upper_limit(cl=0.95, method='bayesian')
+            1.96
+            >>> print '%.2f' % ul.norm_upper_limit(cl=0.95, method='frequentist')
+            1.64
+    """
+
+    defaults = UpperLimit.defaults + (
+        ('npoints', 100, 'Number of points to evaluate the likelihood at'),
+        ('delta_log_likelihood', 10, 'Scan normalization until the log likelihood has dropped by this much'),
+        ('max_steps', 50, 'Maximum number of steps taken to find the upper end of the scan'),
+    )
+
+    def _scan(self, loglike, best, step, lower, upper):
+        """ Evaluate loglike(norm) from the lower limit
+            of the normalization until the likelihood has
+            dropped by delta_log_likelihood from the best value:
+
+                >>> ul = ProfileUpperLimits(dict(), npoints=5, delta_log_likelihood=10, max_steps=50)
+                >>> norms, ll = ul._scan(lambda x: -x**2/2, best=0, step=1, lower=0, upper=np.inf)
+                >>> norms.tolist()
+                [0.0, 2.0, 4.0, 6.0, 8.0]
+
+            The scan stops at the upper limit of the normalization:
+
+                >>> norms, ll = ul._scan(lambda x: -x**2/2, best=0, step=1, lower=0, upper=3)
+                >>> norms.tolist()
+                [0.0, 0.75, 1.5, 2.25, 3.0]
+        """
+        ll_best = loglike(best)
+
+        if step <= 0: step = abs(best) if best != 0 else upper*1e-10
+        xmax = best + step
+        for i in range(self.max_steps):
+            if xmax >= upper or ll_best - loglike(xmax) > self.delta_log_likelihood:
+                break
+            step *= 2
+            xmax = best + step
+        xmax = min(xmax, upper)
+
+        norms = np.unique(np.concatenate([
+            np.linspace(lower, xmax, self.npoints),
+            # extra points to resolve the peak for bright sources.
+            np.linspace(max(lower, 2*best - xmax), xmax, self.npoints),
+            [best]]))
+        ll = np.asarray([loglike(x) for x in norms])
+        return norms, ll
+
+    def norm_upper_limit(self, cl=0.95, method='bayesian'):
+        """ Upper limit on the normalization of the source. """
+        norms = np.asarray(self.results['norms'])
+        ll = np.asarray(self.results['logLikelihood'])
+        ll = ll - ll.max()
+
+        if method == 'bayesian':
+            like = np.exp(ll)
+            cdf = np.append(0, np.cumsum(0.5*(like[1:]+like[:-1])*np.diff(norms)))
+            cdf /= cdf[-1]
+            return np.interp(cl, cdf, norms)
+        elif method == 'frequentist':
+            # one-sided interval
+            delta = chi2.ppf(2*cl-1, 1)/2
+            imax = np.argmax(ll)
+            # force the profile to be monotonic beyond the maximum
+            dll = np.maximum.accumulate(-ll[imax:])
+            if dll[-1] < delta:
+                raise Exception("Likelihood profile does not extend to confidence level %s" % cl)
+            return np.interp(delta, dll, norms[imax:])
+        else:
+            raise Exception("Unrecognized method %s" % method)
+
+    def upper_limit(self, cl=0.95, emin=None, emax=None, method='bayesian', 
+                    include_prefactor=False, prefactor_energy=None):
+        """ Upper limit in the same format as GtlikeUpperLimit.todict(). Energies in MeV. """
+        if emin is None and emax is None:
+            emin, emax = self.results['emin'], self.results['emax']
+
+        norm = self.norm_upper_limit(cl, method)
+
+        model = dict_to_spectrum(self.results['model'])
+        model[model.param_names[0]] = norm
+
+        results = pointlike_model_to_flux(model, emin=emin, emax=emax,
+                                          flux_units=self.flux_units, 
+                                          energy_units=self.energy_units,
+                                          errors=False,
+                                          include_prefactor=include_prefactor,
+                                          prefactor_energy=prefactor_energy)
+
+        spectrum = dict(self.results['spectrum'])
+        spectrum[self.results['norm_name']] = norm
+        results['spectrum'] = spectrum
+        results['confidence'] = cl
+        results['method'] = method
+        return tolist(results)
+
+
+class GtlikeProfileUpperLimits(ProfileUpperLimits):
+    """ Likelihood profile in the normalization for whatever spectral model 
+        is currently in like object. As in GtlikeUpperLimit, the ROI
+        is first fit with the spectral shape of the source frozen and 
+        all other parameters are frozen during the scan. """
+
+    defaults = ProfileUpperLimits.defaults + (
+        ('rescale_parameters_before_limit', True, 'See gtlike_rescale_norm'),
+    )
+
+    @keyword_options.decorate(defaults)
+    def __init__(self, like, name, **kwargs):
+        keyword_options.process(self, kwargs)
+
+        self.like = like
+        self.name = name
+
+        self._compute()
+
+    @instrumented
+    def _compute(self):
+        if self.verbosity: print 'Calculating gtlike likelihood profile'
+
+        like = self.like
+        name = self.name
+
+        saved_state = SuperState(like)
+
+        try:
+            gtlike_allow_fit_only_prefactor(like, name)
+            paranoid_gtlike_fit(like, verbosity=self.verbosity)
+
+            for i in range(len(like.model.params)):
+                like.model[i].setFree(False)
+                like.syncSrcParams(like[i].srcName)
+
+            if self.rescale_parameters_before_limit:
+                gtlike_rescale_norm(like, name, verbosity=self.verbosity)
+
+            spectrum = like.logLike.getSource(name).spectrum()
+            par = spectrum.normPar()
+            scale = par.getScale()
+            lower, upper = par.getBounds()
+
+            def loglike(x):
+                par.setValue(x)
+                like.syncSrcParams(name)
+                return logLikelihood(like)
+
+            best = par.getValue()
+            norms, ll = self._scan(loglike, best=best, step=par.error(), 
+                                   lower=max(lower,0), upper=upper)
+
+            par.setValue(best)
+            like.syncSrcParams(name)
+
+            emin, emax = get_full_energy_range(like)
+            self.results = dict(
+                norm_name=par.getName(),
+                norms=norms*scale,
+                logLikelihood=ll,
+                spectrum=spectrum_to_dict(spectrum),
+                model=spectrum_to_dict(build_pointlike_model(spectrum)),
+                emin=emin,
+                emax=emax)
+
+        except Exception, ex:
+            print 'ERROR gtlike likelihood profile: ', ex
+            traceback.print_exc(file=sys.stdout)
+            self.results = None
+        finally:
+            saved_state.restore()
+
+
+class PointlikeProfileUpperLimits(ProfileUpperLimits):
+    """ Likelihood profile in the normalization for whatever spectral model 
+        is currently in the pointlike ROI. All other parameters are
+        kept fixed during the scan. """
+
+    @keyword_options.decorate(ProfileUpperLimits.defaults)
+    def __init__(self, roi, name, **kwargs):
+        keyword_options.process(self, kwargs)
+
+        self.roi = roi 
+        self.name = name
+
+        self._compute()
+
+    @instrumented
+    def _compute(self):
+        if self.verbosity: print 'Calculating pointlike likelihood profile'
+
+        roi = self.roi
+        name = self.name
+
+        saved_state = PointlikeState(roi)
+
+        try:
+            model = roi.get_model(name).copy()
+            norm_name = model.param_names[0]
+
+            def loglike(x):
+                scan_model = model.copy()
+                scan_model[norm_name] = x
+                roi.modify(which=name, model=scan_model, keep_old_flux=False)
+                return logLikelihood(roi)
+
+            best = model[norm_name]
+
+            # Scan the normalization between its limits.
+            # N.B. pointlike normalizations must be strictly positive
+            lower, upper = model.get_limits(norm_name)
+            if lower <= 0:
+                lower = 1e-10*(upper if np.isfinite(upper) else max(abs(best), model.error(norm_name)))
+
+            norms, ll = self._scan(loglike, best=best, step=model.error(norm_name), 
+                                   lower=lower, upper=upper)
+
+            roi.modify(which=name, model=model, keep_old_flux=False)
+
+            emin, emax = get_full_energy_range(roi)
+            self.results = dict(
+                norm_name=norm_name,
+                norms=norms,
+                logLikelihood=ll,
+                spectrum=spectrum_to_dict(model),
+                model=spectrum_to_dict(model),
+                emin=emin,
+                emax=emax)
+
+        except Exception, ex:
+            print 'ERROR pointlike likelihood profile: ', ex
+            traceback.print_exc(file=sys.stdout)
+            self.results = None
+        finally:
+            saved_state.restore(just_spectra=True)
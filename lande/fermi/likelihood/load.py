@@ -1,17 +1,80 @@
+import os
+from os.path import expandvars
+
 import numpy as np
 
-import pyLikelihood
+from lande.utilities.files import file_hash
+
+# N.B. pyLikelihood and pointlike are imported in the
+# functions which use them, since they are slow to import.
+
+_funcFactory = None
+
+def _get_func_factory():
+    global _funcFactory
+    if _funcFactory is None:
+        import pyLikelihood
+        _funcFactory = pyLikelihood.SourceFactory_funcFactory()
+    return _funcFactory
 
-from uw.like.Models import FileFunction
-import uw.like.Models
-from uw.darkmatter.spectral import DMFitFunction
+# Templates of spectral models, which are copied
+# instead of being built from scratch every time.
+_gtlike_templates = dict()
+_pointlike_file_functions = dict()
 
-_funcFactory = pyLikelihood.SourceFactory_funcFactory()
+# The hash of each FileFunction table, keyed by (path, size, mtime)
+_file_hashes = dict()
+
+def _file_function_key(filename):
+    """ FileFunctions are cached by filename and by a hash of the
+        file, so that a modified file is read in again. Each file
+        is only hashed again when its size or mtime changes. """
+    path = os.path.abspath(expandvars(filename))
+    stat = os.stat(path)
+    id = (path, stat.st_size, stat.st_mtime)
+    if id not in _file_hashes: _file_hashes[id] = file_hash(path)
+    return filename, _file_hashes[id]
+
+def new_gtlike_spectrum(name, file=None):
+    """ Create a new pyLikelihood spectral model of type name
+        (file is the table for a FileFunction).
+
+        The first model of each type (or FileFunction table) is
+        cached and all later models are clones of it. """
+    import pyLikelihood
+    if name == 'FileFunction':
+        key = _file_function_key(file)
+        if key not in _gtlike_templates:
+            template = pyLikelihood.FileFunction()
+            template.readFunction(file)
+            _gtlike_templates[key] = template
+        clone = _gtlike_templates[key].clone()
+        spectrum = pyLikelihood.FileFunction_cast(clone)
+        # N.B. The cast does not own the cloned object, so the
+        # clone lives as long as the spectrum which points to it.
+        spectrum._clone = clone
+        return spectrum
+    else:
+        if name not in _gtlike_templates:
+            _gtlike_templates[name] = _get_func_factory().create(name)
+        return _gtlike_templates[name].clone()
+
+def pointlike_file_function(file):
+    """ Create a new pointlike FileFunction. The table in each
+        file is only read once and then copied. """
+    from uw.like.Models import FileFunction
+    key = _file_function_key(file)
+    if key not in _pointlike_file_functions:
+        _pointlike_file_functions[key] = FileFunction(file=file)
+    return _pointlike_file_functions[key].copy()
 
 
 def pointlike_dict_to_spectrum(d):
+    import uw.like.Models
+    from uw.darkmatter.spectral import DMFitFunction
+
     if d['name'] == 'FileFunction':
-        model = FileFunction(file=d['file'])
+        model = pointlike_file_function(d['file'])
     elif d['name'] == 'DMFitFunction':
         model = DMFitFunction()
     else:
@@ -30,11 +93,7 @@ def gtlike_dict_to_spectrum(d):
     """ Load back as a pyLikelihood spectrum object
         a spectrum that has been saved by the spectrum_to_string
         object. This undoes the conversion of spectrum_to_dict """
-    if d['name'] == 'FileFunction':
-        spectrum = pyLikelihood.FileFunction()
-        spectrum.readFunction(d['file'])
-    else:
-        spectrum=_funcFactory.create(d['name'])
+    spectrum = new_gtlike_spectrum(d['name'], d.get('file'))
     for k,v in d.items(): 
         if k not in ['name','method','file','covariance_matrix']:
             if len(k) > 10 and k[-10:] in ['_upper_err','_lower_err']:
@@ -49,7 +108,8 @@ def gtlike_dict_to_spectrum(d):
 def dict_to_spectrum(d):
     """ Test out FileFunction:
 
-            >>> from uw.like.Models import PowerLaw
+            >>> import pyLikelihood
+            >>> from uw.like.Models import PowerLaw, FileFunction
             >>> pl= PowerLaw()
             >>> from tempfile import NamedTemporaryFile
             >>> tempfile = NamedTemporaryFile()
@@ -80,6 +140,11 @@ def dict_to_spectrum(d):
     if d['method'] == 'pointlike':
         return pointlike_dict_to_spectrum(d)
 
+def dicts_to_spectra(dicts):
+    """ Convert a dictionary mapping source names to the spectral dictionaries
+        of each source into a dictionary mapping source names to spectra. """
+    return dict((name,dict_to_spectrum(d)) for name,d in dicts.items())
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
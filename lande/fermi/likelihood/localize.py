@@ -14,7 +14,7 @@ from uw.utilities import rotations
 from . fit import fit_prefactor
 from . tools import galstr
 from . save import logLikelihood,skydirdict,ts_dict
-from . basefit import BaseFitter
+from . basefit import BaseFitter, instrumented
 
 
 def paranoid_localize(roi, name, verbosity=True):
@@ -228,6 +228,7 @@ class MinuitLocalizer(BaseFitter):
 
         return -ll # minimize negative log likelihood
 
+    @instrumented
     def localize(self):
         roi=self.roi
         name=self.name
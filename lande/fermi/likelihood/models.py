@@ -4,18 +4,27 @@ import numpy as np
 
 import pyLikelihood
 
-from uw.like.Models import FileFunction
 from uw.utilities.parmap import LimitMapper,LinearMapper
 from uw.utilities.xml_parsers import XML_to_Model
 
-from . save import spectrum_to_dict
-from . load import dict_to_spectrum
+from . load import new_gtlike_spectrum, pointlike_file_function
 
 _funcFactory = pyLikelihood.SourceFactory_funcFactory()
 
 def gtlike_unscale_all_parameters(spectrum):
-    """ kind of a kluge. """
-    return dict_to_spectrum(spectrum_to_dict(spectrum))
+    """ Return a copy of spectrum with the default scale for each parameter. """
+    gtlike_name = spectrum.genericName()
+    file = pyLikelihood.FileFunction_cast(spectrum).filename() if gtlike_name == 'FileFunction' else None
+    new_spectrum = new_gtlike_spectrum(gtlike_name, file)
+
+    param_names = pyLikelihood.StringVector()
+    spectrum.getParamNames(param_names)
+    for name in param_names:
+        param = spectrum.getParam(name)
+        new_param = new_spectrum.getParam(name)
+        new_param.setTrueValue(param.getTrueValue())
+        new_param.setError(param.error()*param.getScale()/new_param.getScale())
+    return new_spectrum
 
 
 def build_gtlike_spectrum(model):
@@ -102,6 +111,7 @@ def build_gtlike_spectrum(model):
             >>> filename = temp.name
             >>> pointlike_model.save_profile(filename, emin=1, emax=1e6)
 
+            >>> from uw.like.Models import FileFunction
             >>> ff_pointlike = FileFunction(normalization=9.5,file=filename, set_default_oomp_limits=True)
             >>> ff_gtlike = build_gtlike_spectrum(ff_pointlike)
             >>> np.allclose(DMFitFunction.call_pylike_spectrum(ff_gtlike, energies),
@@ -115,11 +125,7 @@ def build_gtlike_spectrum(model):
 
     gtlike_name = model.gtlike['name']
 
-    if gtlike_name != 'FileFunction':
-        spectrum = _funcFactory.create(gtlike_name)
-    else:
-        spectrum = pyLikelihood.FileFunction()
-        spectrum.readFunction(model.file)
+    spectrum = new_gtlike_spectrum(gtlike_name, model.file if gtlike_name == 'FileFunction' else None)
 
     for p,g in zip(model.param_names,model.gtlike['param_names']):
         param=spectrum.getParam(g)
@@ -246,7 +252,7 @@ def build_pointlike_model(spectrum):
     if gtlike_name == 'FileFunction':
         ff=pyLikelihood.FileFunction_cast(spectrum)
         filename=ff.filename()
-        model = FileFunction(file=filename)
+        model = pointlike_file_function(filename)
     else:
         model = XML_to_Model.modict[gtlike_name]()
     
@@ -282,6 +288,23 @@ def build_pointlike_model(spectrum):
     return model
 
 
+def build_gtlike_spectra(models):
+    """ Convert a dictionary mapping source names to pointlike models
+        into a dictionary mapping source names to pyLikelihood spectra. """
+    return dict((name,build_gtlike_spectrum(model)) for name,model in models.items())
+
+def build_pointlike_models(spectra):
+    """ Convert a dictionary mapping source names to pyLikelihood
+        spectra into a dictionary mapping source names to pointlike models. """
+    return dict((name,build_pointlike_model(spectrum)) for name,spectrum in spectra.items())
+
+def gtlike_set_spectra(like, models):
+    """ Set the spectra of many sources in like from a dictionary
+        mapping source names to pointlike models. """
+    for name,spectrum in build_gtlike_spectra(models).items():
+        like.setSpectrum(name,spectrum)
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
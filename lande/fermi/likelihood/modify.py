@@ -33,3 +33,22 @@ def gtlike_modify(like, name, free=None, freeze_spectral_shape=None):
     like.syncSrcParams(name)
 
 modify=gtlike_modify
+
+def pointlike_modify_many(roi, free=dict(), models=dict()):
+    """ Modify many sources in a pointlike ROI at once.
+
+        models is a dictionary mapping source names to new spectral
+        models (the old flux is not kept) and free is a dictionary mapping
+        source names to their new free arrays.
+
+        roi.modify recomputes the state of the ROI after every call,
+        which takes a long time for ROIs with many sources. Here, the
+        free arrays are set directly on the models and the ROI
+        is updated only once at the end. """
+    for name,model in models.items():
+        roi.modify(which=name, model=model, keep_old_flux=False)
+
+    if len(free) > 0:
+        for name,f in free.items():
+            roi.get_model(name).free[:] = f
+        roi.__update_state__()
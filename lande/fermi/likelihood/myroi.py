@@ -8,83 +8,22 @@
 
     Author: Joshua Lande
 """
-import numpy as np
-
-from lande.utilities.tools import tolist
-
-from . localize import *
-
-# import stuff generally useful
-from uw.like.Models import *
-from uw.like.roi_analysis import *
-from uw.like.roi_image import *
-from uw.like.SpatialModels import *
-from uw.like.roi_extended import *
-from uw.like.roi_monte_carlo import *
-from uw.like.roi_localize import *
-from uw.like.roi_catalogs import *
-from uw.like.roi_plotting import *
-from uw.like.mapplots import *
-from uw.like.pointspec import *
-from uw.like.pointspec_helpers import *
-from uw.utilities.convolution import *
-from uw.utilities.minuit import Minuit
-from uw.utilities import keyword_options
-from skymaps import *
-from os.path import *
-from roi_gtlike import *
-from . extended import *
-from lande.utilities.decorators import *
-from lande.utilities.plotting import *
-
-from . tools import galstr
-from . diffuse import get_background
-
-from uw.like import sed_plotter
-import pylab as P
-import pylab
-from pylab import *
-
-from argparse import ArgumentParser
-import warnings
-import operator
-import cPickle
-import shutil
 import os
-import re
-import math
-import yaml
-from tempfile import NamedTemporaryFile
+import warnings
 import collections
-from cStringIO import StringIO
+from tempfile import NamedTemporaryFile
 
-import numpy
 import numpy as np
-from numpy import *
-
-from scipy.optimize import fmin
-from matplotlib.ticker import FuncFormatter
-
-import pyfits 
 
-from uw.like.pointspec_helpers import get_diffuse_source,FermiCatalog,PointSource,ExtendedSourceCatalog
-from uw.like.roi_diffuse import DiffuseSource
+# N.B. Only what is needed to define LandeROI is imported here.
+# Everything else (pyfits, the catalogs, the plotting and
+# gtlike code, ...) is imported in the methods which use it, so
+# that importing this module is not much slower than importing
+# uw.like.roi_analysis itself.
 from uw.like.roi_analysis import ROIAnalysis,decorate_with
-from uw.like.pointspec import DataSpecification,SpectralAnalysis
-from uw.like.roi_tsmap import TSCalc,TSCalcPySkyFunction
-from uw.like.roi_extended import ExtendedSource,ROIExtendedModelAnalytic
-from uw.like.SpatialModels import SpatialModel
-from uw.like.Models import Model
 
-
-from skymaps import SkyDir,SkyImage
-
-import imp
-from os.path import expandvars as e
-from os.path import join as j
-
-from uw.utilities import colormaps
-from uw.utilities.colormaps import *
+from lande.utilities.decorators import modify_defaults, select_quiet
+from . tools import galstr
 
 
 class Empty: pass
@@ -119,19 +58,35 @@ class LandeROI(ROIAnalysis):
     def get_point_sources(names,catalog):
         """ Input is a list of the name of 1FGL sources. What is
             return is a list of point source found from the names. """
+        from uw.like.pointspec_helpers import FermiCatalog, PointSource
+        from uw.like.roi_catalogs import SourceCatalog
+
         cat=FermiCatalog(catalog,free_radius=180) \
                 if not isinstance(catalog,SourceCatalog) else catalog
 
+        if not isinstance(catalog,SourceCatalog):
+            # Look up names (and associations) in the catalog file's
+            # name index, instead of scanning the catalog for each name.
+            from lande.fermi.data.catalogs import get_catalog_store
+            store=get_catalog_store(catalog)
+            resolve=lambda name: store.names[store.index(name)] if name in store else name
+        else:
+            resolve=lambda name: name
+
+        indices=collections.defaultdict(list)
+        for i,cat_name in enumerate(cat.names):
+            indices[cat_name].append(i)
+
         point_sources=[]
 
         for name in names:
 
-            index=np.where(cat.names==name)[0]
+            index=indices[resolve(name)]
             if len(index) < 1:
                 raise Exception("Cannot find source %s in the catalog %s" % (name,catalog))
             if len(index) > 1:
                 raise Exception("%s has too many counterpats in the catalog %s" % (name,catalog))
-            index = int(index)
+            index = index[0]
 
             point_sources.append(PointSource(cat.dirs[index],
                                  cat.names[index],cat.models[index],
@@ -142,7 +97,10 @@ class LandeROI(ROIAnalysis):
 
         return point_sources
 
-    get_background = get_background
+    @staticmethod
+    def get_background(*args):
+        from lande.fermi.diffuse.background import get_background
+        return get_background(*args)
 
     def fit(self,*args,**kwargs):
         try:
@@ -179,6 +137,8 @@ class LandeROI(ROIAnalysis):
                 # a file). So do some tests to make sure the
                 # file looks good. If not delete and recreate it.
 
+                import pyfits
+
                 # make warnigns raise exceptions
                 warnings.filterwarnings('error')
                 x=pyfits.open(outfile)
@@ -236,6 +196,7 @@ class LandeROI(ROIAnalysis):
 
     def prune_empty_diffuse_models(self):
         """ Remove diffuse models which predict 0s. """
+        from uw.like.roi_extended import ExtendedSource
         del_sources = []
         for i,m in enumerate(self.bgm.diffuse_sources):
             if isinstance(m,ExtendedSource):
@@ -264,6 +225,7 @@ class LandeROI(ROIAnalysis):
             return None
 
     def gtlike_followup(self,which=None,output_srcmdl_file=None, **kwargs):
+        from . roi_gtlike import Gtlike
 
         gtlike=Gtlike(self,**kwargs)
         like=gtlike.like
@@ -278,6 +240,7 @@ class LandeROI(ROIAnalysis):
     def get_info_dict(self,which):
         """ Return a dictionary of everything Joshua finds
             interesting about the source. """
+        from uw.like.roi_extended import ExtendedSource
 
         src_info={}
         src_info['logLikelihood']={'spectral':float(-self.logLikelihood(self.parameters()))}
@@ -360,16 +323,19 @@ class LandeROI(ROIAnalysis):
         return src_info
 
     def freeze_all_background_sources(self):
+        from uw.like.roi_extended import ExtendedSource
         background_sources = [_ for _ in self.dsm.diffuse_sources if not isinstance(_,ExtendedSource)]
         for bgs in background_sources:
             self.modify(which=bgs,free=False)
 
     def plot_profile(self,which,filename="profile.png", datafile="profile.yaml", **kwargs):
+        from . extended import ExtensionProfile
         p=ExtensionProfile(self, which)
         p.plot(filename)
         p.save(datafile)
 
     def extension_profile(self, which,filename='profile.yaml', **kwargs):
+        from . extended import ExtensionProfile
         p=ExtensionProfile(self, which)
         p.save(filename)
 
@@ -377,6 +343,7 @@ class LandeROI(ROIAnalysis):
         return super(LandeROI,self).dual_localize(*args,**kwargs)
 
     def multi_localize(self,*args,**kwargs):
+        from . localize import MultiLocalizer
         dl = MultiLocalizer(self,*args,**kwargs)
         dl.localize()
 
@@ -393,7 +360,7 @@ class LandeROI(ROIAnalysis):
         if not self.quiet: print 'Plotting counts map'
         return super(LandeROI,self).plot_counts_map(filename=filename,**kwargs)
 
-    @decorate_with(ROISmoothedModel)
+    @decorate_with(ROIAnalysis.plot_model)
     def plot_model(self,filename="model_counts.png",**kwargs):
         if not self.quiet: print 'Plotting model counts'
         return super(LandeROI,self).plot_model(filename=filename,**kwargs)
@@ -428,8 +395,9 @@ class LandeROI(ROIAnalysis):
         if not self.quiet: print 'Plotting tsmap'
         return super(LandeROI,self).plot_tsmap(filename=filename,**kwargs)
 
-    @decorate_with(ROISignificance)
     def plot_significance(self,filename="significance.png",**kwargs):
+        """ Plot the significance map of the ROI (see uw.like.mapplots.ROISignificance). """
+        from uw.like.mapplots import ROISignificance
         if not self.quiet: print 'Plotting significance'
         ROISignificance(self,**kwargs).show(filename=filename)
 
@@ -556,6 +524,9 @@ class VerboseROI(LandeROI):
             * merges display of point + extended sources,
             * printing the direction of point sources
             * prints the (quick=True) TS of all components. """
+        from uw.like.pointspec_helpers import PointSource
+        from uw.like.roi_extended import ExtendedSource
+
         r=[]
         r.append('POINT+EXTENDED SOURCE FITS:')
 
@@ -7,7 +7,7 @@ from uw.like.Models import PowerLaw
 
 from lande.pysed import units
 
-from . basefit import BaseFitter
+from . basefit import BaseFitter, instrumented
 from . save import spectrum_to_dict
 from . specplot import SpectralAxes, SpectrumPlotter
 
@@ -33,6 +33,7 @@ class PowerLawApproximator(BaseFitter):
 
         self._calculate()
 
+    @instrumented
     def _calculate(self):
         self.results = dict()
 
@@ -1,25 +1,14 @@
 import traceback
 import sys
 
-import pylab as P
 import numpy as np
-import pyfits
 
-from skymaps import DiffuseFunction,IsotropicSpectrum,IsotropicPowerLaw,IsotropicConstant
-from pyLikelihood import ParameterVector, SpatialMap_cast, PointSource_cast
-import pyLikelihood
-
-from uw.like.Models import PowerLaw, FileFunction, CompositeModel
-from uw.like.pointspec_helpers import PointSource
-from uw.like.roi_extended import ExtendedSource
-from uw.like.roi_diffuse import DiffuseSource
-
-from FluxDensity import FluxDensity
+# N.B. pyLikelihood, pointlike, and matplotlib are imported
+# in the functions which use them, since they are slow to import.
 
 from lande.pysed import units
-from lande.utilities.tools import tolist
+from lande.utilities.tools import tolist, LazyDict
 from . tools import gtlike_or_pointlike
-from . specplot import SpectrumPlotter
 
 def gtlike_get_energies(like):
     kmin,kmax=like.logLike.klims()
@@ -38,6 +27,7 @@ def pointlike_spectrum_to_dict(model, errors=False):
     """ Package of a spectral model into a handy
         python dictionary.
 
+            >>> from uw.like.Models import PowerLaw
             >>> m=PowerLaw(norm=1, index=-.5)
             >>> d=spectrum_to_dict(m)
             >>> print d['Norm']
@@ -66,6 +56,8 @@ def pointlike_spectrum_to_dict(model, errors=False):
             >>> s['spectrum'][1] == spectrum_to_dict(lp)
             True
     """
+    from uw.like.Models import CompositeModel
+
     d = dict(name = model.name, method='pointlike')
     if isinstance(model,CompositeModel):
         d['spectrum'] = map(pointlike_spectrum_to_dict,model.models)
@@ -84,7 +76,8 @@ def pointlike_spectrum_to_dict(model, errors=False):
 def gtlike_spectrum_to_dict(spectrum, errors=False):
     """ Convert a pyLikelihood object to a python 
         dictionary which can be easily saved to a file. """
-    parameters=ParameterVector()
+    import pyLikelihood
+    parameters=pyLikelihood.ParameterVector()
     spectrum.getParams(parameters)
     d = dict(name = spectrum.genericName(), method='gtlike')
     for p in parameters: 
@@ -102,6 +95,7 @@ def gtlike_name_to_spectral_dict(like, name, errors=False, minos_errors=False, c
     spectrum = source.spectrum()
     d=gtlike_spectrum_to_dict(spectrum, errors)
     if minos_errors:
+        from pyLikelihood import ParameterVector
         parameters=ParameterVector()
         spectrum.getParams(parameters)
         for p in parameters: 
@@ -134,6 +128,7 @@ def pointlike_name_to_spectral_dict(roi, name, errors=False, covariance_matrix=F
 def gtlike_flux_dict(like,name, emin=None,emax=None,flux_units='erg', energy_units='MeV',
                      errors=True, include_prefactor=False, prefactor_energy=None):
     """ Note, emin, emax, and prefactor_energy must be in MeV """
+    from . specplot import SpectrumPlotter
 
     if emin is None and emax is None: 
         emin, emax = get_full_energy_range(like)
@@ -217,6 +212,11 @@ def gtlike_get_spatial_model_name(like, name):
         return type
 
 def pointlike_get_spatial_model_name(roi, name):
+    from skymaps import DiffuseFunction,IsotropicSpectrum,IsotropicPowerLaw,IsotropicConstant
+    from uw.like.pointspec_helpers import PointSource
+    from uw.like.roi_extended import ExtendedSource
+    from uw.like.roi_diffuse import DiffuseSource
+
     source = roi.get_source(name)
     if isinstance(source,PointSource):
         return 'SkyDirFunction'
@@ -238,6 +238,42 @@ def pointlike_get_spatial_model_name(roi, name):
 def get_spatial_model_name(*args, **kwargs):
     return gtlike_or_pointlike(gtlike_get_spatial_model_name, pointlike_get_spatial_model_name, *args, **kwargs)
 
+def gtlike_get_spatial_model_names(like):
+    """ Dictionary of the spatial model name of every source in the ROI.
+
+        N.B. This is not cached, since a source can be replaced by one
+        with the same name but a different spatial model, and finding
+        out whether that happened is as expensive as recomputing it. """
+    return dict((name,gtlike_get_spatial_model_name(like, name)) for name in like.sourceNames())
+
+def gtlike_source_model_key(like, name):
+    """ A hashable description of the model of source name: the
+        source type, the spectral and spatial model types, the position
+        of point sources and the spatial parameters (and template
+        file) of extended and diffuse sources. """
+    from pyLikelihood import PointSource_cast, SpatialMap_cast, ParameterVector
+
+    source = like.logLike.getSource(name)
+    spatial_model = gtlike_get_spatial_model_name(like, name)
+    key = [name, source.getType(), spatial_model, source.spectrum().genericName()]
+    if spatial_model == 'SkyDirFunction':
+        dir = PointSource_cast(source).getDir()
+        key += [dir.ra(), dir.dec()]
+    else:
+        spatial = source.getSrcFuncs()['SpatialDist']
+        parameters = ParameterVector()
+        spatial.getParams(parameters)
+        key += [(p.getName(), p.getValue(), p.getScale()) for p in parameters]
+        if spatial_model == 'SpatialMap':
+            key.append(SpatialMap_cast(spatial).fitsFile())
+    return tuple(key)
+
+def pointlike_get_spatial_model_names(roi):
+    return dict((name,pointlike_get_spatial_model_name(roi, name)) for name in pointlike_get_all_names(roi))
+
+def get_spatial_model_names(*args, **kwargs):
+    return gtlike_or_pointlike(gtlike_get_spatial_model_names, pointlike_get_spatial_model_names, *args, **kwargs)
+
 def pointlike_get_all_names(roi):
     """ Get a list of the names of all sources in the pointlike ROI. """
     return np.append(roi.psm.names,roi.dsm.names)
@@ -254,8 +290,9 @@ def get_sources(like_or_roi):
     """ Get a list of point-like and extended sources
         in the ROI. """
     all_names=get_all_names(like_or_roi)
+    spatial_models=get_spatial_model_names(like_or_roi)
     all_ps = [i for i in all_names \
-              if get_spatial_model_name(like_or_roi,i) in \
+              if spatial_models[i] in \
               ['SkyDirFunction','SpatialMap']]
     return all_ps
         
@@ -264,8 +301,9 @@ def get_background(like_or_roi):
     """ Get a list of the names of all background
         sources in the ROI. """
     all_names=get_all_names(like_or_roi)
+    spatial_models=get_spatial_model_names(like_or_roi)
     all_bg = [i for i in all_names \
-              if get_spatial_model_name(like_or_roi,i) in \
+              if spatial_models[i] in \
               ['ConstantValue','MapCubeFunction']]
     return all_bg
 
@@ -284,35 +322,95 @@ def gtlike_ts_dict(like, name, verbosity=True):
         noreoptimize=like.Ts(name,reoptimize=False, verbosity=verbosity)
         )
 
+def gtlike_state_key(like):
+    """ A hashable description of the current state of like: the
+        names and models of all of the sources (see gtlike_source_model_key),
+        all of the parameters, and the covariance matrix. """
+    covariance = getattr(like, 'covariance', None)
+    if covariance is not None: covariance = tuple(tuple(row) for row in covariance)
+    return (tuple(gtlike_source_model_key(like, name) for name in like.sourceNames()),
+            tuple((p.getName(), p.getValue(), p.getScale(), p.isFree()) for p in like.params()),
+            covariance)
+
+def gtlike_cache(like, key, func):
+    """ Return func(), but cache the value on like for as long
+        as the sources, parameters, and covariance matrix
+        of like do not change.
+        Useful for expensive quantities (TS, minos errors, ...)
+        which would otherwise be recomputed for the same fit. """
+    state = gtlike_state_key(like)
+    cache = getattr(like, '_state_cache', None)
+    if cache is None or cache[0] != state:
+        cache = like._state_cache = (state, dict())
+    if key not in cache[1]:
+        cache[1][key] = func()
+    return cache[1][key]
+
+source_dict_levels = ['parameters', 'fluxes', 'TS', 'errors']
+
 def gtlike_source_dict(like, name, emin=None, emax=None, 
                        flux_units='erg', energy_units='MeV', 
                        errors=True, minos_errors=False, covariance_matrix=True,
                        save_TS=True, add_diffuse_dict=True,
-                       verbosity=True):
+                       verbosity=True, levels=None, lazy=False):
+    """ Package up the results of a gtlike fit for source name.
+
+        levels is a list of which of source_dict_levels to compute:
+            'parameters' - logLikelihood, energy, and spectrum (always computed)
+            'fluxes'     - flux
+            'TS'         - TS (reoptimize and noreoptimize)
+            'errors'     - errors on the spectral parameters and fluxes. The minos_errors
+                           and covariance_matrix flags only apply when this level is requested.
+        By default, levels is picked from the errors and save_TS flags.
+
+        Each quantity is cached on like (see gtlike_cache), so
+        calling this function again before like is refit is cheap.
+
+        If lazy=True, return a LazyDict so that each quantity is only
+        computed when it is first accessed. Note that it is computed for
+        whatever the state of like is at that time.
+    """
+    if levels is None:
+        levels = ['parameters', 'fluxes']
+        if save_TS: levels.append('TS')
+        if errors: levels.append('errors')
+    else:
+        for level in levels:
+            if level not in source_dict_levels:
+                raise Exception("Unrecognized level %s. Must be one of %s" % (level, source_dict_levels))
+        errors = 'errors' in levels
+        minos_errors = minos_errors and errors
+        covariance_matrix = covariance_matrix and errors
 
     if emin is None and emax is None:
         emin, emax = get_full_energy_range(like)
 
-    d=dict(
-        logLikelihood=logLikelihood(like),
-    )
+    cache = lambda key, func: gtlike_cache(like, key, func)
 
-    d['energy'] = energy_dict(emin=emin, emax=emax, energy_units=energy_units)
-    
-    d['spectrum']= name_to_spectral_dict(like, name, errors=errors, 
-                                         minos_errors=minos_errors, covariance_matrix=covariance_matrix)
-
-    if save_TS:
-        d['TS']=gtlike_ts_dict(like, name, verbosity=verbosity)
+    funcs = dict(
+        logLikelihood=lambda: logLikelihood(like),
+        energy=lambda: energy_dict(emin=emin, emax=emax, energy_units=energy_units),
+        spectrum=lambda: cache(('spectrum', name, errors, minos_errors, covariance_matrix),
+                               lambda: name_to_spectral_dict(like, name, errors=errors, 
+                                                             minos_errors=minos_errors, 
+                                                             covariance_matrix=covariance_matrix)),
+    )
 
-    d['flux']=flux_dict(like,name,
-                        emin=emin, emax=emax,
-                        flux_units=flux_units, energy_units=energy_units, errors=errors)
+    if 'TS' in levels:
+        funcs['TS']=lambda: cache(('TS', name), lambda: gtlike_ts_dict(like, name, verbosity=verbosity))
 
+    if 'fluxes' in levels:
+        funcs['flux']=lambda: cache(('flux', name, emin, emax, flux_units, energy_units, errors),
+                                    lambda: flux_dict(like,name,
+                                                      emin=emin, emax=emax,
+                                                      flux_units=flux_units, energy_units=energy_units, 
+                                                      errors=errors))
 
     if add_diffuse_dict:
-        d['diffuse'] = diffuse_dict(like)
+        funcs['diffuse']=lambda: cache(('diffuse',), lambda: diffuse_dict(like))
 
+    d = LazyDict(**funcs)
+    if lazy: return d
     return tolist(d)
 
 def source_dict(*args, **kwargs):
@@ -356,6 +454,8 @@ def pointlike_flux_dict(roi, which, emin=None, emax=None, *args, **kwargs):
     return tolist(pointlike_model_to_flux(model, emin, emax, *args, **kwargs))
 
 def pointlike_powerlaw_prefactor_dict(roi, which, flux_units='erg', errors=True):
+    from uw.like.Models import PowerLaw
+
     model=roi.get_model(which)
 
     assert isinstance(model,PowerLaw)
@@ -428,6 +528,8 @@ def pointlike_source_dict(roi, name, emin=None, emax=None,
     return tolist(d)
 
 def spatial_model_to_dict(source, roi, errors=True):
+    from uw.like.roi_extended import ExtendedSource
+
     f = dict()
     if isinstance(source,ExtendedSource):
         # Extended Source parameters
@@ -458,6 +560,7 @@ def ts_dict(*args, **kwargs):
 def spectrum_to_dict(*args, **kwargs):
     """ Test out FileFunction
 
+            >>> from uw.like.Models import PowerLaw, FileFunction
             >>> pl= PowerLaw()
             >>> from tempfile import NamedTemporaryFile
             >>> tempfile = NamedTemporaryFile()
@@ -511,6 +614,9 @@ def get_roi_dir(*args, **kwargs):
 
 def gtlike_get_skydir(like, name):
     """ Get the skydir for a gtlike point or extended source. """
+    from pyLikelihood import SpatialMap_cast, PointSource_cast
+    import pyfits
+
     if not name in get_sources(like):
         raise Exception("Unable to get skydir because %s is not a point or extended source." % name)
 
@@ -534,6 +640,9 @@ def gtlike_get_skydir(like, name):
         return spatial_map.wcsmap().skyDir(crpix1,crpix2)
 
 def pointlike_get_skydir(roi, name):
+    from uw.like.pointspec_helpers import PointSource
+    from uw.like.roi_extended import ExtendedSource
+
     source = roi.get_source(name)
     if not isinstance(source,PointSource) and not isinstance(source,ExtendedSource):
         raise Exception("Unable to get skydir because %s is not a point or extended source." % name)
@@ -553,6 +662,8 @@ def gtlike_get_covariance_matrix(like, name):
         for all parameters, and set the covariance to 0
         when the parameter is free.
     """
+    from pyLikelihood import ParameterVector
+    from FluxDensity import FluxDensity
 
     source = like.logLike.getSource(name)
     spectrum = source.spectrum()
@@ -13,7 +13,6 @@ from uw.utilities import keyword_options
 from uw.like.Models import Model
 
 from lande.pysed import units
-from lande.pysed.helper import logspace_units
 
 from . load import dict_to_spectrum
 
@@ -53,10 +52,24 @@ class SpectralAxes(HostAxes):
         self.plot(energies, e2_dnde, **kwargs)
 
     def convert_points_mev(self, energies_mev, dnde_mev):
+        """ Convert energies (in MeV) and dN/dE (in ph/cm^2/s/MeV) to the
+            energy and E^2 dN/dE units of the axes. 
+            
+            Same as convert_points, but scales by a conversion factor
+            which avoids slow elementwise sympy arithmetic. """
+        energy_factor = float(units.MeV/self.energy_units_obj)
+        e2_dnde_factor = float(units.MeV/self.flux_units_obj)
+
+        energies_mev = np.asarray(energies_mev, dtype=float)
+        energies = energies_mev*energy_factor
+        e2_dnde = np.asarray(dnde_mev, dtype=float)*energies_mev**2*e2_dnde_factor
+        return energies, e2_dnde
 
-        # (a) convert to acutal units. gtlike spectra take energy in MeV, return flux in ph/cm^2/s/MeV
-        return self.convert_points(units.tosympy(energies_mev,units.MeV),
-                                   units.tosympy(dnde_mev,units.ph/units.cm**2/units.s/units.MeV))
+    def get_xlim_mev(self):
+        """ x limits of the axes, in MeV. """
+        emin, emax=self.get_xlim()
+        energy_factor = float(self.energy_units_obj/units.MeV)
+        return emin*energy_factor, emax*energy_factor
 
     def convert_energies(self, energies):
         return units.tonumpy(energies,self.energy_units_obj)
@@ -108,7 +121,8 @@ class SpectrumPlotter(object):
     def get_dnde_mev_gtlike(spectrum,energies):
         """ Returns the spectrum in units of ph/cm^2/s/MeV. """
         if isinstance(energies, collections.Iterable):
-            return np.asarray([SpectrumPlotter.get_dnde_mev_gtlike(spectrum,i) for i in energies])
+            dArg = pyLikelihood.dArg
+            return np.fromiter((spectrum(dArg(i)) for i in energies), dtype=float)
         return spectrum(pyLikelihood.dArg(energies))
 
     @staticmethod
@@ -116,51 +130,84 @@ class SpectrumPlotter(object):
         return spectrum(energies)
 
     @staticmethod
-    def get_dnde_error_mev_gtlike(spectrum,covariance_matrix,energies):
-        """ asume energy in mev and return flux in units of ph/cm**2/s/MeV. """
+    def get_dnde_and_gradient_mev_gtlike(spectrum,energies):
+        """ Evaluate the spectrum and its derivative with respect to each 
+            of its parameters at all energies in one pass.
+
+            Returns dnde (in ph/cm^2/s/MeV) and the gradient matrix 
+            (with shape len(energies) x number of parameters). The
+            derivatives are with respect to the true (unscaled) parameter
+            values, in the order of spectrum.getParamNames. """
         from . models import gtlike_unscale_all_parameters
         spectrum = gtlike_unscale_all_parameters(spectrum)
 
-        dnde_err = np.empty_like(energies)
-        for i,energy in enumerate(energies):
+        # method taken from pyLikelihood.FluxDensity
+        srcpars = pyLikelihood.StringVector()
+        spectrum.getParamNames(srcpars)
+        srcpars = list(srcpars)
 
-            # method taken from pyLikelihood.FluxDensity
-            srcpars = pyLikelihood.StringVector()
-            spectrum.getParamNames(srcpars)
-            arg = pyLikelihood.dArg(energy)
-            partials = np.array([spectrum.derivByParam(arg, x) for x in srcpars])
-            dnde_err[i] = np.sqrt(np.dot(partials, np.dot(covariance_matrix, partials)))
-        return dnde_err
+        args = [pyLikelihood.dArg(energy) for energy in energies]
+        dnde = np.asarray([spectrum(arg) for arg in args], dtype=float)
+        gradient = np.asarray([[spectrum.derivByParam(arg, x) for x in srcpars] for arg in args], dtype=float)
+        return dnde, gradient.reshape((len(args),len(srcpars)))
 
     @staticmethod
-    def get_dnde_error_mev_pointlike(model,covariance_matrix,energies):
-        dnde_err = np.empty_like(energies)
-        for i,energy in enumerate(energies):
-            partials = model.external_gradient(energy)
-            dnde_err[i] = np.sqrt(np.dot(partials, np.dot(covariance_matrix, partials)))
-        return dnde_err
+    def get_dnde_and_gradient_mev_pointlike(model,energies):
+        energies = np.asarray(energies, dtype=float)
+        gradient = np.asarray(model.external_gradient(energies), dtype=float)
+        return model(energies), gradient.reshape((-1,len(energies))).T
 
     @staticmethod
-    def get_dnde_error_mev(spectrum, covariance_matrix, energies):
+    def get_dnde_and_gradient_mev(spectrum,energies):
         if isinstance(spectrum,pyLikelihood.Function):
-            return SpectrumPlotter.get_dnde_error_mev_gtlike(spectrum, covariance_matrix, energies)
+            return SpectrumPlotter.get_dnde_and_gradient_mev_gtlike(spectrum, energies)
         elif isinstance(spectrum,Model):
-            return SpectrumPlotter.get_dnde_error_mev_pointlike(spectrum, covariance_matrix, energies)
+            return SpectrumPlotter.get_dnde_and_gradient_mev_pointlike(spectrum, energies)
         elif isinstance(spectrum,dict):
-            return SpectrumPlotter.get_dnde_error_mev(dict_to_spectrum(spectrum), covariance_matrix, energies)
+            return SpectrumPlotter.get_dnde_and_gradient_mev(dict_to_spectrum(spectrum), energies)
         else:
             raise SEDException("Unrecognized type %s for spectrum." % type(spectrum))
 
-    def plot(self, spectrum, emin=None, emax=None, npts=100, autoscale=None, **kwargs):
+    @staticmethod
+    def propagate_errors(gradient, covariance_matrix):
+        """ Propagate the covariance matrix to each energy:
+                sigma_i^2 = sum_jk gradient_ij C_jk gradient_ik """
+        gradient = np.asarray(gradient, dtype=float)
+        covariance_matrix = np.asarray(covariance_matrix, dtype=float)
+        return np.sqrt(np.sum(np.dot(gradient, covariance_matrix)*gradient, axis=1))
+
+    @staticmethod
+    def get_dnde_and_error_mev(spectrum,covariance_matrix,energies):
+        """ asume energy in mev and return dN/dE and its error 
+            in units of ph/cm**2/s/MeV. """
+        dnde, gradient = SpectrumPlotter.get_dnde_and_gradient_mev(spectrum, energies)
+        return dnde, SpectrumPlotter.propagate_errors(gradient, covariance_matrix)
 
+    @staticmethod
+    def get_dnde_error_mev_gtlike(spectrum,covariance_matrix,energies):
+        """ asume energy in mev and return flux in units of ph/cm**2/s/MeV. """
+        return SpectrumPlotter.get_dnde_and_error_mev(spectrum, covariance_matrix, energies)[1]
+
+    @staticmethod
+    def get_dnde_error_mev_pointlike(model,covariance_matrix,energies):
+        return SpectrumPlotter.get_dnde_and_error_mev(model, covariance_matrix, energies)[1]
+
+    @staticmethod
+    def get_dnde_error_mev(spectrum, covariance_matrix, energies):
+        return SpectrumPlotter.get_dnde_and_error_mev(spectrum, covariance_matrix, energies)[1]
+
+    def _get_energies_mev(self, emin, emax, npts):
         if emin is None and emax is None:
-            emin, emax=self.axes.get_xlim()
-            emin = emin*self.axes.energy_units_obj
-            emax = emax*self.axes.energy_units_obj
+            emin, emax=self.axes.get_xlim_mev()
+        else:
+            emin, emax=units.tonumpy(emin,units.MeV), units.tonumpy(emax,units.MeV)
+        return np.logspace(np.log10(emin), np.log10(emax), npts)
 
-        energies = logspace_units(emin, emax, npts)
-        dnde = self.get_dnde(spectrum, energies)
-        energies, e2_dnde = self.axes.convert_points(energies, dnde)
+    def plot(self, spectrum, emin=None, emax=None, npts=100, autoscale=None, **kwargs):
+
+        energies_mev = self._get_energies_mev(emin, emax, npts)
+        dnde = self.get_dnde_mev(spectrum, energies_mev)
+        energies, e2_dnde = self.axes.convert_points_mev(energies_mev, dnde)
 
         if autoscale is not None:
             old_autoscale=self.axes.get_autoscale_on()
@@ -175,16 +222,10 @@ class SpectrumPlotter(object):
 
         if covariance_matrix is None: covariance_matrix = spectrum['covariance_matrix']
 
-        if emin is None and emax is None:
-            emin, emax=self.axes.get_xlim()
-            emin = emin*self.axes.energy_units_obj
-            emax = emax*self.axes.energy_units_obj
-
-        energies_units = logspace_units(emin, emax, npts)
-        dnde = self.get_dnde(spectrum, energies_units)
-        dnde_error = self.get_dnde_error(spectrum, covariance_matrix,energies_units)
-        energies, e2_dnde = self.axes.convert_points(energies_units, dnde)
-        energies, e2_dnde_error = self.axes.convert_points(energies_units, dnde_error)
+        energies_mev = self._get_energies_mev(emin, emax, npts)
+        dnde, dnde_error = self.get_dnde_and_error_mev(spectrum, covariance_matrix, energies_mev)
+        energies, e2_dnde = self.axes.convert_points_mev(energies_mev, dnde)
+        energies, e2_dnde_error = self.axes.convert_points_mev(energies_mev, dnde_error)
         
         # clip very small values, problems with log scale otherwise
         low=e2_dnde-e2_dnde_error
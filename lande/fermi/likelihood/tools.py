@@ -1,8 +1,5 @@
 """ This file contains various function which I have found useful. """
 
-from uw.like.roi_analysis import ROIAnalysis
-from uw.like.Models import Model
-
 from SED import SED
 
 
@@ -23,6 +20,8 @@ def gtlike_or_pointlike(f_gtlike, f_pointlike, *args, **kwargs):
 
 
     from pyLikelihood import Function
+    from uw.like.roi_analysis import ROIAnalysis
+    from uw.like.Models import Model
     from BinnedAnalysis import BinnedAnalysis
     from UnbinnedAnalysis import UnbinnedAnalysis
 
@@ -39,7 +39,7 @@ from . save import flux_dict, diffuse_dict, get_background, get_sources, source_
 from . limits import GtlikeUpperLimit, PointlikeUpperLimit
 from . fit import allow_fit_only_prefactor
 from . superstate import SuperState
-from . basefit import BaseFitter
+from . basefit import BaseFitter, instrumented
 from . printing import summary
 
 from lande.fermi.data.livetime import pointlike_ltcube
@@ -145,6 +145,7 @@ class CombinedVariabilityTester(VariabilityTester):
         ("refit_background",      True, """ Fit the background sources in each energy bin."""),
         ("refit_other_sources",   True, """ Fit other sources in each energy bin. """),
         ("use_pointlike_ltcube", False, """ Make the ltcubes with pointlike. """),
+        ("ltcube_cachedir",       None, """ Cache the pointlike ltcubes in this directory. """),
         ("nbins",                 None, """ Specify the number of time bins (the time range is
                                             taken from the ft1 file)"""),
         ("tstarts",               None, """ Specify an array of start times. """),
@@ -378,6 +379,7 @@ class CombinedVariabilityTester(VariabilityTester):
 
         return results
 
+    @instrumented
     def _test_variability(self):
         roi = self.roi
 
@@ -403,7 +405,8 @@ class CombinedVariabilityTester(VariabilityTester):
 
             self.bands.append(band)
 
-            smaller_roi = CombinedVariabilityTester.time_cut(roi, tstart, tstop, subdir, self.use_pointlike_ltcube, self.verbosity)
+            smaller_roi = CombinedVariabilityTester.time_cut(roi, tstart, tstop, subdir, self.use_pointlike_ltcube, self.verbosity,
+                                                             ltcube_cachedir=self.ltcube_cachedir)
 
             band['pointlike'] = self.each_time_fit_pointlike(smaller_roi, tstart, tstop)
             if self.do_gtlike:
@@ -464,7 +467,7 @@ class CombinedVariabilityTester(VariabilityTester):
         return tmin, tmax
 
     @staticmethod
-    def time_cut(roi, tstart, tstop, subdir, use_pointlike_ltcube, verbosity):
+    def time_cut(roi, tstart, tstop, subdir, use_pointlike_ltcube, verbosity, ltcube_cachedir=None):
         """ Create a new ROI given a time cut. """
 
         sa = roi.sa
@@ -526,7 +529,8 @@ class CombinedVariabilityTester(VariabilityTester):
                                  binsz=1,
                                  zmax=roi.sa.zenithcut,
                                  cone_angle=roi.sa.exp_radius,
-                                 dir=roi.roi_dir)
+                                 dir=roi.roi_dir,
+                                 cachedir=ltcube_cachedir)
             else:
                 gtltcube=GtApp('gtltcube', 'Likelihood')
                 gtltcube.run(evfile=cut_evfile,
@@ -4,7 +4,7 @@ import os
 
 from uw.like.roi_state import PointlikeState
 
-from lande.fermi.likelihood.fit import fit_prefactor, fit_only_source
+from lande.fermi.likelihood.fit import fit_prefactor, fit_only_source, pointlike_fit
 from lande.fermi.likelihood.save import source_dict, get_full_energy_range
 from lande.fermi.likelihood.limits import PointlikePowerLawUpperLimit
 
@@ -27,7 +27,7 @@ def pointlike_analysis(pipeline, roi, name, hypothesis,
             if just_prefactor:
                 fit_prefactor(roi, name) 
             else:
-                roi.fit(fit_bg_first=fit_bg_first)
+                pointlike_fit(roi, fit_bg_first=fit_bg_first)
         except Exception, ex:
             print 'ERROR spectral fitting pointlike for hypothesis %s:' % hypothesis, ex
             traceback.print_exc(file=sys.stdout)
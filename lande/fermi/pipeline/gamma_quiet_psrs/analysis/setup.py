@@ -3,9 +3,10 @@ import numpy as np
 
 from uw.like.pointspec import SpectralAnalysis,DataSpecification
 from uw.like.pointspec_helpers import get_default_diffuse, PointSource
-from uw.like.roi_catalogs import Catalog2FGL
 from uw.like.Models import PowerLaw
 
+from lande.fermi.likelihood.catalogs import StoreCatalog2FGL
+
 class RadioPSRROIBuilder(object):
     def __init__(self, radiopsr_loader):
         self.radiopsr_loader = radiopsr_loader
@@ -24,12 +25,12 @@ class RadioPSRROIBuilder(object):
             max_free=5
             free_radius=5
 
-        catalog = Catalog2FGL('$FERMI/catalogs/gll_psc_v05.fit', 
-                              latextdir='$FERMI/extended_archives/gll_psc_v05_templates',
-                              prune_radius=0,
-                              max_free=max_free,
-                              free_radius=free_radius,
-                              limit_parameters=True)
+        catalog = StoreCatalog2FGL('$FERMI/catalogs/gll_psc_v05.fit', 
+                                   latextdir='$FERMI/extended_archives/gll_psc_v05_templates',
+                                   prune_radius=0,
+                                   max_free=max_free,
+                                   free_radius=free_radius,
+                                   limit_parameters=True)
 
         ft1 = self.radiopsr_loader.get_ft1(name)
         ft2 = self.radiopsr_loader.get_ft2(name)
@@ -4,7 +4,7 @@ import os
 
 from uw.like.roi_state import PointlikeState
 
-from lande.fermi.likelihood.fit import fit_prefactor, fit_only_source
+from lande.fermi.likelihood.fit import fit_prefactor, fit_only_source, pointlike_fit
 from lande.fermi.likelihood.save import source_dict, get_full_energy_range
 from lande.fermi.likelihood.limits import PointlikePowerLawUpperLimit, PointlikeCutoffUpperLimit
 
@@ -40,11 +40,11 @@ def pointlike_analysis(roi, name, hypothesis, max_free,
             elif just_source:
                 fit_only_source(roi, name)
             elif fit_bg_first:
-                roi.fit(fit_bg_first=True)
+                pointlike_fit(roi, fit_bg_first=True)
             else:
-                roi.fit()
+                pointlike_fit(roi)
                 # For some reason, one final fit seems to help with convergence and not getting negative TS values *shurgs*
-                roi.fit() 
+                pointlike_fit(roi)
         except Exception, ex:
             print 'ERROR spectral fitting pointlike for hypothesis %s:' % hypothesis, ex
             traceback.print_exc(file=sys.stdout)
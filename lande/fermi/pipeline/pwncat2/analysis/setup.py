@@ -15,7 +15,6 @@ from skymaps import SkyDir
 from uw.like.pointspec import SpectralAnalysis,DataSpecification
 from uw.like.pointspec_helpers import get_default_diffuse, PointSource
 from uw.like.SpatialModels import Gaussian
-from uw.like.roi_catalogs import Catalog2FGL
 from uw.like.roi_extended import ExtendedSource
 from uw.like.roi_save import load
 from uw.like.Models import PowerLaw
@@ -23,6 +22,8 @@ from uw.utilities import phasetools
 from uw.pulsar.phase_range import PhaseRange
 from uw.utilities.parmap import LogMapper,LimitMapper
 
+from lande.fermi.likelihood.catalogs import StoreCatalog2FGL
+
 isnum = lambda x: isinstance(x, numbers.Real)
 
 
@@ -117,11 +118,11 @@ class PWNRegion(object):
 
     @staticmethod
     def get_catalog(**kwargs):
-        return Catalog2FGL('$FERMI/catalogs/gll_psc_v05.fit', 
-                           latextdir='$FERMI/extended_archives/gll_psc_v05_templates',
-                           prune_radius=0,
-                           limit_parameters=True,
-                           **kwargs)
+        return StoreCatalog2FGL('$FERMI/catalogs/gll_psc_v05.fit', 
+                                latextdir='$FERMI/extended_archives/gll_psc_v05_templates',
+                                prune_radius=0,
+                                limit_parameters=True,
+                                **kwargs)
 
     @staticmethod
     def phase_ltcube(ltcube,phase,savedir):
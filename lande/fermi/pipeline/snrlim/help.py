@@ -1,6 +1,6 @@
 from lande.fermi.likelihood.save import sourcedict
 from lande.fermi.likelihood.printing import print_summary
-from lande.fermi.likelihood.fit import paranoid_gtlike_fit, fit_prefactor
+from lande.fermi.likelihood.fit import paranoid_gtlike_fit, fit_prefactor, pointlike_fit
 from lande.fermi.likelihood.limits import powerlaw_upper_limit
 
 def pointlike_counts(roi, name, plotdir,size):
@@ -28,7 +28,7 @@ def pointlike_analysis(roi, name, plotdir):
 
     print_summary()
     fit_prefactor(roi, name) 
-    roi.fit()
+    pointlike_fit(roi)
     print_summary()
 
     results  = sourcedict(roi, name)
@@ -4,12 +4,12 @@ import math
 from skymaps import SkyDir
 from uw.like.pointspec import DataSpecification, SpectralAnalysis
 from uw.like.pointspec_helpers import get_default_diffuse
-from uw.like.roi_catalogs import Catalog2FGL
 from uw.like.roi_extended import ExtendedSource
 from uw.like.SpatialModels import Disk
 from uw.like.Models import PowerLaw
  
 from lande.utilities.save import loaddict
+from lande.fermi.likelihood.catalogs import StoreCatalog2FGL
 
 from . import data
 
@@ -41,7 +41,7 @@ def build_roi(name, snrdata, latdata):
 
     diffuse_sources = get_default_diffuse(**latdata['diffuse'])
 
-    catalog = Catalog2FGL(**latdata['catalog'])
+    catalog = StoreCatalog2FGL(**latdata['catalog'])
 
     roi=sa.roi(point_sources=[],
                diffuse_sources=diffuse_sources,
@@ -0,0 +1,267 @@
+""" Bayesian Blocks (Scargle et al 2013, ApJ 764, 167) in numpy.
+
+    The data is divided into cells (one per event, one per bin,
+    or one per measurement) and the optimal partition of the cells
+    into blocks is found with the O(N^2) dynamic program of Scargle.
+
+    Each cell is described by two numbers (x,y) whose sums over
+    the cells in a block determine the fitness of the block:
+
+        * 'events': x = number of events, y = length of the cell.
+          This is the fitness function for unbinned events
+          and for binned counts.
+        * 'measures': x = 1/(2 sigma^2), y = value/sigma^2
+          for point measurements with gaussian errors.
+
+    periodic_blocks runs the algorithm on data which is periodic (like pulsar
+    phases), where a block can wrap around from the end back to the start.
+"""
+import warnings
+
+import numpy as np
+
+def events_fitness(counts, lengths):
+    """ Log likelihood of a block with a constant rate (eq. 19):
+
+            >>> print '%.3f' % events_fitness(10, 0.5)
+            29.957
+            >>> events_fitness(np.asarray([0., 1.]), np.asarray([0.5, 1.])).tolist()
+            [0.0, 0.0]
+    """
+    counts = np.asarray(counts, dtype=float)
+    return np.where(counts > 0, counts*(np.log(np.where(counts > 0, counts, 1)) - np.log(lengths)), 0)
+
+def measures_fitness(a, b):
+    """ Log likelihood of a block of gaussian point measurements (eq. 41),
+        where a = sum(1/(2 sigma^2)) and b = sum(value/sigma^2). """
+    return b**2/(4*a)
+
+fitness_functions = dict(events=events_fitness, measures=measures_fitness)
+
+
+def events_height(counts, lengths):
+    return counts/lengths
+
+def measures_height(a, b):
+    return b/(2*a)
+
+height_functions = dict(events=events_height, measures=measures_height)
+
+
+class FitnessCache(object):
+    """ The fitness of every possible block of a set of cells on a circle.
+
+        The fitness of a block does not depend on ncp_prior, so
+        the cache can be reused when running Bayesian Blocks on
+        the same cells with many different ncp_priors. The fitnesses
+        are stored as one (start cell x block length) matrix which is
+        shared by every way of cutting open the circle. Since this
+        takes N^2 memory, the matrix is only kept when it has
+        at most max_size elements (by default, 32 MB). """
+
+    def __init__(self, x, y, fitness='events', max_size=4*10**6):
+        self.x, self.y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        self.fitness = fitness
+        self.enabled = len(self.x)**2 <= max_size
+        self._matrix = None
+
+    def matrix(self):
+        """ matrix[i,l] is the fitness of the block of
+            cells i,i+1,...,i+l (wrapping around). """
+        if not self.enabled: return None
+        if self._matrix is None:
+            self._matrix = fitness_matrix(self.x, self.y, self.fitness)
+        return self._matrix
+
+    def rows(self, anchor=0):
+        """ rows[r][k] is the fitness of the block of cells [k,r]
+            after rolling the cells to start at anchor. """
+        matrix = self.matrix()
+        if matrix is None: return None
+        return _AnchoredRows(matrix, anchor)
+
+
+class _AnchoredRows(object):
+    def __init__(self, matrix, anchor):
+        self.matrix, self.anchor = matrix, anchor
+
+    def __getitem__(self, r):
+        k = np.arange(r+1)
+        return self.matrix[(self.anchor + k) % len(self.matrix), r - k]
+
+
+def fitness_matrix(x, y, fitness='events'):
+    """ The fitness of the block of cells i,i+1,...,i+l
+        (wrapping around) for every start i and length l+1. """
+    f = fitness_functions[fitness]
+    n = len(x)
+    cx = np.append(0, np.cumsum(np.tile(x, 2), dtype=float))
+    cy = np.append(0, np.cumsum(np.tile(y, 2), dtype=float))
+    starts = np.arange(n).reshape(n,1)
+    stops = starts + np.arange(1,n+1).reshape(1,n)
+    return f(cx[stops] - cx[starts], cy[stops] - cy[starts])
+
+def periodic_fitness(x, y, starts, ncp_prior, fitness='events'):
+    """ Total fitness of the periodic blocks beginning at each cell in starts. """
+    f = fitness_functions[fitness]
+    n = len(x)
+    stops = list(starts[1:]) + [starts[0] + n]
+    x, y = np.tile(x, 2), np.tile(y, 2)
+    return sum(f(x[a:b].sum(), y[a:b].sum()) - ncp_prior for a,b in zip(starts, stops))
+
+
+def linear_blocks(x, y, ncp_prior, fitness='events', rows=None):
+    """ Find the optimal partition of the cells into blocks.
+
+        Returns the index of the first cell of each block
+        and the total fitness of the partition.
+
+        rows are the (optional) precomputed block fitnesses
+        from FitnessCache.rows.
+
+            >>> x, y = np.ones(40), np.append(np.ones(20), 0.1*np.ones(20))
+            >>> starts, total = linear_blocks(x, y, ncp_prior=4)
+            >>> starts
+            [0, 20]
+            >>> linear_blocks(np.ones(40), np.ones(40), ncp_prior=4)[0]
+            [0]
+    """
+    f = fitness_functions[fitness]
+    n = len(x)
+    cx = np.append(0, np.cumsum(x, dtype=float))
+    cy = np.append(0, np.cumsum(y, dtype=float))
+
+    best = np.empty(n)
+    last = np.empty(n, dtype=int)
+    for r in range(n):
+        # fitness of all the blocks [k,r] for k = 0,...,r
+        if rows is None:
+            fit = f(cx[r+1] - cx[:r+1], cy[r+1] - cy[:r+1]) - ncp_prior
+        else:
+            fit = rows[r] - ncp_prior
+        fit[1:] += best[:r]
+        last[r] = np.argmax(fit)
+        best[r] = fit[last[r]]
+
+    starts = []
+    r = n
+    while r > 0:
+        r = last[r-1]
+        starts.append(r)
+    return starts[::-1], best[-1]
+
+def periodic_blocks(x, y, ncp_prior, fitness='events', cache=None,
+                    max_exact_cells=500, max_iterations=10):
+    """ Same as linear_blocks, but the cells are on a circle so that
+        the last block can wrap around to include the first cells.
+
+        Every partition of the circle has a block boundary somewhere,
+        so the optimal partition is the best linear partition of the
+        circle cut open at any of the N cells. For up to max_exact_cells
+        cells, this is found exactly by running the dynamic program
+        for all N ways of cutting the circle at once (O(N^3) work,
+        but only N vectorized steps).
+
+        For more cells, this is too slow and a local search is used instead:
+        the circle is cut open at a block boundary of the previous solution
+        (starting from a cut at cell 0) until the blocks stop changing.
+        Each step can only improve the total fitness, but the result is
+        not guaranteed to be the optimal partition of the circle, so a
+        warning is raised whenever the local search is used.
+
+        Returns the sorted index of the first cell of each block. If
+        there is only one block, it covers the whole circle.
+
+        cache is an optional FitnessCache of the same cells.
+
+            >>> y = np.ones(40)
+            >>> y[35:] = y[:5] = 0.1
+            >>> periodic_blocks(np.ones(40), y, ncp_prior=4)
+            [5, 35]
+            >>> periodic_blocks(np.ones(40), y, ncp_prior=4, max_exact_cells=0)
+            [5, 35]
+            >>> cache = FitnessCache(np.ones(40), y)
+            >>> periodic_blocks(np.ones(40), y, ncp_prior=4, cache=cache)
+            [5, 35]
+
+        The exact solution is as good as the best cut of the circle:
+
+            >>> np.random.seed(1)
+            >>> x = np.random.poisson(np.where(np.arange(60) % 30 < 8, 20, 5)).astype(float)
+            >>> y = np.ones(60)/60.
+            >>> starts = periodic_blocks(x, y, ncp_prior=4)
+            >>> brute = max(linear_blocks(np.roll(x,-a), np.roll(y,-a), ncp_prior=4)[1] for a in range(60))
+            >>> np.allclose(periodic_fitness(x, y, starts, ncp_prior=4), brute)
+            True
+
+        and it agrees with the change points in the middle copy of
+        the old method (tripling the data and running linear blocks):
+
+            >>> starts
+            [0, 8, 30, 38]
+            >>> s, total = linear_blocks(np.tile(x, 3), np.tile(y, 3), ncp_prior=4)
+            >>> sorted(i - 60 for i in s if 60 <= i < 120)
+            [0, 8, 30, 38]
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    n = len(x)
+
+    if n <= max_exact_cells:
+        matrix = cache.matrix() if cache is not None else None
+        if matrix is None: matrix = fitness_matrix(x, y, fitness)
+        return _exact_periodic_blocks(matrix, ncp_prior)
+
+    warnings.warn("%s cells is more than max_exact_cells=%s, so the periodic blocks are "
+                  "found by a local search and may not be optimal." % (n, max_exact_cells))
+
+    anchor, starts = 0, None
+    for i in range(max_iterations):
+        order = np.roll(np.arange(n), -anchor)
+        rows = cache.rows(anchor) if cache is not None else None
+        s, total = linear_blocks(x[order], y[order], ncp_prior, fitness, rows=rows)
+        new = sorted((anchor + j) % n for j in s)
+        if new == starts or len(new) == 1:
+            starts = new
+            break
+        starts = new
+        # Re-anchor at the boundary farthest from the current anchor
+        distance = [min((j-anchor) % n, (anchor-j) % n) for j in starts]
+        anchor = starts[np.argmax(distance)]
+    return starts
+
+def _exact_periodic_blocks(matrix, ncp_prior):
+    """ Run the linear dynamic program for the circle
+        cut open at every cell simultaneously. """
+    n = len(matrix)
+    anchors = np.arange(n).reshape(n,1)
+
+    best = np.empty((n,n))
+    last = np.empty((n,n), dtype=int)
+    for r in range(n):
+        k = np.arange(r+1).reshape(1,r+1)
+        fit = matrix[(anchors + k) % n, r - k] - ncp_prior
+        fit[:,1:] += best[:,:r]
+        last[:,r] = np.argmax(fit, axis=1)
+        best[:,r] = fit[np.arange(n), last[:,r]]
+
+    anchor = np.argmax(best[:,-1])
+    starts = []
+    r = n
+    while r > 0:
+        r = last[anchor,r-1]
+        starts.append((anchor + r) % n)
+    return sorted(starts)
+
+def block_heights(x, y, starts, fitness='events'):
+    """ Height (rate or mean value) of the blocks starting at
+        each cell in starts, where the last block wraps around. """
+    h = height_functions[fitness]
+    n = len(x)
+    stops = starts[1:] + [starts[0] + n]
+    x, y = np.tile(x, 2), np.tile(y, 2)
+    return np.asarray([h(x[a:b].sum(), y[a:b].sum()) for a,b in zip(starts, stops)])
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
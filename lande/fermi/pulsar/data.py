@@ -1,4 +1,7 @@
-from os.path import expandvars
+import os
+import hashlib
+from os.path import expandvars, exists, join, getmtime, getsize
+from tempfile import NamedTemporaryFile
 
 import pylab as P
 import numpy as np
@@ -7,23 +10,73 @@ from uw.utilities.fitstools import rad_extract
 from uw.utilities.decorators import memoize
 from uw.pulsar.phase_range import PhaseRange
 
+from lande.utilities.files import file_hash
+
+# Directory to store extracted phases in so that they can be shared
+# between processes. Set to None to only cache phases in memory.
+phase_cachedir = os.environ.get('PHASE_CACHE_DIR', None)
+
+phase_columns = [('PULSE_PHASE', np.float64), ('TIME', np.float64),
+                 ('ENERGY', np.float64), ('DIFFERENCES', np.float64)]
+
+_ft1_hashes = dict()
+
+def phase_cache_key(ft1, skydir, radius=180):
+    """ A key which uniquely identifies the photons extracted from ft1.
+
+        The pulsar ephemeris enters through the PULSE_PHASE
+        column of the ft1 file, so it is covered by the
+        hash of the file's content. """
+    ft1 = expandvars(ft1)
+    # only hash each (unchanged) file once per process
+    id = (os.path.abspath(ft1), getsize(ft1), getmtime(ft1))
+    if id not in _ft1_hashes: _ft1_hashes[id] = file_hash(ft1)
+
+    key = (_ft1_hashes[id], skydir.ra(), skydir.dec(), radius, phase_columns)
+    return hashlib.sha1(repr(key)).hexdigest()
+
+def _extract_phases(ft1, skydir, radius):
+    ed = rad_extract(expandvars(ft1),skydir,radius_function=radius,return_cols=['PULSE_PHASE', 'TIME'])
+    data = np.empty(len(ed['TIME']), dtype=phase_columns)
+    for name,dtype in phase_columns:
+        data[name] = ed[name]
+    return data
+
 @memoize
-def get_all_phases(ft1, skydir):
-    """ Cache photons = faster """
-    ed = rad_extract(expandvars(ft1),skydir,radius_function=180,return_cols=['PULSE_PHASE', 'TIME'])
-    return ed
+def get_all_phases(ft1, skydir, cachedir=None):
+    """ Cache photons = faster
 
+        Returns a record array with the phase, time, energy,
+        and angular distance (in radians) of every photon.
 
-def get_phases_and_times(ft1, skydir, emin, emax, radius):
-    ed = get_all_phases(ft1, skydir)
-    all_phases = ed['PULSE_PHASE']
-    all_times = ed['TIME']
+        If cachedir (or phase_cachedir) is set, the photons are
+        saved there the first time they are extracted and
+        memory-mapped (read only) by any other process which
+        asks for the same photons. """
+    if cachedir is None: cachedir = phase_cachedir
+    if cachedir is None:
+        return _extract_phases(ft1, skydir, radius=180)
 
-    cut = (ed['ENERGY'] >= emin) & (ed['ENERGY'] <= emax) & (ed['DIFFERENCES'] <= np.radians(radius))
-    return all_phases[cut], all_times[cut]
+    cachedir = expandvars(cachedir)
+    if not exists(cachedir): os.makedirs(cachedir)
+    cachefile = join(cachedir, 'phases_%s.npy' % phase_cache_key(ft1, skydir, radius=180))
 
-def get_phases(*args, **kwargs):
-    return get_phases_and_times(*args, **kwargs)[0]
+    if not exists(cachefile):
+        data = _extract_phases(ft1, skydir, radius=180)
+        # Write atomically so that concurrent jobs never see a partial file
+        temp = NamedTemporaryFile(dir=cachedir, suffix='.npy', delete=False)
+        np.save(temp, data)
+        temp.close()
+        os.rename(temp.name, cachefile)
+
+    return np.load(cachefile, mmap_mode='r')
 
 
+def get_phases_and_times(ft1, skydir, emin, emax, radius, cachedir=None):
+    ed = get_all_phases(ft1, skydir, cachedir)
 
+    cut = (ed['ENERGY'] >= emin) & (ed['ENERGY'] <= emax) & (ed['DIFFERENCES'] <= np.radians(radius))
+    return ed['PULSE_PHASE'][cut], ed['TIME'][cut]
+
+def get_phases(*args, **kwargs):
+    return get_phases_and_times(*args, **kwargs)[0]
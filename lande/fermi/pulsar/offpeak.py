@@ -4,26 +4,35 @@ import sys
 import numpy as np
 from scipy.stats import poisson
 
-import BayesianBlocks
-
 from uw.pulsar.phase_range import PhaseRange
 
+from lande.utilities.parallel import fork_map, default_processes
+
 from . plotting import plot_phaseogram
+from . blocks import periodic_blocks, block_heights, FitnessCache
 
 
 class BlockException(Exception):
     pass
 
+class NoGoodNcpPriors(Exception):
+    """ Raised when no ncpPrior gives acceptable blocks. """
+    pass
+
 class PeriodicBlocks(object):
     """ Applies Baysian blocks to
         data which is periodic between 0 and 1. """
 
-    def __init__(self, phases, ncpPrior):
+    def __init__(self, phases, ncpPrior, fitness_cache=None):
+        """ fitness_cache is the fitness_cache of a previous
+            PeriodicBlocks object for the same phases. Using
+            it avoids recomputing the fitness of every block. """
         if np.any((phases >= 1)|(phases < 0)):
             raise BlockException("Bad phases %s" % phases[(phases<0)|(phases>=1)])
 
         self.phases = phases
         self.ncpPrior = ncpPrior
+        self.fitness_cache = fitness_cache
 
         self.xx, self.yy = self.get_blocks()
 
@@ -34,93 +43,105 @@ class PeriodicBlocks(object):
         self.heights = self.yy[::2]
 
     def get_blocks(self):
-        """ Apply binned baysian blocks to the pulsar phases
+        """ Apply baysian blocks to the pulsar phases
             Return the Bayesian block data. 
-        
-            According to Jeff Scargal, a easy way to accomplish
-            Bayesian blocks on a periodic 
+
+            The blocks are computed directly on the circle (see
+            blocks.periodic_blocks), so a block can wrap around
+            phase 0. A wrapping block is returned as two blocks
+            with the same height, one at the start and one at
+            the end of the [0,1] interval.
         """
-        loop_phases = np.concatenate((self.phases, self.phases-1, self.phases+1))
+        edges, counts = self.get_cells()
+        lengths = np.diff(edges)
 
-        xx, yy = self._get_loop_blocks(loop_phases, self.phases)
+        if self.fitness_cache is None:
+            self.fitness_cache = FitnessCache(counts, lengths, fitness='events')
 
-        xx = np.asarray(xx)
-        yy = np.asarray(yy)
+        starts = periodic_blocks(counts, lengths, self.ncpPrior, fitness='events', cache=self.fitness_cache)
+        heights = block_heights(counts, lengths, starts, fitness='events')
 
-        if np.any(np.isinf(yy)):
-            raise BlockException('Error, some yy are inf. xx=%s, yy=%s' % (str(xx),str(yy)))
+        if np.any(np.isinf(heights)):
+            raise BlockException('Error, some heights are inf. heights=%s' % str(heights))
 
+        if len(starts) == 1:
+            # the entire interval is constant
+            return np.asarray([0.,1.]), np.repeat(heights, 2)
 
-        bin_size = 0.0001
+        # boundaries of the blocks, rotated into [0,1]
+        boundaries = edges[starts] % 1
 
         # I ran into floating point problems with blocks that
         # went just a hair above 0, so it would go from like [-0.75, 1e-10].
         # And this would create unphysically small blocks. The
         # easy solution to this is to just add this small tolerance.
-        tolerance = 1e-5*bin_size
+        tolerance = 1e-9
+        boundaries[(boundaries < tolerance) | (boundaries > 1-tolerance)] = 0
 
-        first = np.where(xx>0 + tolerance)[0][0]-1
-        last = np.where(xx<1 - tolerance)[0][-1]+1
+        order = np.argsort(boundaries)
+        boundaries, heights = boundaries[order], heights[order]
 
-        cut_xx = xx[first:last+1]
-        cut_yy = yy[first:last+1]
+        if len(boundaries) == 1 or boundaries[0] > 0:
+            # split the block which wraps around 0
+            boundaries = np.append(0, boundaries)
+            heights = np.append(heights[-1], heights)
+        boundaries = np.append(boundaries, 1)
 
-        # sanity checks
-        assert (cut_xx[0] <= tolerance) and (cut_xx[-1] >= 1 - tolerance)
+        xx = np.repeat(boundaries, 2)[1:-1]
+        yy = np.repeat(heights, 2)
 
-        if not np.allclose(cut_yy[0],cut_yy[-1]):
-            print 'Warning, Bayesian blocks do not appear to be periodic!'
+        return xx, yy
 
-        cut_xx[0] = 0
-        cut_xx[-1] = 1
 
-        return cut_xx, cut_yy
+class PeriodicUnbinnedBlocks(PeriodicBlocks):
+    """ Bayesian blocks with one cell per photon.
 
+        N.B. The blocks are only guaranteed to be optimal for up to
+        500 distinct phases (max_exact_cells in blocks.periodic_blocks).
+        For more photons, the exact O(N^3) solution is too slow and the
+        blocks are found by a local search which may not give the optimal
+        partition (a warning is raised when this happens). Use
+        PeriodicBinnedBlocks for large numbers of photons. """
 
-class PeriodicUnbinnedBlocks(PeriodicBlocks):
+    def get_cells(self):
+        """ Each cell contains one photon, and extends halfway
+            to the neighboring photons (wrapping around phase 0).
 
-    def _get_loop_blocks(self, loop_phases, phases):
-            # use set(...) to remove duplicate phases which break baysian block algorithm.
-            # in principle, there shouldn't be any duplicate phases because we
-            # are measuring a continuous varaibale. But it is of negligible harm
-            # to strip out one or two photons if needed.
+            Duplicate phases (which, in principle, shouldn't exist because we
+            are measuring a continuous varaibale) are merged into one cell.
+            N.B. Before the blocks were computed in numpy, duplicate
+            photons were instead dropped. """
+        phases, inverse = np.unique(self.phases, return_inverse=True)
+        counts = np.bincount(inverse).astype(float)
 
-        before=len(loop_phases)
-        loop_phases=np.sort(list(set(loop_phases)))
-        after=len(loop_phases)
-        if before != after:
-            print 'Warning, stripping %s/%s duplicate photons from the list' % (before-after,before)
+        if len(phases) != len(self.phases):
+            print 'Warning, merging %s/%s duplicate photons' % (len(self.phases)-len(phases),len(self.phases))
 
-        bb = BayesianBlocks.BayesianBlocks(loop_phases)
-        xx, yy = bb.lightCurve(self.ncpPrior)
+        middles = (phases[1:] + phases[:-1])/2
+        first = (phases[-1] - 1 + phases[0])/2
+        edges = np.concatenate(([first], middles, [first+1]))
 
-        return xx, yy
+        return edges, counts
 
 
 class PeriodicBinnedBlocks(PeriodicBlocks):
 
-    def _get_loop_blocks(self, loop_phases, phases):
-        if len(phases) < 25:
+    def get_cells(self):
+        if len(self.phases) < 25:
             nbins=10
-        elif len(phases) < 50:
+        elif len(self.phases) < 50:
             nbins=25
-        elif len(phases) < 100:
+        elif len(self.phases) < 100:
             nbins=50
-        elif len(phases) < 1000:
+        elif len(self.phases) < 1000:
             nbins=100
         else:
             nbins=200
 
-        print 'phases',loop_phases
+        edges = np.linspace(0,1,nbins+1)
+        counts = np.histogram(self.phases, bins=edges)[0].astype(float)
 
-        tstart=-1
-        bins = np.linspace(-1,2,nbins*3+1)
-        bin_content = np.histogram(loop_phases, bins=bins)[0]
-        bin_sizes = np.ones_like(loop_phases)*(bins[1]-bins[0])
-        bb = BayesianBlocks.BayesianBlocks(tstart,bin_content.tolist(),bin_sizes.tolist())
-        xx, yy = bb.lightCurve(self.ncpPrior)
-
-        return xx, yy
+        return edges, counts
 
 
 
@@ -142,7 +163,25 @@ class OffPeakBB(object):
         structure in the pulsar light curve. """
 
     @staticmethod
-    def find_phase_range(periodic_blocks, phases, prob_2peak=0.01):
+    def count_phases(sorted_phases, phase_range):
+        """ Count the photons in a phase range (which can wrap around
+            phase 0) using a sorted array of phases. """
+        count = lambda a,b: np.searchsorted(sorted_phases, b, side='right') - np.searchsorted(sorted_phases, a, side='left')
+
+        n = 0
+        for a,b in phase_range.tolist(dense=False):
+            width = (b - a) % 1 if b != a + 1 else 1
+            a = a % 1
+            if width >= 1:
+                n += len(sorted_phases)
+            elif a + width <= 1:
+                n += count(a, a + width)
+            else:
+                n += count(a, 1) + count(0, a + width - 1)
+        return n
+
+    @staticmethod
+    def find_phase_range(periodic_blocks, phases, prob_2peak=0.01, verbose=True):
         """ xx and yy are the bayesian block decomposition of
             a pulsar light curve. 
             
@@ -170,69 +209,153 @@ class OffPeakBB(object):
 
             second_min_phase = ranges[sorted[1]]
 
-            ncounts = len([p for p in phases if p in min_phase])
-            second_ncounts = len([p for p in phases if p in second_min_phase])
+            sorted_phases = np.sort(phases)
+            ncounts = OffPeakBB.count_phases(sorted_phases, min_phase)
+            second_ncounts = OffPeakBB.count_phases(sorted_phases, second_min_phase)
 
             predicted_second_counts = ncounts*second_min_phase.phase_fraction/min_phase.phase_fraction
 
             prob =poisson.sf(second_ncounts, predicted_second_counts)
-            print 'Probability of there being a second peak from %s is %s' % (str(second_min_phase),prob)
+            if verbose: print 'Probability of there being a second peak from %s is %s' % (str(second_min_phase),prob)
             region_too_small = second_min_phase.phase_fraction < 0.5*min_phase.phase_fraction
             height_too_different = prob < prob_2peak
 
             if height_too_different or region_too_small:
-                if height_too_different:
+                if verbose and height_too_different:
                     print 'Rejecting second peak - heights are inconsistent'
-                if region_too_small:
+                if verbose and region_too_small:
                     print 'Rejecting second peak - region too small'
                 phase = min_phase
             else:
-                print 'Adding second peak!'
+                if verbose: print 'Adding second peak!'
                 phase  = min_phase + second_min_phase
 
         return phase.trim(fraction=0.1)
 
+    def _try_blocks(self, ncpPrior):
+        """ Returns the blocks for ncpPrior, or None if they are not acceptable. """
+        try:
+            periodic_blocks = PeriodicBinnedBlocks(phases=self.phases, ncpPrior=ncpPrior, 
+                                                   fitness_cache=self.fitness_cache)
+            self.fitness_cache = periodic_blocks.fitness_cache
+            if self.verbose: print '  xx, yy', periodic_blocks.xx, periodic_blocks.yy
+        except BlockException:
+            if self.verbose:
+                print 'Baysian blocks failed with ncpPrior=%s because PeriodicBinnedBlocks raised an exception' % ncpPrior
+                traceback.print_exc(file=sys.stdout)
+            return None
+
+        if len(periodic_blocks.xx) <= 2:
+            if self.verbose: print 'Baysian blocks failed with ncpPrior=%s because the entire interval is constant' % ncpPrior
+            return None
+        elif np.any(np.isinf(periodic_blocks.yy)):
+            if self.verbose: print 'Baysian blocks failed with ncpPrior=%s because some of the blocks have infinite height' % ncpPrior
+            return None
+        return periodic_blocks
+
+    def find_blocks(self):
+        """ Find the largest ncpPrior in ncpPrior, ncpPrior-1, ncpPrior-2, ...
+            (down to 1) which gives acceptable blocks.
+
+            Smaller ncpPriors give more blocks, so instead of trying
+            each ncpPrior in turn, the largest good ncpPrior is found by bisection. 
+            The fitness of all the blocks is computed only once and
+            reused for each ncpPrior.
+
+            The bisection assumes that once the blocks are acceptable,
+            they stay acceptable for smaller ncpPriors. This is true
+            for the usual failure (a large ncpPrior which gives only
+            one block), but not guaranteed for the others (an exception
+            or a block with infinite height). So if the smallest ncpPrior
+            also fails, the others are tried in turn (as in a linear
+            search) instead of giving up. """
+        if self.verbose: print 'Trying Baysian blocks with ncpPrior=%s' % self.ncpPrior
+
+        candidates = self.ncpPrior - np.arange(int(np.ceil(self.ncpPrior - 1)) + 1)
+        candidates = candidates[candidates >= 1]
+        if len(candidates) == 0:
+            raise NoGoodNcpPriors("No good ncpPriors!")
+
+        results = dict()
+        def good(i):
+            if i not in results:
+                results[i] = self._try_blocks(candidates[i])
+            return results[i] is not None
+
+        if good(0):
+            lo = 0
+        else:
+            hi = len(candidates) - 1
+            if good(hi):
+                # candidates[lo] is bad, candidates[hi] is good
+                lo = 0
+                while hi - lo > 1:
+                    mid = (lo + hi)//2
+                    if good(mid):
+                        hi = mid
+                    else:
+                        lo = mid
+                lo = hi
+            else:
+                lo = next((i for i in range(1, hi) if good(i)), None)
+                if lo is None:
+                    raise NoGoodNcpPriors("No good ncpPriors!")
 
-    def __init__(self,phases,ncpPrior=8):
-        """ phases is the numpy array of pulsar phases. """
+        if self.verbose and lo > 0:
+            print 'Bayesian blocks failed with ncpPrior=%s, using ncpPrior=%s' % (candidates[lo-1],candidates[lo])
+
+        self.actual_ncpPrior = candidates[lo]
+        return results[lo]
+
+    def __init__(self,phases,ncpPrior=8,nbootstrap=0,processes=None,verbose=True):
+        """ phases is the numpy array of pulsar phases. 
+        
+            If nbootstrap > 0, the off peak region is also computed
+            for nbootstrap resamplings of the phases (in parallel), 
+            which gives a sense of the uncertainty on the off peak region. """
 
         self.phases = phases
         self.ncpPrior = ncpPrior
-        self.actual_ncpPrior = ncpPrior
-        
-        print 'Trying Baysian blocks with ncpPrior=%s' % self.ncpPrior
-        while True:
-            try:
-                self.periodic_blocks = PeriodicBinnedBlocks(phases=phases, ncpPrior=self.actual_ncpPrior)
-
-                print '  xx, yy', self.periodic_blocks.xx, self.periodic_blocks.yy
-            except BlockException, ex:
-                print 'Baysian blocks failed with ncpPrior=%s because PeriodicBinnedBlocks raised an exception' % self.actual_ncpPrior
-                traceback.print_exc(file=sys.stdout)
-                good_blocks = False
-            else:
-                if len(self.periodic_blocks.xx) <= 2:
-                    print 'Baysian blocks failed with ncpPrior=%s because the entire interval is constant' % self.actual_ncpPrior
-                    good_blocks = False
-                elif np.any(np.isinf(self.periodic_blocks.yy)):
-                    print 'Baysian blocks failed with ncpPrior=%s because some of the blocks have infinite height' % self.actual_ncpPrior
-                    good_blocks = False
-                else:
-                    good_blocks = True
-
-            if good_blocks:
-                break
-            else:
-                print 'Bayesian blocks failed with ncpPrior=%s, trying again with ncpPrior=%s' % (self.actual_ncpPrior,self.actual_ncpPrior-1)
-                self.actual_ncpPrior -= 1 
-                if self.actual_ncpPrior < 1:
-                    raise Exception("No good ncpPriors!")
+        self.verbose = verbose
+        self.fitness_cache = None
 
+        self.periodic_blocks = self.find_blocks()
 
-        self.off_peak = self.find_phase_range(self.periodic_blocks, phases)
+        self.off_peak = self.find_phase_range(self.periodic_blocks, phases, verbose=verbose)
 
         self.blocks = dict(xx = self.periodic_blocks.xx, yy = self.periodic_blocks.yy)
 
+        if nbootstrap > 0:
+            self.bootstrap_off_peaks = self.bootstrap(phases, nbootstrap, processes=processes, ncpPrior=ncpPrior)
+
+    @staticmethod
+    def bootstrap(phases, nbootstrap, processes=None, seed=None, **kwargs):
+        """ Compute the off peak region for nbootstrap resamplings (with replacement)
+            of the phases. The resamplings are split between worker processes.
+
+            Returns a list of the off peak PhaseRange of each resampling
+            (or None when no acceptable blocks were found). """
+        if processes is None: processes = default_processes()
+        nblocks = min(processes, nbootstrap)
+        seeds = np.random.RandomState(seed).randint(2**31, size=nblocks)
+        sizes = [len(i) for i in np.array_split(np.arange(nbootstrap), nblocks)]
+
+        def resample(args):
+            seed, size = args
+            random = np.random.RandomState(seed)
+            off_peaks = []
+            for i in range(size):
+                sample = phases[random.randint(len(phases), size=len(phases))]
+                try:
+                    off_peak = OffPeakBB(sample, verbose=False, **kwargs).off_peak
+                    off_peaks.append(off_peak.tolist(dense=False))
+                except (BlockException, NoGoodNcpPriors):
+                    off_peaks.append(None)
+            return off_peaks
+
+        results = fork_map(resample, zip(seeds, sizes), processes=processes)
+        return [PhaseRange(i) if i is not None else None for i in sum(results, [])]
+
 def rotate_blocks(xx,yy,offset):
     """ rotate the bayesian blocks xx, yy. """
 
@@ -1,17 +1,104 @@
 import numpy  as np
 
-from uw.pulsar.stats import hm
+from lande.fermi.pulsar.data import get_all_phases
+
+def h_test(phases, m=20, c=4):
+    """ The H-test of de Jager et al (1989), with the
+        same definition as uw.pulsar.stats.hm:
+
+            H = max_{1<=k<=m} (Z^2_k - c*(k-1))
+
+        >>> h_test([])
+        0
+        >>> print '%.3f' % h_test([0.1, 0.1, 0.1, 0.1])
+        84.000
+    """
+    phases = np.asarray(phases, dtype=float)
+    n = len(phases)
+    if n == 0: return 0
+    k = np.arange(1,m+1)
+    args = 2*np.pi*np.outer(k, phases)
+    z2 = 2.0/n*np.cumsum(np.cos(args).sum(axis=1)**2 + np.sin(args).sum(axis=1)**2)
+    return np.max(z2 - c*(k-1))
+
+def h_test_grid(phases, energies, distances, emins, rads, m=20, c=4):
+    """ The H-test of the photons with energy >= emin and distance <= radius
+        for every emin in emins and every radius in rads (which must both be sorted).
+
+        Instead of cutting the photons for each cell, the Fourier sums
+        of the photons are binned once into the (emin, radius) grid and
+        then accumulated with prefix sums along both axes, so the cost
+        is one pass over the photons for the whole grid.
+
+        >>> np.random.seed(0)
+        >>> phases, energies, distances = np.random.rand(3, 1000)
+        >>> phases = np.append(phases, np.random.normal(0.5, 0.05, 200) % 1)
+        >>> energies = np.append(energies, np.random.rand(200))
+        >>> distances = np.append(distances, np.random.rand(200)**2)
+        >>> emins, rads = [0.1, 0.3, 0.5], [0.2, 0.6, 0.9, 1]
+        >>> grid = h_test_grid(phases, energies, distances, emins, rads)
+        >>> grid.shape
+        (3, 4)
+        >>> all(np.allclose(grid[i,j], h_test(phases[(energies>=e)&(distances<=r)]))
+        ...     for i,e in enumerate(emins) for j,r in enumerate(rads))
+        True
+    """
+    phases, energies, distances = [np.asarray(i, dtype=float) for i in (phases, energies, distances)]
+    emins, rads = np.asarray(emins, dtype=float), np.asarray(rads, dtype=float)
+    ne, nr = len(emins), len(rads)
+
+    # A photon is in cell (i,j) iff i <= ie and j >= ir
+    ie = np.searchsorted(emins, energies, side='right') - 1
+    ir = np.searchsorted(rads, distances, side='left')
+    keep = (ie >= 0) & (ir < nr)
+    cell = ie[keep]*nr + ir[keep]
+    phases = phases[keep]
+
+    def accumulate(x):
+        x = x.reshape(x.shape[:-1] + (ne, nr))
+        x = np.cumsum(x[...,::-1,:], axis=-2)[...,::-1,:]
+        return np.cumsum(x, axis=-1)
+
+    n = accumulate(np.bincount(cell, minlength=ne*nr).astype(float))
+
+    power = np.empty((m, ne, nr))
+    for k in range(1,m+1):
+        args = 2*np.pi*k*phases
+        cos = accumulate(np.bincount(cell, weights=np.cos(args), minlength=ne*nr))
+        sin = accumulate(np.bincount(cell, weights=np.sin(args), minlength=ne*nr))
+        power[k-1] = cos**2 + sin**2
+
+    z2 = 2*np.cumsum(power, axis=0)/np.where(n > 0, n, 1)
+    h = np.max(z2 - c*np.arange(m).reshape(m,1,1), axis=0)
+    return np.where(n > 0, h, 0)
+
+def _refine(grid, i):
+    """ A finer grid (with the same number of points)
+        spanning the neighbors of grid[i]:
+
+            >>> _refine([1, 2, 3, 4, 5], 2).tolist()
+            [2.0, 2.5, 3.0, 3.5, 4.0]
+            >>> _refine([1, 2, 3, 4, 5], 0).tolist()
+            [1.0, 1.25, 1.5, 1.75, 2.0]
+    """
+    return np.linspace(grid[max(i-1,0)], grid[min(i+1,len(grid)-1)], len(grid))
 
-from lande.fermi.pulsar.data import get_phases
 
 class OptimizePhases(object):
     """ very simple object to load in an ft1 file and
         optimize the radius & energy to find the
-        best pulsations. """
+        best pulsations.
+
+        The H-test is computed for the whole grid at once (see
+        h_test_grid). If refine > 0, the grid is then repeatedly
+        zoomed in around the best (emin,radius) to optimize
+        more precisely. """
 
     def __init__(self, ft1, skydir, emax,
                  emins=np.logspace(2,4,17),
                  rads=np.linspace(0.1,4,40),
+                 refine=0,
+                 m=20, c=4,
                  verbose=False,
                 ):
 
@@ -19,19 +106,32 @@ class OptimizePhases(object):
         self.skydir = skydir
         self.emax = emax
 
-        stats = np.empty([len(emins),len(rads)])
+        ed = get_all_phases(ft1, skydir)
+        cut = ed['ENERGY'] <= emax
+        phases, energies, distances = [ed[i][cut] for i in ['PULSE_PHASE', 'ENERGY', 'DIFFERENCES']]
+
+        emins, rads = np.asarray(emins, dtype=float), np.asarray(rads, dtype=float)
+        self.optimal_h = -np.inf
+
+        for level in range(refine+1):
+            stats = h_test_grid(phases, energies, distances, emins, np.radians(rads), m=m, c=c)
+
+            a = np.argmax(stats)
+            coord_e, coord_r = np.unravel_index(a, stats.shape)
+            if verbose: print 'level=%s, emin=%s, radius=%s, stat=%s' % (level,emins[coord_e],rads[coord_r],stats[coord_e,coord_r])
+
+            if stats[coord_e,coord_r] > self.optimal_h:
+                self.optimal_emin = emins[coord_e]
+                self.optimal_radius = rads[coord_r]
+                self.optimal_h = stats[coord_e,coord_r]
 
-        for iemin,emin in enumerate(emins):
-            for irad,radius in enumerate(rads):
-                phases = get_phases(ft1, skydir, emin, emax, radius)
-                stat = hm(phases) if len(phases) > 0 else 0
-                if verbose: print 'emin=%s, radius=%s, stat=%s, len=%s' % (emin,radius,stat,len(phases))
-                stats[iemin,irad] = stat
+            if level < refine:
+                emins = np.exp(_refine(np.log(emins), coord_e))
+                rads = _refine(rads, coord_r)
 
-        a = np.argmax(stats)
-        coord_e, coord_r = np.unravel_index(a, stats.shape)
+        self.emins, self.rads, self.stats = emins, rads, stats
 
-        self.optimal_emin = emins[coord_e]
-        self.optimal_radius = rads[coord_r]
-        self.optimal_h = np.max(stats)
 
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
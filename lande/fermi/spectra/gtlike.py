@@ -18,6 +18,7 @@ from lande.fermi.likelihood.limits import GtlikePowerLawUpperLimit
 from lande.fermi.likelihood.printing import summary
 
 from . sed import SED
+from lande.fermi.likelihood.basefit import instrumented
 
 
 class GtlikeSED(SED):
@@ -84,6 +85,7 @@ class GtlikeSED(SED):
         super(GtlikeSED,self).__init__(self.results, **keyword_options.defaults_to_kwargs(self, SED))
 
 
+    @instrumented
     def _calculate(self,*args,**kwargs):
         """ Convert all units into sympy arrays after the initial calculation. """
 
@@ -1,64 +1,107 @@
 """ This file contains various function which I have found useful. """
 from math import ceil
+from os.path import exists, expandvars
 
 import pylab as P
 
-from mpl_toolkits.axes_grid1 import AxesGrid
+from lande.pysed import units
+from lande.utilities.math import angular_separation
+from lande.fermi.likelihood.specplot import SpectralAxes
+
+from . sed import SED
+from . pointlike import pointlike_seds, save_sed_table, load_sed_table, sed_table_key
+
+def plot_sed_table(seds, filename=None, ncols=4, colors=dict(),
+                   title=None, flux_units='erg', energy_units='MeV',
+                   emin=80*units.MeV, emax=5e5*units.MeV,
+                   fmin=1e-7*units.MeV/units.cm**2/units.s, fmax=3e-4*units.MeV/units.cm**2/units.s,
+                   **kwargs):
+    """ Plot, in one big grid, all the SEDs in an SED table
+        (a dictionary mapping source names to SED objects or to SED dictionaries).
+
+        colors is an optional dictionary mapping source names to the color of
+        the frame around the SED. kwargs are passed into SED.plot. """
+    names = sorted(seds.keys())
+    nrows = int(ceil(float(len(names))/ncols))
 
-def pointlike_plot_all_seds(roi, filename=None, ncols=4, **kwargs):
-    """ Create an SED of all sources in the ROI as a big plot. """
-    
-    sources=roi.get_sources()
-    nrows = int(ceil(float(len(sources))/ncols))
-    
     fig = P.figure(figsize=(2.5*ncols,2*nrows),frameon=False)
-    tit=P.title("All seds of the sources included in the region.\nRed : fitted sources\nBlue : non fitted sources inside the counts map\nBlack : sources outside of the counts map")
-
-    tit.axes.get_xaxis().set_visible(False)
-    tit.axes.get_yaxis().set_visible(False)
-    grid = AxesGrid(fig, 111,
-                    aspect=False,
-                    nrows_ncols = (nrows, ncols),
-                    axes_pad = 0.1,
-                    add_all=True,
-                    label_mode = "L")
-
-
-    from celgal import dist
-    from mpl_toolkits.axes_grid.anchored_artists import AnchoredText
-    use_ergs=True
-    energy_flux_unit = None
-    if energy_flux_unit is None:
-        energy_flux_unit = 'erg' if use_ergs else 'MeV'
-    assert energy_flux_unit in ('erg', 'MeV', 'GeV', 'eV') , 'unrecognized energy flux unit'
-    energy_flux_factor = dict(erg=1.602e-6, MeV=1, eV=1e6, GeV=1e-3)[energy_flux_unit]
-    dir=["bottom","top","left","right"]
-    for i,which in enumerate(sources):
-        source=roi.get_source(which=which)
-        distance=dist([source.skydir.ra(),source.skydir.dec()],[roi.sa.roi_dir.ra(),roi.sa.roi_dir.dec()])
-        axis = (80, 5e5, 1e-7*energy_flux_factor,3.0e-4*energy_flux_factor)
-        axes=grid[i]
-        if distance<float(roi.sa.maxROI):
-            if len(source.model.get_parameters())!=0:
-                for axem in dir:
-                    axes.spines[axem].set_color('red')
-            else :
-                for axem in dir:
-                    axes.spines[axem].set_color('blue')
-        else :
-            for axem in dir:
-                axes.spines[axem].set_color('black')
-        at = AnchoredText("%s"%which.name,
-                          prop=dict(size=8), frameon=True,
-                          loc=2,
-                          )
-        at.patch.set_boxstyle("round,pad=0.,rounding_size=0.2")
-        axes.add_artist(at)
-                                
-            
-        roi.plot_sed(which,axes=grid[i],axis=axis,title=which.name,energy_flux_unit=energy_flux_unit,**kwargs)
-        
-    if filename is not None: P.savefig(filename)
-    
+    if title is not None: fig.suptitle(title)
+
+    width, height = 0.9/ncols, 0.85/nrows
+    for i,name in enumerate(names):
+        sed = seds[name]
+        if not isinstance(sed, SED): sed = SED(sed)
+
+        row, col = i // ncols, i % ncols
+        axes = SpectralAxes(fig=fig,
+                            rect=(0.08+col*width, 0.9-(row+1)*height, width, height),
+                            flux_units=flux_units, energy_units=energy_units)
+        fig.add_axes(axes)
+
+        # N.B. set the limits first so that the spectral model
+        # is plotted over the whole energy range of the panel
+        axes.set_xlim_units(emin, emax)
+        axes.set_ylim_units(fmin, fmax)
+
+        sed.plot(axes=axes, **kwargs)
+
+        # Only label the outside of the grid
+        if col > 0:
+            axes.set_ylabel('')
+            axes.set_yticklabels([])
+        if i + ncols < len(names):
+            axes.set_xlabel('')
+            axes.set_xticklabels([])
+
+        axes.text(0.05, 0.95, name, transform=axes.transAxes, size=8, va='top',
+                  bbox=dict(boxstyle="round,pad=0.2", facecolor='white'))
+
+        if name in colors:
+            for spine in axes.spines.values():
+                spine.set_color(colors[name])
+
+    if filename is not None: P.savefig(expandvars(filename))
+    return fig
+
+def pointlike_plot_all_seds(roi, filename=None, ncols=4, sedfile=None,
+                            parallel=True, processes=None, **kwargs):
+    """ Create an SED of all sources in the ROI as a big plot.
+
+        The SEDs are computed (in parallel) and then plotted in
+        two separate stages. If sedfile is given, the SEDs are
+        saved to it and, if it already exists and was computed from
+        the same state of the ROI (see sed_table_key), loaded
+        from it instead of being recomputed.
+
+        kwargs are passed into plot_sed_table. """
+
+    seds = None
+    if sedfile is not None:
+        key = sed_table_key(roi)
+        if exists(expandvars(sedfile)):
+            seds = load_sed_table(sedfile, key=key)
+
+    if seds is None:
+        seds = pointlike_seds(roi, parallel=parallel, processes=processes)
+        if sedfile is not None: save_sed_table(seds, sedfile, key=key)
+
+    # Red : fitted sources
+    # Blue : non fitted sources inside the counts map
+    # Black : sources outside of the counts map
+    sources = roi.get_sources()
+    distances = angular_separation([source.skydir.ra() for source in sources],
+                                   [source.skydir.dec() for source in sources],
+                                   roi.sa.roi_dir.ra(), roi.sa.roi_dir.dec())
+    colors = dict()
+    for source,distance in zip(sources, distances):
+        if distance < float(roi.sa.maxROI):
+            colors[source.name] = 'red' if len(source.model.get_parameters())!=0 else 'blue'
+        else:
+            colors[source.name] = 'black'
+
+    kwargs.setdefault('title', "All seds of the sources included in the region.\nRed : fitted sources\nBlue : non fitted sources inside the counts map\nBlack : sources outside of the counts map")
+
+    return plot_sed_table(seds, filename=filename, ncols=ncols, colors=colors, **kwargs)
+
 
 plot_all_seds = pointlike_plot_all_seds # for now
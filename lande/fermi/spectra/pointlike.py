@@ -1,4 +1,6 @@
+import hashlib
 from collections import defaultdict
+from os.path import expandvars
 
 import yaml
 import numpy as np
@@ -8,8 +10,12 @@ from uw.like.sed_plotter import BandFlux
 
 from lande.pysed import units
 from lande.utilities.tools import tolist
+from lande.utilities.save import loaddict
+from lande.utilities.parallel import fork_map, default_processes
 
 from lande.fermi.likelihood.save import name_to_spectral_dict
+from lande.fermi.likelihood.counts import pointlike_state_key
+from lande.fermi.likelihood.basefit import instrumented
 
 from . sed import SED
 
@@ -25,12 +31,23 @@ class PointlikeSED(SED):
         self.roi = roi
         self.name = name
         
-        bf = BandFlux(self.roi, which=self.name, merge=self.merge, scale_factor=1)
-        results = PointlikeSED.pointlike_sed_to_dict(bf, flux_units=self.flux_units, energy_units=self.energy_units)
-
-        results['spectrum'] = name_to_spectral_dict(roi, name, errors=True, covariance_matrix=True)
+        results = self._compute()
 
         super(PointlikeSED,self).__init__(results, **keyword_options.defaults_to_kwargs(self, SED))
+
+    @instrumented
+    def _compute(self):
+        return PointlikeSED.compute(self.roi, self.name, merge=self.merge, 
+                                    flux_units=self.flux_units, energy_units=self.energy_units)
+
+    @staticmethod
+    def compute(roi, name, merge=False, flux_units='erg', energy_units='MeV'):
+        """ Compute the SED (as a dictionary) of the source name. """
+        bf = BandFlux(roi, which=name, merge=merge, scale_factor=1)
+        results = PointlikeSED.pointlike_sed_to_dict(bf, flux_units=flux_units, energy_units=energy_units)
+
+        results['spectrum'] = name_to_spectral_dict(roi, name, errors=True, covariance_matrix=True)
+        return results
         
 
     @staticmethod
@@ -83,3 +100,51 @@ def pointlike_sed_to_yaml(bandflux, filename):
     """
     d=PointlikeSED.pointlike_sed_to_dict(bandflux)
     open(filename,'w').write(yaml.dump(d))
+
+
+def pointlike_seds(roi, names=None, parallel=True, processes=None, **kwargs):
+    """ Compute the SEDs of many sources (by default, all
+        sources in the ROI) at once. 
+
+        Returns an 'SED table', a dictionary mapping the name
+        of each source to its SED dictionary (see PointlikeSED).
+
+        If parallel, the sources are split into one block per worker.
+        The workers are forked from the fully set up ROI, so they share
+        all of its per-band quantities and each worker only computes
+        the band fluxes for its own block of sources. """
+    if names is None:
+        names = [source.name for source in roi.get_sources()]
+
+    compute = lambda block: [(name,PointlikeSED.compute(roi, name, **kwargs)) for name in block]
+
+    if parallel:
+        if processes is None: processes = default_processes()
+        blocks = [names[i::processes] for i in range(min(processes,len(names)))]
+        seds = sum(fork_map(compute, blocks, processes=processes), [])
+    else:
+        seds = compute(names)
+    return dict(seds)
+
+
+def sed_table_key(roi):
+    """ A key which identifies the state of the ROI an SED table was computed from. """
+    return hashlib.sha1(repr(pointlike_state_key(roi))).hexdigest()
+
+
+def save_sed_table(seds, filename, key=None):
+    """ Save an SED table (see pointlike_seds) to one yaml file.
+        key (see sed_table_key) is saved with the table. """
+    table = tolist(seds)
+    if key is not None: table['__key__'] = key
+    open(expandvars(filename),'w').write(yaml.dump(table))
+
+
+def load_sed_table(filename, key=None, **kwargs):
+    """ Load an SED table into a dictionary mapping source names to SED objects.
+
+        If key is given, return None unless the table was saved with the same key. """
+    table = loaddict(filename)
+    if table.pop('__key__', None) != key and key is not None:
+        return None
+    return dict((name,SED(results, **kwargs)) for name,results in table.items())
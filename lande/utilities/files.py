@@ -1,4 +1,5 @@
 import os, fnmatch
+import hashlib
 
 def locate(pattern, root=os.curdir):
     """ Locate all files matching supplied filename pattern in and below
@@ -9,3 +10,12 @@ def locate(pattern, root=os.curdir):
         for filename in fnmatch.filter(files, pattern):
             yield os.path.join(path, filename)
 
+
+def file_hash(filename):
+    """ sha1 hash of a (possibly very large) file. """
+    sha1 = hashlib.sha1()
+    f = open(filename,'rb')
+    for chunk in iter(lambda: f.read(2**20), ''):
+        sha1.update(chunk)
+    f.close()
+    return sha1.hexdigest()
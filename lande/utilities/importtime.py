@@ -0,0 +1,99 @@
+""" Benchmark the cold-start import time of python modules.
+
+    Each module is imported in a fresh python process, so the
+    time includes importing everything the module depends upon.
+
+    Usage:
+
+        # record import times
+        python -m lande.utilities.importtime lande.fermi.likelihood lande.fermi.likelihood.myroi --save=importtime.yaml
+
+        # compare against a previous run, fail if anything got much slower
+        python -m lande.utilities.importtime lande.fermi.likelihood --baseline=importtime.yaml
+"""
+import sys
+import pkgutil
+import subprocess
+import importlib
+from argparse import ArgumentParser
+
+import yaml
+
+_timer = """
+import time
+start = time.time()
+import %s
+print time.time() - start
+"""
+
+
+def public_modules(package):
+    """ Names of all public modules in package (including package).
+        package can also be a plain module. """
+    names = [package]
+    # N.B. don't import a plain module here, that is what is being timed
+    if not pkgutil.get_loader(package).is_package(package): return names
+    p = importlib.import_module(package)
+    for loader, name, ispkg in pkgutil.walk_packages(p.__path__, prefix=package+'.', onerror=lambda x: None):
+        if not any(i.startswith('_') for i in name.split('.')):
+            names.append(name)
+    return names
+
+
+def import_time(module, python=sys.executable):
+    """ Seconds to import module in a new python process (or None if the import fails). """
+    p = subprocess.Popen([python, '-c', _timer % module],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        return None
+    return float(stdout.strip().split('\n')[-1])
+
+
+def import_times(modules, repeat=3, **kwargs):
+    """ Best of repeat cold-start import times for each module. """
+    times = dict()
+    for module in modules:
+        t = [import_time(module, **kwargs) for i in range(repeat)]
+        times[module] = None if None in t else min(t)
+    return times
+
+
+def find_regressions(times, baseline, tolerance=1.5, min_time=0.1):
+    """ Modules whose import time grew by more than a factor of tolerance
+        (ignoring modules which import faster than min_time seconds). """
+    regressions = dict()
+    for module,t in times.items():
+        old = baseline.get(module)
+        if t is None or old is None: continue
+        if t > min_time and t > tolerance*old:
+            regressions[module] = [old, t]
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('packages', nargs='+')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', default=None, help='Save import times to this file.')
+    parser.add_argument('--baseline', default=None, help='Compare import times to this file.')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args()
+
+    modules = sum([public_modules(package) for package in args.packages], [])
+    times = import_times(modules, repeat=args.repeat)
+
+    for module in sorted(times.keys()):
+        t = times[module]
+        print '%-60s %s' % (module, 'FAILED' if t is None else '%.3fs' % t)
+
+    if args.save is not None:
+        open(args.save,'w').write(yaml.dump(times))
+
+    if args.baseline is not None:
+        baseline = yaml.load(open(args.baseline))
+        regressions = find_regressions(times, baseline, tolerance=args.tolerance)
+        for module,(old,new) in sorted(regressions.items()):
+            print 'Import time regression for %s: %.3fs -> %.3fs' % (module, old, new)
+        if len(regressions) > 0:
+            sys.exit(1)
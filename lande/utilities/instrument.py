@@ -0,0 +1,78 @@
+""" Lightweight instrumentation of a block of code.
+
+    Usage:
+
+        with Instrument() as instrument:
+            instrument.count_calls(roi, 'logLikelihood', 'likelihood_evaluations')
+            roi.fit()
+        print instrument.results
+
+    instrument.results contains the wall time, cpu time (of this process
+    and of any child processes it waited for), the peak resident memory,
+    and the number of calls to each counted method.
+
+    The kernel only records the peak resident memory over the lifetime
+    of the process, so two memory measurements are stored:
+    lifetime_peak_rss is the peak of the process up to the end of the
+    block, and peak_rss_increase is how much the block raised it.
+    peak_rss_increase is 0 when the block used less memory than
+    something which ran before it, so it is a lower bound on the
+    memory used by the block.
+"""
+import os
+import time
+
+from lande.utilities.memory import get_peak_rss
+
+
+class Instrument(object):
+
+    def __init__(self):
+        self.counts = dict()
+        self.results = None
+        self._patched = []
+
+    def count_calls(self, obj, method, counter):
+        """ Count calls to obj.method as counter while instrumenting.
+
+            obj can be either an instance (only calls to this object are
+            counted) or a class (calls from all instances are counted).
+            The method is restored when the instrumented block exits. """
+        original = getattr(obj, method)
+        self.counts.setdefault(counter, 0)
+
+        def counted(*args, **kwargs):
+            self.counts[counter] += 1
+            return original(*args, **kwargs)
+
+        # keep the raw attribute so that a class method
+        # (or the absence of an instance attribute) is restored exactly
+        self._patched.append((obj, method, vars(obj).get(method), method in vars(obj)))
+        setattr(obj, method, counted)
+
+    def _restore(self):
+        for obj, method, raw, existed in reversed(self._patched):
+            if existed:
+                setattr(obj, method, raw)
+            else:
+                delattr(obj, method)
+        self._patched = []
+
+    def __enter__(self):
+        self.start_wall = time.time()
+        self.start_times = os.times()
+        self.start_peak_rss = get_peak_rss()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._restore()
+        stop_times = os.times()
+        self.results = dict(
+            wall_time = time.time() - self.start_wall,
+            cpu_time = (stop_times[0] + stop_times[1]) - (self.start_times[0] + self.start_times[1]),
+            child_cpu_time = (stop_times[2] + stop_times[3]) - (self.start_times[2] + self.start_times[3]),
+        )
+        self.results['lifetime_peak_rss'] = get_peak_rss()
+        self.results['peak_rss_increase'] = self.results['lifetime_peak_rss'] - self.start_peak_rss
+        self.results.update(self.counts)
+        return False
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
-from os.path import join, expandvars, exists, splitext
+import time
+import subprocess
+from os.path import join, expandvars, exists, splitext, abspath, basename, dirname
 from os import makedirs
 from collections import defaultdict
 from itertools import product
+from datetime import timedelta
 
 import numpy as np
 import yaml
@@ -231,6 +234,78 @@ class JobMerger(object):
         savedict(filename, self.results)
         
 
+def run_jobs_locally(jobs, processes=None, retries=2, poll=1, verbosity=True):
+    """ Run shell scripts (like the run.sh files created by JobBuilder)
+        on this computer, with at most processes running at once.
+
+        Each script is run inside its own folder and its output
+        goes to the file script.log. When it succeeds, the marker
+        file script.done is created, and jobs which already have a
+        marker are skipped (so an interrupted set of jobs can be resumed).
+        A failed job is retried up to retries more times.
+
+        Returns the list of jobs which failed. """
+    if processes is None: 
+        from multiprocessing import cpu_count
+        processes = cpu_count()
+
+    jobs = [abspath(expandvars(j)) for j in jobs]
+    marker = lambda job: job + '.done'
+
+    pending = [job for job in jobs if not exists(marker(job))]
+    already_done = len(jobs) - len(pending)
+    if verbosity and already_done > 0: print 'Skipping %s jobs which are already done' % already_done
+
+    attempts = defaultdict(int)
+    running = dict()
+    failed = []
+    completed = 0
+    start = time.time()
+
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < processes:
+                job = pending.pop(0)
+                attempts[job] += 1
+                log = open(job + '.log', 'a')
+                p = subprocess.Popen(['sh', basename(job)], cwd=dirname(job), 
+                                     stdout=log, stderr=subprocess.STDOUT)
+                running[job] = (p, log)
+
+            time.sleep(poll)
+
+            for job,(p,log) in running.items():
+                if p.poll() is None: continue
+
+                del running[job]
+                log.close()
+
+                if p.returncode == 0:
+                    open(marker(job),'w').write('%s\n' % time.ctime())
+                    completed += 1
+                elif attempts[job] <= retries:
+                    print 'Job %s failed with exit code %s, retrying (attempt %s/%s)' % (job, p.returncode, attempts[job]+1, retries+1)
+                    pending.append(job)
+                    continue
+                else:
+                    print 'Job %s failed with exit code %s (see %s.log)' % (job, p.returncode, job)
+                    failed.append(job)
+
+                if verbosity:
+                    elapsed = time.time() - start
+                    remaining = len(pending) + len(running)
+                    eta = timedelta(seconds=int(elapsed/completed*remaining)) if completed > 0 else 'unknown'
+                    print '%s/%s jobs done, %s failed, %s running, elapsed %s, ETA %s' % \
+                            (already_done + completed, len(jobs), len(failed), len(running), 
+                             timedelta(seconds=int(elapsed)), eta)
+    finally:
+        for p,log in running.values():
+            p.terminate()
+            log.close()
+
+    return failed
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,67 @@
+""" Lazy loading of packages.
+
+    Many of the packages in lande pull in pointlike, pyLikelihood, and
+    matplotlib when they are imported, which is slow. lazy_package replaces
+    a package with a module object which only imports a submodule
+    (and anything it depends upon) the first time one of its
+    attributes is used. For example, in the __init__.py of a package:
+
+        from lande.utilities.lazy import lazy_package
+        lazy_package(__name__, dict(LandeROI='myroi'))
+
+    Then 'from package import LandeROI' imports package.myroi, but
+    'import package' and 'from package.save import loaddict' do not.
+"""
+import sys
+import imp
+import types
+import importlib
+
+
+class LazyPackage(types.ModuleType):
+    """ Module object which imports attributes from submodules on demand.
+
+        attributes is a dictionary mapping the name of each lazy attribute
+        to the submodule which defines it. In addition,
+        all submodules of the package are available as attributes. """
+
+    def __init__(self, module, attributes):
+        super(LazyPackage,self).__init__(module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        self.__all__ = sorted(attributes.keys())
+
+        # N.B. hold on to the original module, otherwise python
+        # will clear out its namespace when it is garbage collected.
+        self._module = module
+        self._attributes = attributes
+
+    def _is_submodule(self, name):
+        try:
+            f, pathname, description = imp.find_module(name, self.__path__)
+        except ImportError:
+            return False
+        if f is not None: f.close()
+        return True
+
+    def __getattr__(self, name):
+        # Only called when name is not already an attribute.
+        if name in self._attributes:
+            submodule = importlib.import_module('%s.%s' % (self.__name__, self._attributes[name]))
+            value = getattr(submodule, name)
+        elif not name.startswith('_') and self._is_submodule(name):
+            value = importlib.import_module('%s.%s' % (self.__name__, name))
+        else:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys() + self._attributes.keys()))
+
+
+def lazy_package(name, attributes):
+    """ Replace the package name in sys.modules with a LazyPackage. """
+    package = LazyPackage(sys.modules[name], attributes)
+    sys.modules[name] = package
+    return package
@@ -56,6 +56,26 @@ def log_binomial(n,m):
     return log_fac(n)-log_fac(m)-log_fac(n-m)
 
 
+def angular_separation(lon1, lat1, lon2, lat2):
+    """ Angular distance, in degrees, between points on the
+        sphere. All arguments are in degrees and can be arrays,
+        so many separations are computed in one call.
+
+        Uses the Vincenty formula, which is accurate at all distances.
+
+            >>> print '%.1f' % angular_separation(0, 0, 90, 0)
+            90.0
+            >>> np.allclose(angular_separation([0, 10, 180], [90, 0, 0], 0, 0), [90, 10, 180])
+            True
+    """
+    lon1, lat1, lon2, lat2 = [np.radians(np.asarray(i, dtype=float)) for i in [lon1, lat1, lon2, lat2]]
+    dlon = lon2 - lon1
+    num1 = np.cos(lat2)*np.sin(dlon)
+    num2 = np.cos(lat1)*np.sin(lat2) - np.sin(lat1)*np.cos(lat2)*np.cos(dlon)
+    denominator = np.sin(lat1)*np.sin(lat2) + np.cos(lat1)*np.cos(lat2)*np.cos(dlon)
+    return np.degrees(np.arctan2(np.hypot(num1, num2), denominator))
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -1,5 +1,5 @@
-import psutil
 import os
+import resource
 
 def convert_bytes(bytes, precision=1):
     """ Function taken from 
@@ -25,6 +25,8 @@ def convert_bytes(bytes, precision=1):
 
 def get_memory_usage(extra=None):
     """ Simple utility to monitor memory usage of my script. """
+    import psutil
+
     ret = ''
 
     p = psutil.Process(os.getpid())
@@ -42,3 +44,9 @@ def get_memory_usage(extra=None):
 
 def print_memory_usage(*args, **kwargs):
     print get_memory_usage(*args, **kwargs)
+
+def get_peak_rss():
+    """ Largest resident memory (in bytes) used by this process
+        over its whole lifetime (not just the recent past). """
+    # N.B. ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
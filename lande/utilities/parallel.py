@@ -0,0 +1,133 @@
+""" Run functions in forked worker processes.
+
+    pyLikelihood objects and pointlike ROIs cannot be pickled, so
+    multiprocessing.Pool is not very useful for them. Instead, the
+    functions here fork the current process so that each worker
+    inherits its own private copy of the analysis objects. Only the
+    return values (which must be picklable) are sent back to the parent.
+
+    Example usage:
+
+        def fit(model):
+            roi.modify(which='source', model=model)
+            roi.fit()
+            return roi.logLikelihood(roi.parameters())
+
+        results = fork_map(fit, [PowerLaw(), LogParabola()])
+"""
+import sys
+import traceback
+import multiprocessing
+from Queue import Empty
+
+
+class WorkerException(Exception): pass
+
+
+def _run(index, func, args, queue):
+    try:
+        queue.put((index, True, func(*args)))
+    except Exception, ex:
+        traceback.print_exc(file=sys.stdout)
+        queue.put((index, False, '%s: %s' % (type(ex).__name__, ex)))
+
+
+def _start(index, func, args, queue):
+    p = multiprocessing.Process(target=_run, args=(index, func, args, queue))
+    p.daemon = True
+    p.start()
+    return p
+
+
+def _next_result(queue, running, poll=1):
+    """ Wait for the next (index, success, value) tuple to arrive from a worker.
+        A worker which dies without reporting (e.g. a segfault
+        in the ScienceTools) is reported as a failure. """
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            for index,p in running.items():
+                if p.exitcode is not None:
+                    # give any result still in the pipe a chance to arrive
+                    try:
+                        return queue.get(timeout=poll)
+                    except Empty:
+                        return index, False, 'worker exited with code %s' % p.exitcode
+
+
+def _terminate(running):
+    for p in running.values():
+        p.terminate()
+        p.join()
+    running.clear()
+
+
+def default_processes():
+    return multiprocessing.cpu_count()
+
+
+def fork_map(func, items, processes=None, raise_exceptions=True):
+    """ Like map(func, items), but each call is performed in a forked worker
+        process with at most 'processes' workers running at once.
+
+        The results are returned in the same order as items. If
+        raise_exceptions is False, a failed call returns
+        a WorkerException object in place of its result. """
+    items = list(items)
+    if processes is None: processes = default_processes()
+
+    queue = multiprocessing.Queue()
+    results = [None]*len(items)
+    pending = range(len(items))
+    running = dict()
+
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < processes:
+                index = pending.pop(0)
+                running[index] = _start(index, func, (items[index],), queue)
+
+            index, success, value = _next_result(queue, running)
+            running.pop(index).join()
+
+            if success:
+                results[index] = value
+            elif raise_exceptions:
+                raise WorkerException("Worker %s failed: %s" % (index, value))
+            else:
+                results[index] = WorkerException(value)
+    finally:
+        _terminate(running)
+
+    return results
+
+
+def fork_race(funcs, accept=None):
+    """ Run each of the functions in funcs (which take no arguments) at
+        the same time in forked worker processes.
+
+        Return (index, value) for the first function to
+        finish successfully and whose value passes accept(value).
+        All remaining workers are killed.
+
+        Raises a WorkerException if no function succeeds. """
+    queue = multiprocessing.Queue()
+    running = dict((index, _start(index, func, (), queue)) for index,func in enumerate(funcs))
+
+    failures = []
+    try:
+        while len(running) > 0:
+            index, success, value = _next_result(queue, running)
+            running.pop(index).join()
+
+            if success and (accept is None or accept(value)):
+                return index, value
+            elif success:
+                failures.append('%s: result not accepted' % index)
+            else:
+                failures.append('%s: %s' % (index, value))
+    finally:
+        _terminate(running)
+
+    raise WorkerException("All workers failed (%s)" % '; '.join(failures))
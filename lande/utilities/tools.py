@@ -2,7 +2,7 @@
     can't think of a better place to put. 
     
     Author: Joshua Lande <joshualande@gmail.com> """
-from collections import OrderedDict
+from collections import OrderedDict, Mapping
 
 import yaml
 
@@ -110,6 +110,8 @@ def tolist(x):
         return x.tolist(dense=True)
     elif isinstance(x,OrderedDict):
         return dict(x)
+    elif isinstance(x,Mapping):
+        return dict((tolist(k),tolist(v)) for k,v in x.items())
     elif isinstance(x,basestring) or isinstance(x,np.str):
         x=str(x) # convert unicode & numpy strings 
         try:
@@ -183,6 +185,37 @@ class OrderedDefaultDict(OrderedDict):
         return type(self)(self.default_factory, self)
 
 
+class LazyDict(Mapping):
+    """ Read-only dictionary where each value is computed
+        by calling a function the first time it is accessed.
+
+            >>> def f():
+            ...     print 'computing'
+            ...     return 1
+            >>> d = LazyDict(a=f)
+            >>> d['a']
+            computing
+            1
+            >>> d['a']
+            1
+            >>> tolist(d)
+            {'a': 1}
+    """
+    def __init__(self, **funcs):
+        self._funcs = funcs
+        self._values = dict()
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            self._values[key] = self._funcs[key]()
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._funcs)
+
+    def __len__(self):
+        return len(self._funcs)
+
 
 if __name__ == "__main__":
     import doctest